@@ -69,7 +69,7 @@ class MainLogger:
         :return:
         """
         test_returns = self.episodal_stats[Collectibles.RETURN]["test"][Originator.HOME]
-        test_finished = len(test_returns) == self.test_n_episode
+        test_finished = len(test_returns) >= self.test_n_episode  # Asynchronous steppers may return more episodes
         # Collect test data as long as test is running
         if self.test_mode and test_finished:
             self._log_collectibles(t_env)  # ... then process and log collectibles
@@ -45,6 +45,9 @@ class LeagueExperimentInstance(ExperimentInstance):
         self.terminated: bool = False
 
         self._experiment = None
+        # Opponents with episodes in the carried over replay buffer, most recent last. Episodes played against the AI
+        # carry the default tag.
+        self._buffer_tags = [-1]
 
     def _run_experiment(self):
         raise NotImplementedError("Please implement a league experiment.")
@@ -53,6 +56,23 @@ class LeagueExperimentInstance(ExperimentInstance):
     def home_agent_state(self) -> OrderedDict:
         return self._experiment.home_mac.agent.state_dict()  # return agent of the controller in the current experiment
 
+    def _carried_buffer(self, tag: int):
+        """
+        Hand the replay buffer of the finished experiment over to the next one if buffer_carry_over is set. Episodes
+        of all but the last buffer_keep_opponents opponents are evicted.
+        :param tag: tag of the next opponent
+        :return: replay buffer or None to build a new one
+        """
+        if not self._args.buffer_carry_over or self._experiment is None:
+            return None
+        buffer = self._experiment.home_buffer
+        self._buffer_tags = [t for t in self._buffer_tags if t != tag] + [tag]
+        keep = self._args.buffer_keep_opponents
+        if 0 < keep < len(self._buffer_tags):
+            buffer.evict(self._buffer_tags[:-keep])
+            self._buffer_tags = self._buffer_tags[-keep:]
+        return buffer
+
     def _configure_experiment(self, home: Team, ai: bool, away: Team = None):
         # In case this process needs to save models -> modify token
         self._args.env_args['match_build_plan'][0]['units'] = home.units  # mirror if no away units passed
@@ -83,16 +103,7 @@ class LeagueExperimentInstance(ExperimentInstance):
         self._sync_barrier.wait() if self._sync_barrier is not None else None
 
     def _extract_result(self, env_info: dict) -> PayoffEntry:
-        policy_team_id = self._experiment.stepper.policy_team_id
-        draw = env_info["draw"]
-        battle_won = env_info["battle_won"]
-        if draw or all(battle_won) or not any(battle_won):
-            result = PayoffEntry.DRAW  # Draw if all won or all lost
-        elif battle_won[policy_team_id]:  # Policy team(= home team) won
-            result = PayoffEntry.WIN
-        else:
-            result = PayoffEntry.LOSS  # Policy team(= home team) lost
-        return result
+        return self._experiment.episode_result(env_info)
 
     def _update_payoff(self, env_info: Dict):
         """
@@ -86,8 +86,10 @@ class EnsembleLeagueInstance(LeagueExperimentInstance):
                 args=self._args,
                 logger=self._logger,
                 on_episode_end=self._update_payoff,
-                log_start_t=self._t_env
+                log_start_t=self._t_env,
+                home_buffer=self._carried_buffer(tag=self._adversary_team.tid)
             )
+            self._experiment.home_buffer.tag = self._adversary_team.tid
             self._logger.info(f"Load ensemble agents {str(self)}")
             self._experiment.load_ensemble(native=foreign_params, foreign=agent_state)
             self._experiment.load_adversary(agent=foreign_params)
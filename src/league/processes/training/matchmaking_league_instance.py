@@ -55,8 +55,10 @@ class MatchmakingLeagueInstance(LeagueExperimentInstance):
                 args=self._args,
                 logger=self._logger,
                 on_episode_end=self._update_payoff,
-                log_start_t=self._t_env
+                log_start_t=self._t_env,
+                home_buffer=self._carried_buffer(tag=self._adversary_team.tid)
             )
+            self._experiment.home_buffer.tag = self._adversary_team.tid
             self._logger.info(f"Loading adversary team {self._adversary_team.tid} in {str(self)}")
             self._experiment.load_home_agent(agent=agent_state)
             self._experiment.load_adversary(agent=adversary_params)
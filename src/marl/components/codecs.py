@@ -0,0 +1,102 @@
+import torch as th
+import torch.nn.functional as F
+
+
+class Codec:
+    """
+    Storage codecs compress a scheme field within the replay buffer. A field is encoded when episodes are inserted and
+    decoded when episodes are sampled, so learners always read the original dtype and shape.
+    Codecs operate on the full field tensor including batch (and time) dimension.
+    """
+    def encode(self, tensor):
+        raise NotImplementedError
+
+    def decode(self, stored, out):
+        raise NotImplementedError
+
+    def infer_storage_info(self, shape_in, dtype_in):
+        raise NotImplementedError
+
+
+class HalfPrecision(Codec):
+    def __init__(self, dtype=th.float16):
+        self.dtype = dtype
+
+    def encode(self, tensor):
+        return tensor.to(self.dtype)
+
+    def decode(self, stored, out):
+        out.copy_(stored)
+
+    def infer_storage_info(self, shape_in, dtype_in):
+        return shape_in, self.dtype
+
+
+class AffineQuantization(Codec):
+    def __init__(self, low=0., high=1.):
+        """
+        Quantizes bounded features in [low, high] into 256 evenly spaced levels stored as uint8.
+        :param low: lower bound of the features
+        :param high: upper bound of the features
+        """
+        self.low = low
+        self.scale = (high - low) / 255.
+
+    def encode(self, tensor):
+        return ((tensor - self.low) / self.scale).round_().clamp_(0, 255).to(th.uint8)
+
+    def decode(self, stored, out):
+        th.mul(stored, self.scale, out=out)
+        out.add_(self.low)
+
+    def infer_storage_info(self, shape_in, dtype_in):
+        return shape_in, th.uint8
+
+
+class BitPack(Codec):
+    def __init__(self, dim=-1):
+        """
+        Packs boolean values (f.e. masks) into bits along a given dimension, 8 values per byte.
+        :param dim: dimension to pack along - the last dimension for action masks, the time dimension (=1) for
+        per-step flags such as terminated or filled.
+        """
+        self.dim = dim
+        self._weights = th.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=th.uint8)
+        self._shifts = th.arange(7, -1, -1, dtype=th.uint8)
+
+    def encode(self, tensor):
+        bits = (tensor != 0).to(th.uint8).movedim(self.dim, -1)
+        bits = F.pad(bits, (0, -bits.shape[-1] % 8))
+        bits = bits.view(*bits.shape[:-1], -1, 8) * self._weights.to(bits.device)
+        return bits.sum(dim=-1, dtype=th.uint8).movedim(-1, self.dim)
+
+    def decode(self, stored, out):
+        bits = (stored.movedim(self.dim, -1).unsqueeze(-1) >> self._shifts.to(stored.device)) & 1
+        bits = bits.flatten(-2)[..., :out.shape[self.dim]]
+        out.copy_(bits.movedim(-1, self.dim))
+
+    def infer_storage_info(self, shape_in, dtype_in):
+        shape = list(shape_in)
+        shape[self.dim] = (shape[self.dim] + 7) // 8
+        return tuple(shape), th.uint8
+
+
+REGISTRY = {
+    "float16": HalfPrecision,
+    "bfloat16": lambda: HalfPrecision(dtype=th.bfloat16),
+    "uint8": AffineQuantization,
+    "bitpack": BitPack
+}
+
+
+def build_codec(spec) -> Codec:
+    """
+    Build a codec from its configuration. Either a registry name f.e. "float16" or a dict holding the name in "codec"
+    and the arguments of the codec f.e. {"codec": "uint8", "low": -1, "high": 1}.
+    :param spec:
+    :return:
+    """
+    if isinstance(spec, str):
+        return REGISTRY[spec]()
+    spec = dict(spec)
+    return REGISTRY[spec.pop("codec")](**spec)
@@ -62,7 +62,8 @@ class EpisodeBatch:
                  max_seq_length,
                  data=None,
                  preprocess=None,
-                 device="cpu"):
+                 device="cpu",
+                 shared=None):
         """
         Batch of episodes.
         :param scheme:
@@ -72,6 +73,9 @@ class EpisodeBatch:
         :param data: Data of all episodes
         :param preprocess: Pre-processing steps to the data
         :param device: Device-type for tensors
+        :param shared: Tensors of transition fields to use instead of allocating them, f.e. fields of another batch
+        (see shared_fields()) which are common to both batches. Writes are seen by both batches, so only one of them
+        has to write a shared field.
         """
         self.scheme = scheme.copy()
         self.groups = groups
@@ -79,12 +83,18 @@ class EpisodeBatch:
         self.max_seq_length = max_seq_length
         self.preprocess = {} if preprocess is None else preprocess
         self.device = device
+        # Derived fields which are only computed when read: derived key -> (source key, transforms)
+        self._lazy = {new_k: (k, transforms) for k, (new_k, transforms) in self.preprocess.items()
+                      if all(transform.lazy for transform in transforms)}
+        self._derived = {}  # Cache of computed lazy fields - invalidated on update of their source
+        self._shared = {} if shared is None else shared
 
         if data is not None:
             self.data = data
         else:
             self.data = _new_data_sn()
             self._setup_data(self.scheme, self.groups, batch_size, max_seq_length, self.preprocess)
+        self._compile_field_shapes()
 
     def _setup_data(self, scheme, groups, batch_size, max_seq_length, preprocess):
         # Preprocess scheme
@@ -111,16 +121,22 @@ class EpisodeBatch:
                 # Carry episode_const key over to new scheme value
                 if "episode_const" in self.scheme[k]:
                     self.scheme[new_k]["episode_const"] = self.scheme[k]["episode_const"]
+                # Lazy fields are part of the scheme but never stored
+                if new_k in self._lazy:
+                    self.scheme[new_k]["lazy"] = True
 
         # "filled" not allowed as key since used for masking in learners -> add to scheme
-        assert "filled" not in scheme, '"filled" is a reserved key for masking.'
+        # Only the storage codec of "filled" may be configured
+        assert set(scheme.get("filled", {})) <= {"codec"}, '"filled" is a reserved key for masking.'
         scheme.update({
-            "filled": {"vshape": (1,), "dtype": th.long},
+            "filled": {**scheme.get("filled", {}), "vshape": (1,), "dtype": th.long},
         })
 
         # Setup scheme
         for field_key, field_info in scheme.items():
             assert "vshape" in field_info, "Scheme must define vshape for {}".format(field_key)
+            if field_info.get("lazy", False):
+                continue
             vshape = field_info["vshape"]
             episode_const = field_info.get("episode_const", False)  # episode_const is per default False
             group = field_info.get("group", None)  # group is per default None
@@ -137,14 +153,43 @@ class EpisodeBatch:
                 shape = vshape
 
             if episode_const:  # always same episode length -> leave out max_seq_length in tensor construction
-                self.data.episode_data[field_key] = th.zeros((batch_size, *shape), dtype=dtype, device=self.device)
+                self.data.episode_data[field_key] = self._new_tensor(field_key, (batch_size, *shape), dtype)
             else:
-                self.data.transition_data[field_key] = th.zeros((batch_size, max_seq_length, *shape), dtype=dtype,
-                                                                device=self.device)
+                shape = (batch_size, max_seq_length, *shape)
+                if field_key in self._shared:
+                    tensor = self._shared[field_key]
+                    assert tensor.shape == shape and tensor.dtype == dtype, \
+                        "Shared tensor does not match the scheme of {}".format(field_key)
+                    self.data.transition_data[field_key] = tensor
+                else:
+                    self.data.transition_data[field_key] = self._new_tensor(field_key, shape, dtype)
+
+    def _new_tensor(self, key, shape, dtype):
+        """
+        Allocate the storage of a single scheme field. Subclasses may override to change where data is stored.
+        :param key: name of the field
+        :param shape: full shape of the field including batch (and time) dimension
+        :param dtype: data type of the field
+        :return: zero initialized tensor
+        """
+        return th.zeros(shape, dtype=dtype, device=self.device)
 
     def extend(self, scheme, groups=None):
         # Extend via new setup -> groups are carried over if set to None (default)
         self._setup_data(scheme, self.groups if groups is None else groups, self.batch_size, self.max_seq_length)
+        self._compile_field_shapes()
+
+    def _compile_field_shapes(self):
+        # Shape of a single entry of every field (without batch and time dimension) to validate stacked updates
+        self._field_shapes = {k: tuple(v.shape[2:]) for k, v in self.data.transition_data.items()}
+        self._field_shapes.update({k: tuple(v.shape[1:]) for k, v in self.data.episode_data.items()})
+
+    def shared_fields(self, keys):
+        """
+        :param keys: transition fields to share
+        :return: tensors of the fields to pass as shared to another batch
+        """
+        return {k: self.data.transition_data[k] for k in keys}
 
     def to(self, device):
         # Convert all data from the scheme to specified device
@@ -152,6 +197,7 @@ class EpisodeBatch:
             self.data.transition_data[k] = v.to(device)
         for k, v in self.data.episode_data.items():
             self.data.episode_data[k] = v.to(device)
+        self._derived.clear()
         self.device = device
 
     def update(self, data, bs=slice(None), ts=slice(None), mark_filled=True):
@@ -185,7 +231,9 @@ class EpisodeBatch:
             target[key][_slices] = value.view_as(target[key][_slices])
 
             # Perform pre-processing
-            if key in self.preprocess:
+            if key in self.preprocess and self.preprocess[key][0] in self._lazy:
+                self._derived.pop(self.preprocess[key][0], None)  # Derived on next read
+            elif key in self.preprocess:
                 new_k = self.preprocess[key][0]  # Get new key defined by preprocess method
                 value = target[key][_slices]  # Get original value
                 for transform in self.preprocess[key][1]:  # Get all transforms and apply them in array order
@@ -194,6 +242,54 @@ class EpisodeBatch:
                 _check_safe_view(value, target[new_k][_slices], key)
                 target[new_k][_slices] = value.view_as(target[new_k][_slices])
 
+    def update_stacked(self, data, bs=slice(None), ts=slice(None), mark_filled=True):
+        """
+        Fast path of update() for data which is already stacked per key into contiguous NumPy arrays (or tensors), f.e.
+        an array of shape (len(bs), n_agents, obs_shape) for the observations of a single timestep ts. Arrays are
+        wrapped with th.from_numpy without copying and validated against the field shapes compiled at scheme setup.
+        :param data: stacked array per key - rows are ordered as the batch indices bs
+        :param bs: list or slice of batch indices
+        :param ts: timestep, slice of timesteps or list of one timestep per batch index in bs
+        :param mark_filled:
+        :return:
+        """
+        if isinstance(bs, list):
+            n_bs, bs = len(bs), th.tensor(bs, dtype=th.long, device=self.device)
+        else:
+            n_bs = _get_num_items(bs, self.batch_size)
+        if isinstance(ts, list):  # Timestep of each row
+            assert isinstance(bs, th.Tensor) and len(ts) == n_bs, "Timesteps per row require a list of batch indices."
+            n_ts, ts = (), th.tensor(ts, dtype=th.long, device=self.device)
+        else:
+            n_ts = () if isinstance(ts, int) else (_get_num_items(ts, self.max_seq_length),)
+        for key, value in data.items():
+            if key in self.data.transition_data:
+                target, index, rows = self.data.transition_data, (bs, ts), (n_bs, *n_ts)
+                if mark_filled:
+                    target["filled"][index] = 1
+                    mark_filled = False
+            elif key in self.data.episode_data:
+                target, index, rows = self.data.episode_data, bs, (n_bs,)
+            else:
+                raise KeyError("{} not found in transition or episode data".format(key))
+
+            value = th.from_numpy(value) if isinstance(value, np.ndarray) else value
+            if value.shape != (*rows, *self._field_shapes[key]):
+                raise ValueError("Unsafe reshape of {} to {} at Key: {}".format(
+                    tuple(value.shape), (*rows, *self._field_shapes[key]), key))
+            # Only converts if the array does not match the field already
+            target[key][index] = value.to(device=self.device, dtype=target[key].dtype)
+
+            # Perform pre-processing
+            if key in self.preprocess and self.preprocess[key][0] in self._lazy:
+                self._derived.pop(self.preprocess[key][0], None)  # Derived on next read
+            elif key in self.preprocess:
+                new_k = self.preprocess[key][0]
+                value = target[key][index]
+                for transform in self.preprocess[key][1]:
+                    value = transform.transform(value)
+                target[new_k][index] = value
+
     def __getitem__(self, item):
         # If item is a string
         if isinstance(item, str):
@@ -202,6 +298,8 @@ class EpisodeBatch:
                 return self.data.episode_data[item]
             elif item in self.data.transition_data:
                 return self.data.transition_data[item]
+            elif item in self._lazy:
+                return self._derive(item)
             else:
                 raise ValueError
         # If item is a string only tuple
@@ -213,6 +311,8 @@ class EpisodeBatch:
                     new_data.transition_data[key] = self.data.transition_data[key]
                 elif key in self.data.episode_data:
                     new_data.episode_data[key] = self.data.episode_data[key]
+                elif key in self._lazy:  # Requested lazy fields are handed over derived
+                    new_data.transition_data[key] = self._derive(key)
                 else:
                     raise KeyError("Unrecognised key {}".format(key))
 
@@ -234,11 +334,65 @@ class EpisodeBatch:
             ret_bs = _get_num_items(item[0], self.batch_size)
             ret_max_t = _get_num_items(item[1], self.max_seq_length)
 
-            ret = EpisodeBatch(self.scheme, self.groups, ret_bs, ret_max_t, data=new_data, device=self.device)
+            ret = EpisodeBatch(self.scheme, self.groups, ret_bs, ret_max_t, data=new_data, preprocess=self.preprocess,
+                               device=self.device)
             return ret
 
+    def get_timestep(self, key, t):
+        """
+        Read a field at a single timestep (or time slice). Lazy fields which are not derived yet are only computed for
+        the requested timesteps, which keeps the per-step reads of controllers during rollouts cheap.
+        :param key:
+        :param t:
+        :return:
+        """
+        if key in self._lazy and key not in self._derived:
+            return self._apply_lazy(key, (slice(None), t))
+        return self[key][:, t]
+
+    def _derive(self, key):
+        if key not in self._derived:
+            self._derived[key] = self._apply_lazy(key, (slice(None), slice(None)))
+        return self._derived[key]
+
+    def _apply_lazy(self, key, item):
+        source, transforms = self._lazy[key]
+        if self.scheme[key].get("episode_const", False):
+            return self._transform(self[source][item[0]], transforms)
+        value = self._transform(self[source][item], transforms)
+        # Timesteps which were never written stay zero, as they would be if the field was transformed on update
+        filled = self["filled"][item]
+        return value * filled.view(*filled.shape, *[1] * (value.dim() - filled.dim())).to(value.dtype)
+
+    @staticmethod
+    def _transform(value, transforms):
+        for transform in transforms:  # Get all transforms and apply them in array order
+            value = transform.transform(value)
+        return value
+
+    def clear(self, bs=slice(None)):
+        """
+        Zero all data of the given batch entries, so they can be refilled by a new episode as a new batch would be.
+        :param bs: batch entries to clear
+        :return:
+        """
+        for v in self.data.transition_data.values():
+            v[bs] = 0
+        for v in self.data.episode_data.values():
+            v[bs] = 0
+        self.invalidate_derived()
+
+    def invalidate_derived(self):
+        """
+        Drop all cached lazy fields. Needed if the underlying data was written without update().
+        :return:
+        """
+        self._derived.clear()
+
     def max_t_filled(self):
         # Return the number of the maximum timestep until which a episode is filled (episodes have different length)
+        if "lengths" in self.data.episode_data:  # Batches sampled from packed storage carry their episode lengths
+            return self.data.episode_data["lengths"].max().clamp(max=self.max_seq_length)
         return th.sum(self.data.transition_data["filled"], 1).max(0)[0]
 
     def __repr__(self):
@@ -246,3 +400,28 @@ class EpisodeBatch:
                                                                                      self.max_seq_length,
                                                                                      self.scheme.keys(),
                                                                                      self.groups.keys())
+
+
+def concat_batches(batches) -> EpisodeBatch:
+    """
+    Concatenate batches of the same scheme along the batch dimension. Shorter batches are padded with zeros to the
+    longest max sequence length. Episode data is only kept if all batches have it.
+    :param batches:
+    :return: newly allocated batch
+    """
+    first = batches[0]
+    max_t = max(batch.max_seq_length for batch in batches)
+    data = _new_data_sn()
+    for k, v in first.data.transition_data.items():
+        parts = []
+        for batch in batches:
+            v = batch.data.transition_data[k]
+            if v.shape[1] < max_t:
+                v = th.cat([v, v.new_zeros((v.shape[0], max_t - v.shape[1], *v.shape[2:]))], dim=1)
+            parts.append(v)
+        data.transition_data[k] = th.cat(parts)
+    for k in first.data.episode_data:
+        if all(k in batch.data.episode_data for batch in batches):
+            data.episode_data[k] = th.cat([batch.data.episode_data[k] for batch in batches])
+    return EpisodeBatch(first.scheme, first.groups, sum(batch.batch_size for batch in batches), max_t, data=data,
+                        preprocess=first.preprocess, device=first.device)
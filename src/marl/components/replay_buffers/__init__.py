@@ -1,2 +1,10 @@
-from .replay_buffer import ReplayBuffer
-from .prioritized_replay_buffer import PrioritizedReplayBuffer
\ No newline at end of file
+from .replay_buffer import ReplayBuffer, balanced
+from .prioritized_replay_buffer import PrioritizedReplayBuffer
+from .packed_replay_buffer import PackedReplayBuffer
+from .prefetcher import BatchPrefetcher
+
+REGISTRY = {
+    "replay": ReplayBuffer,
+    "prioritized": PrioritizedReplayBuffer,
+    "packed": PackedReplayBuffer
+}
@@ -0,0 +1,176 @@
+from marl.components import EpisodeBatch
+from marl.components.episode_batch import _new_data_sn
+from marl.components.replay_buffers.replay_buffer import ReplayBuffer
+from typing import Dict, List, Optional
+import torch as th
+
+
+class PackedReplayBuffer(ReplayBuffer):
+    def __init__(self, scheme, groups, buffer_size: int, max_seq_length: int, preprocess=None, device="cpu",
+                 storage="memory", storage_dir=None, sampler="uniform", step_capacity=None):
+        """
+        ReplayBuffer which stores the filled timesteps of episodes back-to-back instead of padding every episode to the
+        max sequence length. Transition fields are stored as one ring of timesteps with an index holding the offset and
+        length of every episode slot. Episodes are padded only when they are sampled, to the length of the longest
+        sampled episode. "filled" is not stored since it follows from the length index.
+        If an episode does not fit into the remaining timesteps of the ring it is written to the start of the ring.
+        The oldest episodes are evicted as soon as their timesteps are overwritten, so the buffer may hold fewer than
+        buffer_size episodes if episodes are long.
+        Sampled batches are padded to their longest episode and carry the episode lengths ("lengths") as episode data,
+        which answers max_t_filled() without summing "filled".
+        Reading transition fields from the buffer directly returns their packed form of shape (step_capacity, ...).
+        :param scheme:
+        :param groups:
+        :param buffer_size: maximum number of episodes
+        :param max_seq_length:
+        :param preprocess:
+        :param device:
+        :param storage:
+        :param storage_dir:
+        :param sampler:
+        :param step_capacity: number of timesteps stored over all episodes. Defaults to buffer_size * max_seq_length,
+        which never evicts episodes early - choose it according to the expected episode length to save memory.
+        """
+        self.step_capacity = buffer_size * max_seq_length if step_capacity is None else step_capacity
+        assert self.step_capacity >= max_seq_length, "Step capacity must hold at least one full episode."
+        super(PackedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                 preprocess=preprocess,
+                                                 device=device,
+                                                 storage=storage,
+                                                 storage_dir=storage_dir,
+                                                 sampler=sampler)
+        # Length index - first timestep of the episode in each slot, the number of its timesteps is held in lengths
+        self.offsets = th.zeros((buffer_size,), dtype=th.long)
+        self.step_index = 0
+
+    def _new_tensor(self, key, shape, dtype):
+        if key == "filled":  # Given by the length index
+            shape = (0, *shape[2:])
+        elif not self.scheme[key].get("episode_const", False):
+            shape = (self.step_capacity, *shape[2:])
+        return super(PackedReplayBuffer, self)._new_tensor(key, shape, dtype)
+
+    def _overlaps(self, slot: int, start: int, length: int) -> bool:
+        offset = self.offsets[slot].item()
+        return offset < start + length and start < offset + self.lengths[slot].item()
+
+    def insert_episode_batch(self, ep_batch: EpisodeBatch, index=None):
+        index = self._episode_index(ep_batch, index)
+        for b, length in enumerate(index["length"].tolist()):
+            if self.step_index + length > self.step_capacity:
+                self.step_index = 0  # The remaining timesteps at the end of the ring stay unused
+            # Evict the oldest episodes as long as all slots are taken or their timesteps would be overwritten
+            while self.episodes_in_buffer > 0 and (self.episodes_in_buffer == self.buffer_size
+                                                   or self._overlaps(self._oldest_slot(), self.step_index, length)):
+                self.episodes_in_buffer -= 1
+            self._write_episode(ep_batch, b, length, index)
+            self.buffer_index = (self.buffer_index + 1) % self.buffer_size
+            self.episodes_in_buffer += 1
+        self.invalidate_derived()
+
+    def _write_episode(self, ep_batch: EpisodeBatch, b: int, length: int, index: Dict[str, th.Tensor]):
+        slot, steps = self.buffer_index, slice(self.step_index, self.step_index + length)
+        for k, v in ep_batch.data.transition_data.items():
+            if k != "filled":
+                v = v[b, :length]
+                self.data.transition_data[k][steps] = self.codecs[k][0].encode(v) if k in self.codecs else v
+        for k, v in ep_batch.data.episode_data.items():
+            v = v[b:b + 1]
+            self.data.episode_data[k][slot:slot + 1] = self.codecs[k][0].encode(v) if k in self.codecs else v
+        self.offsets[slot] = self.step_index
+        for k, v in index.items():
+            self.index[k][slot] = v[b]
+        self.step_index += length
+
+    def _n_fitting(self, lengths: th.Tensor) -> int:
+        n = super(PackedReplayBuffer, self)._n_fitting(lengths)
+        while lengths[len(lengths) - n:].sum() > self.step_capacity:
+            n -= 1
+        return n
+
+    def _time_coded(self) -> List[str]:
+        return []  # Timesteps are stored without time dimension - codecs encode each timestep on its own
+
+    def _stored_steps(self) -> Dict[str, th.Tensor]:
+        return {k: v for k, v in self.data.transition_data.items() if k != "filled"}
+
+    def _episode_steps(self, slots: th.Tensor, lengths: th.Tensor) -> th.Tensor:
+        starts = th.cumsum(lengths, 0) - lengths  # Start of each episode within the concatenated timesteps
+        steps = th.arange(lengths.sum().item()) + (self.offsets[slots] - starts).repeat_interleave(lengths)
+        return steps.to(self.device)
+
+    def _write_steps(self, steps: Dict[str, th.Tensor], lengths: th.Tensor):
+        # Episodes are written back-to-back from the start of the ring
+        n_steps = lengths.sum().item()
+        for k, v in steps.items():
+            self.data.transition_data[k][:n_steps] = v
+        self.offsets[:len(lengths)] = th.cumsum(lengths, 0) - lengths
+        self.step_index = n_steps
+
+    def _gather(self, ep_ids: th.Tensor, fields: Optional[set] = None) -> EpisodeBatch:
+        staging = self._staging_batch(len(ep_ids))
+        bs = len(ep_ids)
+        ep_ids = ep_ids.to(dtype=th.long)
+        lengths = self.lengths[ep_ids]
+        self._record_padding(lengths)
+        max_t = lengths.max().item()
+        # Timestep index of every entry in the padded batch - padding points at step 0 and is zeroed afterwards
+        ts = th.arange(max_t)
+        padding = (ts.unsqueeze(0) >= lengths.unsqueeze(1)).view(-1).to(self.device)
+        steps = (self.offsets[ep_ids].unsqueeze(1) + ts).view(-1).to(self.device).masked_fill_(padding, 0)
+
+        data = _new_data_sn()
+        for k, v in self.data.transition_data.items():
+            if fields is not None and k not in fields:
+                continue
+            out = staging.data.transition_data[k][:bs * max_t]
+            if k == "filled":
+                out.copy_(padding.logical_not().unsqueeze(1))
+            else:
+                self._select_steps(k, v, steps, out, bs)
+                out.masked_fill_(padding.view(-1, *[1] * (out.dim() - 1)), 0)
+            data.transition_data[k] = out.view(bs, max_t, *out.shape[1:])
+        ep_ids = ep_ids.to(self.device)
+        for k, v in self.data.episode_data.items():
+            if fields is not None and k not in fields:
+                continue
+            self._select(k, v, ep_ids, staging.data.episode_data[k])
+            data.episode_data[k] = staging.data.episode_data[k]
+        data.episode_data["lengths"] = staging.data.episode_data["lengths"].copy_(lengths)
+        return EpisodeBatch(self.scheme, self.groups, bs, max_t, data=data, preprocess=self.preprocess,
+                            device=self.device)
+
+    def _select_steps(self, key: str, stored: th.Tensor, steps: th.Tensor, out: th.Tensor, batch_size: int):
+        if key in self.codecs:
+            rows = self._encoded_staging[batch_size][key][:len(steps)]
+            th.index_select(stored, 0, steps, out=rows)
+            self.codecs[key][0].decode(rows, out=out)
+        else:
+            th.index_select(stored, 0, steps, out=out)
+
+    def _staging_batch(self, batch_size: int) -> EpisodeBatch:
+        key = self._next_staging_key(batch_size)
+        if key not in self._staging:
+            # Staging tensors are padded to the max sequence length - samples use their contiguous prefix
+            n_steps = batch_size * self.max_seq_length
+            data = _new_data_sn()
+            for k, v in self.data.transition_data.items():
+                shape, dtype = self.codecs[k][1:] if k in self.codecs else (v.shape[1:], v.dtype)
+                data.transition_data[k] = th.empty((n_steps, *shape), dtype=dtype, device=self.device)
+            for k, v in self.data.episode_data.items():
+                data.episode_data[k] = self._new_staging_tensor(k, v, batch_size)
+            data.episode_data["lengths"] = th.zeros((batch_size,), dtype=th.long, device=self.device)
+            self._encoded_staging[batch_size] = {
+                k: th.empty((n_steps if k in self.data.transition_data else batch_size, *v.shape[1:]),
+                            dtype=v.dtype, device=self.device)
+                for k, v in {**self.data.transition_data, **self.data.episode_data}.items() if k in self.codecs
+            }
+            self._staging[key] = EpisodeBatch(self.scheme, self.groups, batch_size, self.max_seq_length,
+                                              data=data, preprocess=self.preprocess, device=self.device)
+        return self._staging[key]
+
+    def __repr__(self):
+        return "PackedReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
+                                                                              self.buffer_size,
+                                                                              self.scheme.keys(),
+                                                                              self.groups.keys())
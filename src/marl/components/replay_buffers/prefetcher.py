@@ -0,0 +1,98 @@
+import queue
+import threading
+
+from marl.components import EpisodeBatch
+from marl.components.replay_buffers.replay_buffer import ReplayBuffer
+
+
+class BatchPrefetcher:
+    def __init__(self, buffer: ReplayBuffer, sample_fn, prepare_fn, batch_size: int, queue_size: int = 2,
+                 max_staleness: int = 2):
+        """
+        Assembles training batches in a background thread so that sampling, truncation and device transfer overlap
+        with training. Each batch is drawn from the buffer as it is at sampling time and queued together with the
+        number of episode batches inserted until then. Batches which missed more than max_staleness insertions are
+        dropped instead of trained on. While the prefetcher runs, the buffer must only be changed through it.
+        :param buffer:
+        :param sample_fn: draws a batch from the buffer - called while holding the buffer lock
+        :param prepare_fn: prepares a sampled batch for training f.e. truncation and device transfer
+        :param batch_size: batch size drawn by sample_fn
+        :param queue_size: number of ready batches kept in the queue
+        :param max_staleness: number of insertions a batch may miss. Batches wait in the queue for up to queue_size
+        insertions, so smaller values drop prefetched batches.
+        """
+        self.buffer = buffer
+        self.sample_fn = sample_fn
+        self.prepare_fn = prepare_fn
+        self.batch_size = batch_size
+        self.max_staleness = max_staleness
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Queued batches, the batch in training and the batch being assembled each need their own staging batch
+        self.buffer.staging_pool = queue_size + 2
+        self.inserts = 0
+        self.dropped = 0
+        self._occupancy = []  # Queue sizes seen by get() since the last call of occupancy()
+        self._insertion = threading.Condition(self.buffer.lock)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with self._insertion:
+                    if not self.buffer.can_sample(self.batch_size):
+                        self._insertion.wait(timeout=0.1)
+                        continue
+                    batch, inserts = self.sample_fn(self.buffer), self.inserts
+                self._put(inserts, self.prepare_fn(batch))
+        except Exception as e:  # Raised by get() - training would otherwise wait for batches forever
+            self._put(self.inserts, e)
+
+    def _put(self, inserts, batch):
+        while not self._stop.is_set():
+            try:
+                self.queue.put((inserts, batch), timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def insert_episode_batch(self, ep_batch: EpisodeBatch, index=None):
+        with self._insertion:
+            self.buffer.insert_episode_batch(ep_batch, index)
+            self.inserts += 1
+            self._insertion.notify_all()
+
+    def update_priorities(self, batch: EpisodeBatch, errors):
+        with self.buffer.lock:
+            self.buffer.update_priorities(batch, errors)
+
+    def get(self) -> EpisodeBatch:
+        """
+        Pop the next batch which is not stale. Blocks until one is ready. Errors raised while assembling batches are
+        raised here.
+        :return:
+        """
+        while True:
+            self._occupancy.append(self.queue.qsize())
+            inserts, batch = self.queue.get()
+            if isinstance(batch, Exception):
+                self.queue.put((inserts, batch))  # The thread ended - later calls raise as well
+                raise RuntimeError("Prefetching a training batch failed.") from batch
+            if self.inserts - inserts <= self.max_staleness:
+                return batch
+            self.dropped += 1
+
+    def occupancy(self) -> float:
+        """
+        Mean fill level of the queue (0 to 1) seen when popping batches since the last call. Low values mean training
+        waits for batch assembly.
+        :return:
+        """
+        occupancy = sum(self._occupancy) / (len(self._occupancy) * self.queue.maxsize) if self._occupancy else 0.
+        self._occupancy = []
+        return occupancy
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
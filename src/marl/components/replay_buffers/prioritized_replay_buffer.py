@@ -1,230 +1,205 @@
-import random
-
 import numpy as np
+import torch as th
 
 from marl.components import EpisodeBatch
+from marl.components.replay_buffers.replay_buffer import ReplayBuffer
 
 
 class BinarySumTree:
-    write = 0
 
-    def __init__(self, capacity):
+    def __init__(self, capacity: int):
         """
-        A binary tree data structure where the parent’s value is the sum of its children
-        :param capacity:
+        A binary tree data structure where the parent’s value is the sum of its children. A second tree over the same
+        leaves keeps the minimum of its children, which is needed to normalize importance-sampling weights.
+        Both trees are stored level by level in flat arrays (root at index 1, children of i at 2i and 2i+1) so that all
+        operations can be performed for a whole batch of leaves at once.
+        :param capacity: amount of leaves (=stored priorities)
         """
         self.capacity = capacity
-        self.tree = np.zeros(2 * capacity - 1)
+        self.depth = max(1, (capacity - 1).bit_length())  # levels below the root
+        self.n_leaves = 1 << self.depth  # leaves are padded to the next power of two
+        self.tree = np.zeros(2 * self.n_leaves)
+        self.min_tree = np.full(2 * self.n_leaves, np.inf)
+        self.write = 0
         self.n_entries = 0
 
-    def _propagate(self, idx, change):
-        """
-        Update to the root node
-        :param idx:
-        :param change:
-        :return:
-        """
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
+    def total(self) -> float:
+        return self.tree[1]
 
-        if parent != 0:
-            self._propagate(parent, change)
+    def min(self) -> float:
+        return self.min_tree[1]
 
-    def _retrieve(self, idx, s):
+    def add(self, priorities: np.ndarray) -> np.ndarray:
         """
-        Find sample on leaf node
-        :param idx:
-        :param s:
-        :return:
+        Store priorities at the next leaves in ring order.
+        :param priorities:
+        :return: leaf indices the priorities were written to
         """
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self.tree[left])
-
-    def total(self):
-        return self.tree[0]
-
-    def add(self, p):
+        priorities = np.atleast_1d(priorities)
+        idxs = (self.write + np.arange(len(priorities))) % self.capacity
+        self.update(idxs, priorities)
+        self.write = (self.write + len(priorities)) % self.capacity
+        self.n_entries = min(self.n_entries + len(priorities), self.capacity)
+        return idxs
+
+    def update(self, idxs: np.ndarray, priorities: np.ndarray):
         """
-        Store priority and sample
-        :param p:
-        :param data:
+        Set the priorities of many leaves and propagate the change to the root level by level. If a leaf index occurs
+        multiple times the last priority wins. Each parent is only recomputed once per level.
+        :param idxs: leaf indices
+        :param priorities: new priorities of the leaves
         :return:
         """
-        idx = self.write + self.capacity - 1
-
-        self.update(idx, p)
-
-        self.write += 1
-        if self.write >= self.capacity:
-            self.write = 0
-
-        if self.n_entries < self.capacity:
-            self.n_entries += 1
-
-    def update(self, idx, p):
-        change = p - self.tree[idx]
-
-        self.tree[idx] = p
-        self._propagate(idx, change)
-
-    def get(self, s):
+        idxs, priorities = np.atleast_1d(idxs), np.broadcast_to(priorities, np.shape(idxs))
+        # Keep the last occurrence of duplicate indices
+        idxs, last = np.unique(idxs[::-1], return_index=True)
+        priorities = priorities[::-1][last]
+
+        nodes = idxs + self.n_leaves
+        self.tree[nodes] = priorities
+        self.min_tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            self.min_tree[nodes] = np.minimum(self.min_tree[2 * nodes], self.min_tree[2 * nodes + 1])
+
+    def get(self, idxs: np.ndarray) -> np.ndarray:
         """
-        Get priority and sample
-        :param s:
-        :return:
+        :param idxs: leaf indices
+        :return: priorities of the leaves
         """
-        idx = self._retrieve(0, s)
-        didx = idx - self.capacity + 1
-
-        return idx, self.tree[idx], didx
-
-
-class Memory:  # stored as ( s, a, r, s_ ) in SumTree
-    e = 0.01
-    a = 0.6
-    beta = 0.4
-    beta_increment_per_sampling = 0.001
-
-    def __init__(self, capacity):
-        self.tree = BinarySumTree(capacity)
-        self.capacity = capacity
-
-    def _get_priority(self, error):
-        return (np.abs(error) + self.e) ** self.a
-
-    def add(self, error, sample):
-        p = self._get_priority(error)
-        self.tree.add(p)
-
-    def sample(self, n):
-        batch = []
-        idxs = []
-        segment = self.tree.total() / n
-        priorities = []
-
-        self.beta = np.min([1., self.beta + self.beta_increment_per_sampling])
-
-        for i in range(n):
-            a = segment * i
-            b = segment * (i + 1)
+        return self.tree[np.asarray(idxs) + self.n_leaves]
 
-            s = random.uniform(a, b)
-            (idx, p, data) = self.tree.get(s)
-            priorities.append(p)
-            batch.append(data)
-            idxs.append(idx)
-
-        sampling_probabilities = priorities / self.tree.total()
-        is_weight = np.power(self.tree.n_entries * sampling_probabilities, -self.beta)
-        is_weight /= is_weight.max()
-
-        return batch, idxs, is_weight
-
-    def update(self, idx, error):
-        p = self._get_priority(error)
-        self.tree.update(idx, p)
+    def retrieve(self, values: np.ndarray) -> np.ndarray:
+        """
+        Find the leaves at which the prefix sums of the priorities reach the given values. All values descend the
+        tree together, one level per iteration.
+        :param values: prefix sums in [0, total)
+        :return: leaf indices
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.)
+            nodes = left + go_right
+        # Guard against floating point drift leading into empty leaves
+        return np.minimum(nodes - self.n_leaves, max(self.n_entries - 1, 0))
+
+    def sample(self, n: int) -> np.ndarray:
+        """
+        Stratified sampling: split the total priority into n equal segments and draw one prefix sum from each.
+        :param n:
+        :return: leaf indices
+        """
+        segment = self.total() / n
+        values = (np.arange(n) + np.random.uniform(size=n)) * segment
+        return self.retrieve(np.minimum(values, np.nextafter(self.total(), 0)))
 
 
-class PrioritizedReplayBuffer(EpisodeBatch):
-    def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu"):
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu",
+                 storage="memory", storage_dir=None, alpha=0.6, beta=0.4, beta_increment=0.001, eps=0.01):
         """
-        ReplayBuffer is a EpisodeBatch which is caped in size by its buffer size.
+        ReplayBuffer which samples episodes proportional to their priority (Schaul et al., Prioritized Experience
+        Replay). The priority of an episode is derived from the TD-error magnitude reported by the learner. New episodes
+        receive the maximum priority seen so far to ensure they are trained on at least once.
+        Sampled batches carry the buffer indices ("ep_ids") and importance-sampling weights ("is_weights") of their
+        episodes as episode data.
         :param scheme:
         :param groups:
         :param buffer_size:
         :param max_seq_length:
         :param preprocess:
         :param device:
+        :param storage:
+        :param storage_dir:
+        :param alpha: how much prioritization is used (0 = uniform)
+        :param beta: initial importance-sampling correction (1 = full correction)
+        :param beta_increment: annealing of beta towards 1 per sample
+        :param eps: added to errors to keep every episode sampleable
         """
         super(PrioritizedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
                                                       preprocess=preprocess,
-                                                      device=device)
-        self.buffer_size = buffer_size  # same as self.batch_size but more explicit
+                                                      device=device,
+                                                      storage=storage,
+                                                      storage_dir=storage_dir)
         self.tree = BinarySumTree(capacity=buffer_size)
-        self.buffer_index = 0
-        self.episodes_in_buffer = 0
-        self.e = 0.01
-        self.a = 0.6
-        self.beta = 0.4
-        self.beta_increment_per_sampling = 0.001
-
-    def _get_priority(self, error):
-        return (np.abs(error) + self.e) ** self.a
-
-    def insert_episode_batch(self, ep_batch: EpisodeBatch, errors=None):
-        # If buffer does not overflow with new episode batch
-        if self.buffer_index + ep_batch.batch_size <= self.buffer_size:
-            priorities  = self._get_priority(errors)
-            self.tree.add(priorities, ep_batch)
-            # Add transition data as samples to buffer
-            self.update(ep_batch.data.transition_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
-                        slice(0, ep_batch.max_seq_length),
-                        mark_filled=False)
-            # Add episode data as samples to buffer
-            self.update(ep_batch.data.episode_data, slice(self.buffer_index, self.buffer_index + ep_batch.batch_size))
-            self.buffer_index = (self.buffer_index + ep_batch.batch_size)
-            self.episodes_in_buffer = max(self.episodes_in_buffer, self.buffer_index)
-            self.buffer_index = self.buffer_index % self.buffer_size
-            assert self.buffer_index < self.buffer_size
-        # If buffer overflows with new episode batch
-        else:
-            # Slice episode batch to size (buffer_left) fitting into buffer and insert recursively
-            buffer_left = self.buffer_size - self.buffer_index
-            self.insert_episode_batch(ep_batch[0:buffer_left, :])
-            self.insert_episode_batch(ep_batch[buffer_left:, :])
-
-    def can_sample(self, batch_size):
-        return self.episodes_in_buffer >= batch_size
-
-    def sample(self, batch_size) -> EpisodeBatch:
-        assert self.can_sample(batch_size)
-        if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]  # return complete buffer if the buffer is filled with one batch
-        else:
-            # Uniform sampling - Choose episode ids to include into the sample
-            ep_ids = np.random.choice(self.episodes_in_buffer, batch_size, replace=False)
-            return self[ep_ids]
-
-    def sample(self, batch_size: int) -> EpisodeBatch:
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def _get_priority(self, errors: np.ndarray) -> np.ndarray:
+        return (np.abs(errors) + self.eps) ** self.alpha
+
+    def _write(self, ep_batch: EpisodeBatch, slots: slice, index):
+        super(PrioritizedReplayBuffer, self)._write(ep_batch, slots, index)
+        # Tree leaves advance in the same ring order as the buffer slots
+        assert self.tree.write == slots.start, "Priority tree is out of sync with the buffer."
+        self.tree.add(np.full(slots.stop - slots.start, self.max_priority))
+
+    def _export(self, slots: th.Tensor) -> dict:
+        state = super(PrioritizedReplayBuffer, self)._export(slots)
+        state["priorities"] = th.from_numpy(self.tree.get(slots.numpy()))
+        return state
+
+    def _restore(self, state: dict):
+        super(PrioritizedReplayBuffer, self)._restore(state)
+        # Episodes saved without priorities are treated as new episodes
+        n = self.episodes_in_buffer
+        priorities = state.get("priorities", th.full((len(state["index"]["length"]),), self.max_priority)).numpy()
+        priorities = priorities[len(priorities) - n:]
+        self.tree = BinarySumTree(capacity=self.buffer_size)
+        if n > 0:
+            self.tree.add(priorities)
+            self.max_priority = max(self.max_priority, priorities.max())
+
+    def sample(self, batch_size: int, keys=None, weights=None) -> EpisodeBatch:
+        """
+        Sample episodes proportional to their priority. As with uniform sampling the returned batch is a reused
+        staging batch.
+        :param batch_size:
+        :param keys: keys required from the batch
+        :param weights: not supported - priorities define the sampling weights
+        :return:
+        """
         assert self.can_sample(batch_size)
-        if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]  # return complete buffer if the buffer is filled with one batch
-        else:
-            batch = []
-            ep_ids = []
-            segment = self.tree.total() / batch_size
-            priorities = []
-
-            self.beta = np.min([1., self.beta + self.beta_increment_per_sampling])
+        assert weights is None, "Prioritized sampling does not support weights over the episode index."
+        self.beta = min(1., self.beta + self.beta_increment)
 
-            for i in range(batch_size):
-                a = segment * i
-                b = segment * (i + 1)
+        ep_ids = self.tree.sample(batch_size)
+        priorities = self.tree.get(ep_ids)
+        # Normalize by the largest possible weight, which belongs to the smallest priority stored in the tree
+        is_weights = np.power(priorities / self.tree.min(), -self.beta)
 
-                s = random.uniform(a, b)
-                (idx, p, data) = self.tree.get(s)
-                priorities.append(p)
-                batch.append(data)
-                ep_ids.append(idx)
+        batch = self._gather(th.from_numpy(ep_ids), self._fields(keys))
+        batch.data.episode_data["ep_ids"].copy_(th.from_numpy(ep_ids))
+        batch.data.episode_data["is_weights"].copy_(th.from_numpy(is_weights).unsqueeze(1))
+        return batch
 
-            sampling_probabilities = priorities / self.tree.total()
-            is_weight = np.power(self.tree.n_entries * sampling_probabilities, -self.beta)
-            is_weight /= is_weight.max()
+    def update_priorities(self, batch: EpisodeBatch, errors: th.Tensor):
+        """
+        Update the priorities of all episodes of a sampled batch at once.
+        :param batch: batch returned by sample()
+        :param errors: per-episode TD-error magnitudes reported by the learner
+        :return:
+        """
+        priorities = self._get_priority(errors.detach().cpu().numpy())
+        self.tree.update(batch["ep_ids"].cpu().numpy(), priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
 
-            return self[ep_ids]
+    def _staging_batch(self, batch_size: int) -> EpisodeBatch:
+        batch = super(PrioritizedReplayBuffer, self)._staging_batch(batch_size)
+        if "ep_ids" not in batch.data.episode_data:
+            batch.data.episode_data["ep_ids"] = th.zeros((batch_size,), dtype=th.long, device=self.device)
+            batch.data.episode_data["is_weights"] = th.ones((batch_size, 1), device=self.device)
+        return batch
 
     def __repr__(self):
-        return "ReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
-                                                                        self.buffer_size,
-                                                                        self.scheme.keys(),
-                                                                        self.groups.keys())
+        return "PrioritizedReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
+                                                                                   self.buffer_size,
+                                                                                   self.scheme.keys(),
+                                                                                   self.groups.keys())
@@ -1,34 +1,139 @@
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
 from marl.components import EpisodeBatch
+from marl.components.codecs import Codec
+from marl.components.episode_batch import _new_data_sn
 import numpy as np
+import torch as th
+
+
+def balanced(column: str):
+    """
+    :param column: index column f.e. "tag" to balance opponents or "outcome" to balance wins, draws and losses
+    :return: sampling weights (see ReplayBuffer.sample()) which give every value of the column the same probability
+    """
+    def weights(index: Dict[str, th.Tensor]) -> th.Tensor:
+        _, inverse, counts = th.unique(index[column], return_inverse=True, return_counts=True)
+        return 1. / counts[inverse]
+    return weights
+
+
+def _vshape(info) -> tuple:
+    vshape = info["vshape"]
+    return (vshape,) if isinstance(vshape, int) else tuple(vshape)
 
 
 class ReplayBuffer(EpisodeBatch):
-    def __init__(self, scheme, groups, buffer_size: int, max_seq_length: int, preprocess=None, device="cpu"):
+    def __init__(self, scheme, groups, buffer_size: int, max_seq_length: int, preprocess=None, device="cpu",
+                 storage="memory", storage_dir=None, sampler="uniform"):
         """
         ReplayBuffer is a EpisodeBatch which is caped in size by its buffer size.
+        Episodes are stored in a ring of preallocated tensors (one per scheme field). With "memory" storage these
+        tensors are placed in shared memory (on CPU). With "memmap" storage they are backed by files in storage_dir so
+        the buffer can exceed the available RAM - sampled rows are then read through the OS page cache.
+        Fields whose scheme entry defines a "codec" are stored encoded and decoded on sampling, which means reading them
+        from the buffer directly returns their encoded form.
+        Sampling gathers the chosen episodes into reusable staging tensors instead of building new tensors on every call.
+        The "length_bucketed" sampler draws batches of episodes with similar lengths, which reduces the timesteps learners
+        unroll on padding. Every stored episode is still sampled with the same probability.
+        Inserted episodes are marked with the current tag (f.e. the id of the opponent they were played against) which
+        allows to evict them later. The buffer can be saved to disk without padding and restored into another buffer.
+        Besides the tensors the buffer keeps a columnar index with one entry per slot: "length", "tag", "return",
+        "outcome" (PayoffEntry of the episode, 0 if unknown) and "t_env" (environment step of the insertion).
+        Samples can be weighted or filtered by the index without reading the stored episodes.
         :param scheme:
         :param groups:
         :param buffer_size:
         :param max_seq_length:
         :param preprocess:
         :param device:
+        :param storage: "memory" or "memmap"
+        :param storage_dir: directory for the files of the "memmap" storage
+        :param sampler: "uniform" or "length_bucketed"
         """
+        assert storage in ["memory", "memmap"], "Unknown replay storage {}".format(storage)
+        assert storage != "memmap" or (storage_dir is not None and device == "cpu"), \
+            "Memory-mapped replay storage requires a storage directory and a CPU buffer."
+        assert sampler in ["uniform", "length_bucketed"], "Unknown replay sampler {}".format(sampler)
+        self.storage = storage
+        self.storage_dir = storage_dir
+        # Codec, decoded shape (without batch dim) and decoded dtype per encoded field
+        self.codecs: Dict[str, Tuple[Codec, Tuple, th.dtype]] = {}
         super(ReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess,
                                            device=device)
         self.buffer_size = buffer_size  # same as self.batch_size but more explicit
         self.buffer_index = 0
         self.episodes_in_buffer = 0
+        self.sampler = sampler
+        self.lengths = th.zeros((buffer_size,), dtype=th.long)  # Number of filled timesteps of the episode per slot
+        self.tags = th.full((buffer_size,), -1, dtype=th.long)  # Tag of the episode per slot
+        self.tag = -1  # Tag of inserted episodes
+        self.index: Dict[str, th.Tensor] = {
+            "length": self.lengths,
+            "tag": self.tags,
+            "return": th.zeros((buffer_size,)),
+            "outcome": th.zeros((buffer_size,), dtype=th.long),
+            "t_env": th.zeros((buffer_size,), dtype=th.long),
+        }
+        self._sampled_steps = 0  # Filled and unrolled timesteps of the batches sampled since the last padding_ratio()
+        self._unrolled_steps = 0
+        # Reusable sample batches per requested batch size and turn. Samples stay valid for staging_pool - 1 further
+        # samples of the same size, which allows to hold several sampled batches at once (f.e. when prefetching).
+        self.staging_pool = 1
+        self._staging_turn = 0
+        self._staging: Dict[Tuple[int, int], EpisodeBatch] = {}
+        self._encoded_staging: Dict[int, Dict[str, th.Tensor]] = {}  # Gathered rows of encoded fields before decoding
+        self.lock = threading.RLock()  # Guards the buffer if it is sampled from another thread
+
+    def _new_tensor(self, key, shape, dtype):
+        codec = self.scheme[key].get("codec", None)
+        if codec is not None:
+            self.codecs[key] = (codec, shape[1:], dtype)
+            shape, dtype = codec.infer_storage_info(shape, dtype)
+        if self.storage == "memmap":
+            return self._new_memmap(key, shape, dtype)
+        tensor = super(ReplayBuffer, self)._new_tensor(key, shape, dtype)
+        return tensor.share_memory_() if tensor.device.type == "cpu" else tensor
+
+    def _new_memmap(self, key, shape, dtype):
+        os.makedirs(self.storage_dir, exist_ok=True)
+        path = os.path.join(self.storage_dir, "{}_{}.dat".format(id(self), key))
+        # Dtypes unknown to numpy (f.e. bfloat16) are mapped as unsigned ints of the same size and viewed afterwards
+        np_dtype = np.dtype("u{}".format(th.empty((), dtype=dtype).element_size()))
+        array = np.memmap(path, dtype=np_dtype, mode="w+", shape=shape)  # Zero filled sparse file
+        # The mapping keeps the file alive. Unlinking right away frees the disk space once the buffer is released.
+        os.remove(path)
+        return th.from_numpy(array).view(dtype)
+
+    def insert_episode_batch(self, ep_batch: EpisodeBatch, index=None):
+        """
+        :param ep_batch:
+        :param index: values of index columns per episode f.e. {"outcome": [...], "t_env": [...]}. Length, return and
+        tag are taken from the episodes and the current tag if not given.
+        :return:
+        """
+        self._insert(ep_batch, self._episode_index(ep_batch, index))
+
+    def _episode_index(self, ep_batch: EpisodeBatch, index=None) -> Dict[str, th.Tensor]:
+        bs = ep_batch.batch_size
+        columns = {
+            "length": ep_batch["filled"].view(bs, -1).sum(1).cpu(),
+            "tag": th.full((bs,), self.tag, dtype=th.long),
+        }
+        if "reward" in ep_batch.data.transition_data:
+            # Unfilled timesteps of reused episode batches may hold rewards of an earlier episode
+            columns["return"] = (ep_batch["reward"] * ep_batch["filled"]).view(bs, -1).sum(1).cpu()
+        for k, v in ({} if index is None else index).items():
+            columns[k] = th.as_tensor(v, dtype=self.index[k].dtype)
+        return columns
 
-    def insert_episode_batch(self, ep_batch: EpisodeBatch):
+    def _insert(self, ep_batch: EpisodeBatch, index: Dict[str, th.Tensor]):
         # If buffer does not overflow with new episode batch
         if self.buffer_index + ep_batch.batch_size <= self.buffer_size:
-            # Add transition data as samples to buffer
-            self.update(ep_batch.data.transition_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
-                        slice(0, ep_batch.max_seq_length),
-                        mark_filled=False)
-            # Add episode data as samples to buffer
-            self.update(ep_batch.data.episode_data, slice(self.buffer_index, self.buffer_index + ep_batch.batch_size))
+            # Add transition and episode data as samples to buffer
+            self._write(ep_batch, slice(self.buffer_index, self.buffer_index + ep_batch.batch_size), index)
             self.buffer_index = (self.buffer_index + ep_batch.batch_size)
             self.episodes_in_buffer = max(self.episodes_in_buffer, self.buffer_index)
             self.buffer_index = self.buffer_index % self.buffer_size
@@ -37,20 +142,356 @@ class ReplayBuffer(EpisodeBatch):
         else:
             # Slice episode batch to size (buffer_left) fitting into buffer and insert recursively
             buffer_left = self.buffer_size - self.buffer_index
-            self.insert_episode_batch(ep_batch[0:buffer_left, :])
-            self.insert_episode_batch(ep_batch[buffer_left:, :])
+            self._insert(ep_batch[0:buffer_left, :], {k: v[:buffer_left] for k, v in index.items()})
+            self._insert(ep_batch[buffer_left:, :], {k: v[buffer_left:] for k, v in index.items()})
+
+    def _write(self, ep_batch: EpisodeBatch, slots: slice, index: Dict[str, th.Tensor]):
+        """
+        Copy all fields of the episode batch into the given buffer slots. Preprocessed fields are already part of the
+        episode batch and are therefore copied instead of transformed again. Lazy fields are not stored at all.
+        :param ep_batch:
+        :param slots:
+        :param index: index columns of the episodes
+        :return:
+        """
+        for k, v in ep_batch.data.transition_data.items():
+            v = self.codecs[k][0].encode(v) if k in self.codecs else v
+            self.data.transition_data[k][slots, :v.shape[1]] = v
+        for k, v in ep_batch.data.episode_data.items():
+            self.data.episode_data[k][slots] = self.codecs[k][0].encode(v) if k in self.codecs else v
+        for k, v in index.items():
+            self.index[k][slots] = v
+        self.invalidate_derived()
+
+    def matches(self, scheme, groups) -> bool:
+        """
+        :param scheme: scheme of new episodes
+        :param groups:
+        :return: whether episodes of the scheme can be stored in this buffer f.e. to reuse it in another experiment
+        """
+        stored = set(self.scheme) - {new_k for new_k, _ in self.preprocess.values()} - {"filled"}
+        if set(scheme) - {"filled"} != stored:
+            return False
+        for k in stored:
+            new, old = scheme[k], self.scheme[k]
+            if _vshape(new) != _vshape(old) \
+                    or new.get("dtype", th.float32) != old.get("dtype", th.float32) \
+                    or new.get("episode_const", False) != old.get("episode_const", False) \
+                    or groups.get(new.get("group", None), 1) != self.groups.get(old.get("group", None), 1) \
+                    or type(new.get("codec", None)) != type(old.get("codec", None)):
+                return False
+        return True
+
+    def evict(self, tags):
+        """
+        Remove all episodes with one of the given tags. The remaining episodes keep their order of insertion.
+        :param tags:
+        :return:
+        """
+        slots = self._slots(th.arange(self.episodes_in_buffer))
+        keep = th.isin(self.tags[slots], th.as_tensor(list(tags), dtype=th.long)).logical_not()
+        self._restore(self._export(slots[keep]))
+
+    def episode_index(self) -> Dict[str, th.Tensor]:
+        """
+        :return: index columns of the stored episodes in order of insertion
+        """
+        slots = self._slots(th.arange(self.episodes_in_buffer))
+        return {k: v[slots] for k, v in self.index.items()}
+
+    def save(self, path: str):
+        """
+        Save the stored episodes in order of insertion. Only filled timesteps are saved and encoded fields are saved in
+        their encoded form. Fields encoded along the time dimension are saved per episode.
+        :param path:
+        :return:
+        """
+        th.save(self._export(self._slots(th.arange(self.episodes_in_buffer))), path)
+
+    def load(self, path: str):
+        """
+        Replace the content of the buffer with the episodes saved by save(). If the buffer is too small, the newest
+        episodes are kept.
+        :param path:
+        :return:
+        """
+        self._restore(th.load(path))
+
+    def _export(self, slots: th.Tensor) -> dict:
+        """
+        :param slots: slots of the episodes to export
+        :return: episodes of the slots with the filled timesteps of all episodes concatenated
+        """
+        lengths = self.lengths[slots]
+        steps = self._episode_steps(slots, lengths)
+        ep_slots = slots.to(self.device)
+        return {
+            "index": {k: v[slots].clone() for k, v in self.index.items()},
+            "encoded": sorted(self.codecs),
+            "transition_data": {k: v[steps].cpu() for k, v in self._stored_steps().items()},
+            "slot_transition_data": {k: self.data.transition_data[k][ep_slots].cpu() for k in self._time_coded()},
+            "episode_data": {k: v[ep_slots].cpu() for k, v in self.data.episode_data.items()},
+        }
+
+    def _restore(self, state: dict):
+        """
+        Replace the stored episodes by exported episodes.
+        :param state: episodes returned by _export()
+        :return:
+        """
+        assert state["encoded"] == sorted(self.codecs), "Saved episodes were encoded with other codecs."
+        assert sorted(state["slot_transition_data"]) == sorted(self._time_coded()), \
+            "Saved episodes were encoded along other dimensions."
+        lengths = state["index"]["length"]
+        n = self._n_fitting(lengths)
+        skip = lengths[:len(lengths) - n].sum().item()  # Timesteps of the dropped oldest episodes
+        lengths = lengths[len(lengths) - n:]
+        steps = {k: v[skip:].to(self.device) for k, v in state["transition_data"].items()}
+        self._write_steps(steps, lengths)
+        for k, v in state["slot_transition_data"].items():
+            self.data.transition_data[k][:n] = v[len(v) - n:].to(self.device)
+        for k, v in state["episode_data"].items():
+            self.data.episode_data[k][:n] = v[len(v) - n:].to(self.device)
+        for k, v in state["index"].items():
+            self.index[k][:n] = v[len(v) - n:]
+        self.episodes_in_buffer = n
+        self.buffer_index = n % self.buffer_size
+        self.invalidate_derived()
+
+    def _n_fitting(self, lengths: th.Tensor) -> int:
+        """
+        :param lengths: lengths of episodes in order of insertion
+        :return: number of newest episodes which fit into the buffer
+        """
+        return min(len(lengths), self.buffer_size)
+
+    def _time_coded(self) -> List[str]:
+        # Transition fields whose codec packs several timesteps into one stored entry - "filled" follows from the
+        # episode lengths
+        return [k for k, v in self.data.transition_data.items() if v.shape[1] != self.max_seq_length and k != "filled"]
+
+    def _stored_steps(self) -> Dict[str, th.Tensor]:
+        # Transition fields with one entry per timestep - "filled" follows from the episode lengths
+        time_coded = self._time_coded()
+        return {k: v.flatten(0, 1) for k, v in self.data.transition_data.items()
+                if k != "filled" and k not in time_coded}
 
-    def can_sample(self, batch_size: int) ->  bool:
+    def _episode_steps(self, slots: th.Tensor, lengths: th.Tensor) -> th.Tensor:
+        """
+        :param slots:
+        :param lengths: lengths of the episodes in the slots
+        :return: indices into the stored timesteps (see _stored_steps) of the filled timesteps of the episodes
+        """
+        ts = th.arange(self.max_seq_length)
+        steps = slots.unsqueeze(1) * self.max_seq_length + ts
+        return steps[ts < lengths.unsqueeze(1)].to(self.device)
+
+    def _write_steps(self, steps: Dict[str, th.Tensor], lengths: th.Tensor):
+        """
+        Write the filled timesteps of episodes to the first slots and clear their padding. Fields encoded along the time
+        dimension are restored per episode instead.
+        :param steps: concatenated timesteps per transition field
+        :param lengths: episode lengths
+        :return:
+        """
+        filled = (th.arange(self.max_seq_length) < lengths.unsqueeze(1)).to(self.device)
+        for k, v in self.data.transition_data.items():
+            rows = v[:len(lengths)]
+            if k == "filled":
+                filled_rows = filled.unsqueeze(-1)
+                rows.copy_(self.codecs[k][0].encode(filled_rows) if k in self.codecs else filled_rows)
+            elif k in steps:
+                rows.zero_()
+                rows[filled] = steps[k]
+
+    def can_sample(self, batch_size: int) -> bool:
         return self.episodes_in_buffer >= batch_size
 
-    def sample(self, batch_size: int) -> EpisodeBatch:
+    def sample(self, batch_size: int, keys=None, weights=None) -> EpisodeBatch:
+        """
+        Sample episodes with the configured sampler. The returned batch is a staging batch which is reused by the next
+        call of sample() with the same batch size. Copy data out of it if it has to outlive the next sample.
+        :param batch_size:
+        :param keys: keys required from the batch f.e. Learner.required_keys() - only these fields are gathered
+        :param weights: maps the episode index (see episode_index()) to sampling weights per episode, which replace
+        the sampler. Boolean weights filter episodes f.e. lambda index: index["outcome"] == PayoffEntry.WIN
+        :return:
+        """
         assert self.can_sample(batch_size)
-        if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]  # return complete buffer if the buffer is filled with one batch
+        if weights is not None:
+            weights = weights(self.episode_index()).float()
+            assert (weights > 0).sum() >= batch_size, "Less than {} episodes with positive weight.".format(batch_size)
+            positions = th.multinomial(weights, batch_size, replacement=False)
+        elif self.episodes_in_buffer == batch_size:
+            positions = th.arange(batch_size)  # return complete buffer if the buffer is filled with one batch
+        elif self.sampler == "length_bucketed":
+            positions = self._sample_length_bucket(batch_size)
         else:
             # Uniform sampling - Choose episode ids to include into the sample
-            ep_ids = np.random.choice(self.episodes_in_buffer, batch_size, replace=False)
-            return self[ep_ids]
+            positions = th.from_numpy(np.random.choice(self.episodes_in_buffer, batch_size, replace=False))
+        return self._gather(self._slots(positions), self._fields(keys))
+
+    def sample_sequences(self, batch_size: int, sequence_length: int, burn_in: int = 0, keys=None,
+                         weights=None) -> EpisodeBatch:
+        """
+        Sample fixed-length sequences from anywhere inside episodes (R2D2, Kapturowski et al.). Episodes are chosen by
+        the configured sampler, within each episode the first trained step is chosen uniformly. A sequence holds up to
+        burn_in steps before its first trained step, which are only used to refresh the recurrent state stored in
+        "hidden_states", followed by sequence_length trained transitions and the step of their bootstrap target.
+        Sequences starting close to the beginning of their episode have a shorter burn-in and more trained steps. The
+        burn-in of every sequence is passed as episode data ("burn_in"). The returned batch is newly allocated.
+        :param batch_size:
+        :param sequence_length: number of trained transitions per sequence
+        :param burn_in: maximal number of steps to unroll before the first trained step
+        :param keys: keys required from the batch
+        :param weights: sampling weights of the episodes (see sample())
+        :return: batch of shape (batch_size, burn_in + sequence_length + 1)
+        """
+        assert "hidden_states" in self.scheme, "Sequence sampling requires hidden states to be stored in the buffer."
+        return self._chunk(self.sample(batch_size, keys=keys, weights=weights), burn_in + sequence_length + 1, burn_in)
+
+    def _chunk(self, episodes: EpisodeBatch, length: int, burn_in: int) -> EpisodeBatch:
+        bs, device = episodes.batch_size, episodes.device
+        lengths = episodes["filled"].view(bs, -1).sum(1)
+        # First trained step - the last filled step is only a bootstrap target
+        first = (th.rand(bs, device=device) * (lengths - 1).clamp(min=1)).long()
+        start = (first - burn_in).clamp(min=0)
+        ts = start.unsqueeze(1) + th.arange(length, device=device)
+        padding = ts >= lengths.unsqueeze(1)
+        ts = ts.clamp(max=episodes.max_seq_length - 1)
+
+        data = _new_data_sn()
+        for k, v in episodes.data.transition_data.items():
+            shape = (bs, length, *[1] * (v.dim() - 2))
+            chunk = v.gather(1, ts.view(shape).expand(bs, length, *v.shape[2:]))
+            data.transition_data[k] = chunk.masked_fill_(padding.view(shape), 0)
+        data.episode_data = {k: v.clone() for k, v in episodes.data.episode_data.items() if k != "lengths"}
+        data.episode_data["burn_in"] = first - start
+        return EpisodeBatch(self.scheme, self.groups, bs, length, data=data, preprocess=self.preprocess, device=device)
+
+    def _sample_length_bucket(self, batch_size: int) -> th.Tensor:
+        """
+        Sort the stored episodes by length (ties broken randomly) and take a window of batch_size neighbouring episodes
+        starting at a uniformly chosen position, wrapping around at the end. Each episode lies in exactly batch_size of
+        the windows, so it is sampled as often as with uniform sampling.
+        :param batch_size:
+        :return: positions of the chosen episodes among the stored episodes
+        """
+        n = self.episodes_in_buffer
+        lengths = self.lengths[self._slots(th.arange(n))]
+        order = th.argsort(lengths + th.rand(n))
+        return order[(np.random.randint(n) + th.arange(batch_size)) % n]
+
+    def _oldest_slot(self) -> int:
+        return (self.buffer_index - self.episodes_in_buffer) % self.buffer_size
+
+    def _slots(self, positions: th.Tensor) -> th.Tensor:
+        # Stored episodes occupy a ring of slots starting at the oldest episode
+        return (positions + self._oldest_slot()) % self.buffer_size
+
+    def padding_ratio(self) -> float:
+        """
+        Share of padded timesteps within the batches sampled since the last call, after truncating each batch to its
+        longest episode as the experiments do before training.
+        :return:
+        """
+        ratio = 1. - self._sampled_steps / self._unrolled_steps if self._unrolled_steps > 0 else 0.
+        self._sampled_steps, self._unrolled_steps = 0, 0
+        return ratio
+
+    def _record_padding(self, lengths: th.Tensor):
+        self._sampled_steps += lengths.sum().item()
+        self._unrolled_steps += len(lengths) * lengths.max().item()
+
+    def update_priorities(self, batch: EpisodeBatch, errors: th.Tensor):
+        """
+        Report the per-episode TD-error magnitudes of a sampled batch back to the buffer. Uniform sampling ignores them.
+        :param batch: batch returned by sample()
+        :param errors: per-episode TD-error magnitudes reported by the learner
+        :return:
+        """
+        pass
+
+    def _fields(self, keys) -> Optional[set]:
+        """
+        :param keys: keys required from a sampled batch or None for all keys
+        :return: stored fields needed to provide the keys - lazy fields are derived from their source field
+        """
+        if keys is None:
+            return None
+        return {"filled"} | {self._lazy[key][0] if key in self._lazy else key for key in keys}
+
+    def _project(self, batch: EpisodeBatch, fields: Optional[set]) -> EpisodeBatch:
+        """
+        Restrict a staging batch to the gathered fields. Episode data which is not stored in the buffer (f.e. the
+        importance weights of the prioritized buffer) is always kept.
+        :param batch:
+        :param fields:
+        :return:
+        """
+        if fields is None:
+            return batch
+        data = _new_data_sn()
+        data.transition_data = {k: v for k, v in batch.data.transition_data.items() if k in fields}
+        data.episode_data = {k: v for k, v in batch.data.episode_data.items()
+                             if k in fields or k not in self.data.episode_data}
+        return EpisodeBatch(self.scheme, self.groups, batch.batch_size, batch.max_seq_length, data=data,
+                            preprocess=self.preprocess, device=batch.device)
+
+    def _gather(self, ep_ids: th.Tensor, fields: Optional[set] = None) -> EpisodeBatch:
+        """
+        Gather the rows of the given episodes into the staging batch of matching size.
+        :param ep_ids: buffer indices of the episodes to gather
+        :param fields: fields to gather or None for all fields
+        :return:
+        """
+        out = self._staging_batch(len(ep_ids))
+        self._record_padding(self.lengths[ep_ids.long()])
+        ep_ids = ep_ids.to(device=self.device, dtype=th.long)
+        for k, v in self.data.transition_data.items():
+            if fields is None or k in fields:
+                self._select(k, v, ep_ids, out.data.transition_data[k])
+        for k, v in self.data.episode_data.items():
+            if fields is None or k in fields:
+                self._select(k, v, ep_ids, out.data.episode_data[k])
+        out.invalidate_derived()
+        return self._project(out, fields)
+
+    def _select(self, key: str, stored: th.Tensor, ep_ids: th.Tensor, out: th.Tensor):
+        if key in self.codecs:
+            rows = self._encoded_staging[len(ep_ids)][key]
+            th.index_select(stored, 0, ep_ids, out=rows)
+            self.codecs[key][0].decode(rows, out=out)
+        else:
+            th.index_select(stored, 0, ep_ids, out=out)
+
+    def _next_staging_key(self, batch_size: int) -> Tuple[int, int]:
+        key = (batch_size, self._staging_turn)
+        self._staging_turn = (self._staging_turn + 1) % self.staging_pool
+        return key
+
+    def _staging_batch(self, batch_size: int) -> EpisodeBatch:
+        key = self._next_staging_key(batch_size)
+        if key not in self._staging:
+            data = _new_data_sn()
+            for k, v in self.data.transition_data.items():
+                data.transition_data[k] = self._new_staging_tensor(k, v, batch_size)
+            for k, v in self.data.episode_data.items():
+                data.episode_data[k] = self._new_staging_tensor(k, v, batch_size)
+            self._encoded_staging[batch_size] = {
+                k: th.empty((batch_size, *v.shape[1:]), dtype=v.dtype, device=self.device)
+                for k, v in {**self.data.transition_data, **self.data.episode_data}.items() if k in self.codecs
+            }
+            self._staging[key] = EpisodeBatch(self.scheme, self.groups, batch_size, self.max_seq_length,
+                                              data=data, preprocess=self.preprocess, device=self.device)
+        return self._staging[key]
+
+    def _new_staging_tensor(self, key: str, stored: th.Tensor, batch_size: int) -> th.Tensor:
+        if key in self.codecs:  # Staging holds the decoded field
+            _, shape, dtype = self.codecs[key]
+        else:
+            shape, dtype = stored.shape[1:], stored.dtype
+        return th.empty((batch_size, *shape), dtype=dtype, device=self.device)
 
     def __repr__(self):
         return "ReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
@@ -2,6 +2,8 @@ import torch as th
 
 
 class Transform:
+    lazy = False  # Lazy transforms are applied when the derived field is read instead of on every update
+
     def transform(self, tensor):
         raise NotImplementedError
 
@@ -10,8 +12,9 @@ class Transform:
 
 
 class OneHot(Transform):
-    def __init__(self, out_dim):
+    def __init__(self, out_dim, lazy=False):
         self.out_dim = out_dim
+        self.lazy = lazy
 
     def transform(self, tensor):
         y_onehot = tensor.new(*tensor.shape[:-1], self.out_dim).zero_()
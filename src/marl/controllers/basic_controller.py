@@ -28,29 +28,34 @@ class BasicMAC(MultiAgentController):
 
     def select_actions(self, ep_batch, t_ep, t_env, bs=slice(None), test_mode=False):
         # Only select available actions for the selected batch elements in bs
-        avail_actions = ep_batch["avail_actions"][:, t_ep]
-        # Run forward propagation for the batch -> Q-values
-        agent_outs = self.forward(ep_batch, t_ep, test_mode=test_mode)
+        avail_actions = ep_batch["avail_actions"][bs, t_ep]
+        if "hidden_states" in ep_batch.data.transition_data:  # Store the hidden state fed into t for sequence replay
+            hidden_states = self.hidden_states.detach().reshape(ep_batch.batch_size, self.n_agents, -1)[bs]
+            ep_batch.update_stacked({"hidden_states": hidden_states}, bs=bs, ts=t_ep, mark_filled=False)
+        # Run forward propagation only for the selected batch elements -> Q-values
+        agent_outs = self.forward(ep_batch, t_ep, test_mode=test_mode, bs=bs)
         # Choose action by f.e. epsilon-greedy (except test mode is False)
-        chosen_actions, is_greedy = self.action_selector.select(agent_outs[bs], avail_actions[bs], t_env, test_mode)
+        chosen_actions, is_greedy = self.action_selector.select(agent_outs, avail_actions, t_env, test_mode)
         return chosen_actions, is_greedy
 
-    def forward(self, ep_batch, t, test_mode=False):
-        agent_inputs = self._build_inputs(ep_batch, t)
+    def forward(self, ep_batch, t, test_mode=False, bs=slice(None)):
+        agent_inputs = self._build_inputs(ep_batch, t, bs)
         if self.hidden_states is None:
             raise HiddenStateNotInitialized()
 
-        agent_outs = self._compute_agent_outputs(agent_inputs)
+        agent_outs = self._compute_agent_outputs(agent_inputs, bs)
 
         # Softmax the agent outputs if they're policy logits
         if self.agent_output_type == "pi_logits":
 
-            agent_outs = self._softmax(agent_outs, ep_batch, t, test_mode)
+            agent_outs = self._softmax(agent_outs, ep_batch, t, test_mode, bs)
 
-        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+        return agent_outs.view(-1, self.n_agents, agent_outs.shape[-1])
 
-    def _compute_agent_outputs(self, agent_inputs):
-        agent_outs, self.hidden_states = self.agent(agent_inputs, self.hidden_states)
+    def _compute_agent_outputs(self, agent_inputs, bs=slice(None)):
+        hidden_states = self._hidden_rows(self.hidden_states, bs, self.n_agents)
+        agent_outs, hidden_states = self.agent(agent_inputs, hidden_states)
+        self.hidden_states = self._with_hidden_rows(self.hidden_states, bs, hidden_states, self.n_agents)
         return agent_outs
 
     def update_trained_steps(self, update):
@@ -59,6 +64,37 @@ class BasicMAC(MultiAgentController):
     def init_hidden(self, batch_size):
         self.hidden_states = self.agent.init_hidden().unsqueeze(0).expand(batch_size, self.n_agents, -1)  # bav
 
+    def reset_hidden(self, bs):
+        self.hidden_states = self._reset_hidden_rows(self.hidden_states, bs, self.agent.init_hidden(), self.n_agents)
+
+    def get_hidden_states(self):
+        return self.hidden_states.detach()
+
+    def set_hidden_states(self, hidden_states):
+        self.hidden_states = hidden_states
+
+    @staticmethod
+    def _reset_hidden_rows(hidden_states, bs, init_hidden, n_agents):
+        hidden_states = hidden_states.reshape(-1, n_agents, hidden_states.shape[-1]).clone()  # bav
+        hidden_states[bs] = init_hidden
+        return hidden_states
+
+    @staticmethod
+    def _hidden_rows(hidden_states, bs, n_agents):
+        # Hidden states of the batch entries bs
+        if _all_rows(bs):
+            return hidden_states
+        return hidden_states.reshape(-1, n_agents, hidden_states.shape[-1])[bs]  # bav
+
+    @staticmethod
+    def _with_hidden_rows(hidden_states, bs, rows, n_agents):
+        # Hidden states with the entries bs replaced by rows - the other entries keep their hidden state
+        if _all_rows(bs):
+            return rows
+        hidden_states = hidden_states.reshape(-1, n_agents, hidden_states.shape[-1]).clone()  # bav
+        hidden_states[bs] = rows.reshape(-1, n_agents, rows.shape[-1])
+        return hidden_states
+
     def parameters(self):
         return self.agent.parameters()
 
@@ -77,18 +113,18 @@ class BasicMAC(MultiAgentController):
     def _build_agent(self, input_shape) -> AgentNetwork:
         return agent_REGISTRY[self.args.agent](input_shape, self.args)
 
-    def _build_inputs(self, batch: EpisodeBatch, t: int):
-        bs = batch.batch_size
-        inputs = [batch["obs"][:, t]]
+    def _build_inputs(self, batch: EpisodeBatch, t: int, bs=slice(None)):
+        inputs = [batch["obs"][bs, t]]
+        n_rows = inputs[0].shape[0]
         if self.args.obs_last_action:
             if t == 0:
-                inputs.append(th.zeros_like(batch["actions_onehot"][:, t]))
+                inputs.append(th.zeros_like(batch.get_timestep("actions_onehot", t)[bs]))
             else:
-                inputs.append(batch["actions_onehot"][:, t - 1])
+                inputs.append(batch.get_timestep("actions_onehot", t - 1)[bs])
         if self.args.obs_agent_id:
-            inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(bs, -1, -1))
+            inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(n_rows, -1, -1))
 
-        inputs = th.cat([x.reshape(bs * self.n_agents, -1) for x in inputs], dim=1)
+        inputs = th.cat([x.reshape(n_rows * self.n_agents, -1) for x in inputs], dim=1)
         return inputs
 
     def _get_input_shape(self, scheme):
@@ -99,3 +135,7 @@ class BasicMAC(MultiAgentController):
             input_shape += self.n_agents
 
         return input_shape
+
+
+def _all_rows(bs) -> bool:
+    return isinstance(bs, slice) and bs == slice(None)
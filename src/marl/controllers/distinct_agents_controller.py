@@ -29,10 +29,12 @@ class DistinctMAC(BasicMAC):
 
         self.hidden_states = None
 
-    def _compute_agent_outputs(self, agent_inputs):
+    def _compute_agent_outputs(self, agent_inputs, bs=slice(None)):
         agent_outs = []
         for i, agent in enumerate(self.agents):
-            agent_out, self.hidden_states[i] = agent(agent_inputs[:, i, :], self.hidden_states[i])
+            hidden_state = self._hidden_rows(self.hidden_states[i], bs, 1)
+            agent_out, hidden_state = agent(agent_inputs[:, i, :], hidden_state)
+            self.hidden_states[i] = self._with_hidden_rows(self.hidden_states[i], bs, hidden_state, 1)
             agent_outs.append(agent_out)
         agent_outs = th.cat(agent_outs, dim=0)
         return agent_outs
@@ -43,6 +45,15 @@ class DistinctMAC(BasicMAC):
             for agent in self.agents
         ]
 
+    def reset_hidden(self, bs):
+        self.hidden_states = [
+            self._reset_hidden_rows(hidden_states, bs, agent.init_hidden(), 1)
+            for agent, hidden_states in zip(self.agents, self.hidden_states)
+        ]
+
+    def get_hidden_states(self):
+        return [hidden_states.detach() for hidden_states in self.hidden_states]
+
     @staticmethod
     def _set_trained_steps(agent, steps):
         agent.trained_steps = steps
@@ -79,13 +90,13 @@ class DistinctMAC(BasicMAC):
     def _build_agent(self, input_shape):
         return [agent_REGISTRY[self.args.agent](input_shape, self.args) for _ in range(self.n_agents)]
 
-    def _build_inputs(self, batch: EpisodeBatch, t):
-        inputs = [batch["obs"][:, t]]
+    def _build_inputs(self, batch: EpisodeBatch, t, bs=slice(None)):
+        inputs = [batch["obs"][bs, t]]
         if self.args.obs_last_action:
             if t == 0:
-                inputs.append(th.zeros_like(batch["actions_onehot"][:, t]))
+                inputs.append(th.zeros_like(batch.get_timestep("actions_onehot", t)[bs]))
             else:
-                inputs.append(batch["actions_onehot"][:, t - 1])
+                inputs.append(batch.get_timestep("actions_onehot", t - 1)[bs])
 
         if self.args.obs_agent_id:
             raise NotImplementedError("Please deactivate agent id observation for distinct agents networks.")
@@ -27,32 +27,38 @@ class EnsembleMAC(BasicMAC):
         self._all_ids = set(range(self.n_agents))
 
     def select_actions(self, ep_batch, t_ep, t_env, bs=slice(None), test_mode=False):
-        avail_actions = ep_batch["avail_actions"][:, t_ep]
-        agent_outs = self.forward(ep_batch, t_ep, test_mode=test_mode)
-        chosen_actions, is_greedy = self.action_selector.select(agent_outs[bs], avail_actions[bs], t_env, test_mode)
+        avail_actions = ep_batch["avail_actions"][bs, t_ep]
+        agent_outs = self.forward(ep_batch, t_ep, test_mode=test_mode, bs=bs)
+        chosen_actions, is_greedy = self.action_selector.select(agent_outs, avail_actions, t_env, test_mode)
         return chosen_actions, is_greedy
 
-    def forward(self, ep_batch, t, test_mode=False):
-        native_inputs, specific_inputs = self._build_inputs(ep_batch, t)
+    def forward(self, ep_batch, t, test_mode=False, bs=slice(None)):
+        native_inputs, specific_inputs = self._build_inputs(ep_batch, t, bs)
+        n_rows = native_inputs.shape[0] // self.n_agents
 
-        agent_outs = self._compute_agent_outputs(native_inputs, specific_inputs, ep_batch.batch_size)
+        agent_outs = self._compute_agent_outputs(native_inputs, specific_inputs, n_rows, bs)
 
         # Softmax the agent outputs if they're policy logits
         if self.agent_output_type == "pi_logits":
             raise NotImplementedError()
 
-        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+        return agent_outs.view(n_rows, self.n_agents, -1)
 
-    def _compute_agent_outputs(self, native_inputs, specific_inputs=None, batch_size=None):
+    def _compute_agent_outputs(self, native_inputs, specific_inputs=None, batch_size=None, bs=slice(None)):
         # Infer with the original native network - Receives all obs
-        native_agent_outs, self.native_hidden_states = self.agent(native_inputs, self.native_hidden_states)
+        native_hidden_states = self._hidden_rows(self.native_hidden_states, bs, self.n_agents)
+        native_agent_outs, native_hidden_states = self.agent(native_inputs, native_hidden_states)
+        self.native_hidden_states = self._with_hidden_rows(self.native_hidden_states, bs, native_hidden_states,
+                                                           self.n_agents)
         agent_outs = native_agent_outs.view(batch_size, self.n_agents, -1)
 
         # Replace inference for specific agents with the corresponding network from the ensemble - Receive only one obs
         for aid, ensemble_agent in self.ensemble.items():
             specific_input = specific_inputs[aid, :].view(batch_size, -1)
-            hidden_state = self.ensemble_hidden_states[aid]
-            agent_outs[:, aid, :], self.ensemble_hidden_states[aid] = ensemble_agent(specific_input, hidden_state)
+            hidden_state = self._hidden_rows(self.ensemble_hidden_states[aid], bs, 1)
+            agent_outs[:, aid, :], hidden_state = ensemble_agent(specific_input, hidden_state)
+            self.ensemble_hidden_states[aid] = self._with_hidden_rows(self.ensemble_hidden_states[aid], bs,
+                                                                      hidden_state, 1)
 
         return agent_outs.view(batch_size * self.n_agents, -1)
 
@@ -63,18 +69,33 @@ class EnsembleMAC(BasicMAC):
             for aid, agent in self.ensemble.items()
         }
 
-    def _build_inputs(self, batch, t):
-        bs = batch.batch_size
-        inputs = [batch["obs"][:, t]]
+    def reset_hidden(self, bs):
+        self.native_hidden_states = self._reset_hidden_rows(self.native_hidden_states, bs, self.agent.init_hidden(),
+                                                            self.n_agents)
+        self.ensemble_hidden_states = {
+            aid: self._reset_hidden_rows(self.ensemble_hidden_states[aid], bs, agent.init_hidden(), 1)
+            for aid, agent in self.ensemble.items()
+        }
+
+    def get_hidden_states(self):
+        ensemble_hidden_states = {aid: h.detach() for aid, h in self.ensemble_hidden_states.items()}
+        return self.native_hidden_states.detach(), ensemble_hidden_states
+
+    def set_hidden_states(self, hidden_states):
+        self.native_hidden_states, self.ensemble_hidden_states = hidden_states
+
+    def _build_inputs(self, batch, t, bs=slice(None)):
+        inputs = [batch["obs"][bs, t]]
+        n_rows = inputs[0].shape[0]
         if self.args.obs_last_action:
             if t == 0:
-                inputs.append(th.zeros_like(batch["actions_onehot"][:, t]))
+                inputs.append(th.zeros_like(batch.get_timestep("actions_onehot", t)[bs]))
             else:
-                inputs.append(batch["actions_onehot"][:, t - 1])
+                inputs.append(batch.get_timestep("actions_onehot", t - 1)[bs])
         if self.args.obs_agent_id:
-            inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(bs, -1, -1))
+            inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(n_rows, -1, -1))
 
-        native_inputs = th.cat([x.reshape(bs * self.n_agents, -1) for x in inputs], dim=1)
+        native_inputs = th.cat([x.reshape(n_rows * self.n_agents, -1) for x in inputs], dim=1)
         specific_inputs = th.cat([x.reshape(self.n_agents, -1) for x in inputs], dim=1)
         return native_inputs, specific_inputs
 
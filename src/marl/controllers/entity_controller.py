@@ -8,26 +8,34 @@ class EntityMAC(BasicMAC):
     def __init__(self, scheme, groups, args):
         super(EntityMAC, self).__init__(scheme, groups, args)
 
-    def _build_inputs(self, batch, t):
+    def _build_inputs(self, batch, t, rows=slice(None)):
         # Assumes homogenous agents with entity + observation mask inputs.
-        bs = batch.batch_size
         entities = []
-        entities.append(batch["entities"][:, t])  # bs, ts, n_entities, vshape
+        entities.append(batch["entities"][rows, t])  # bs, ts, n_entities, vshape
+        bs = entities[0].shape[0]
         if self.args.entity_last_action:
             ent_acs = th.zeros(bs, t.stop - t.start, self.args.n_entities,
                                self.args.n_actions, device=batch.device,
                                dtype=batch["entities"].dtype)
             if t.start == 0:
                 ent_acs[:, 1:, :self.args.n_agents] = (
-                    batch["actions_onehot"][:, slice(0, t.stop - 1)])
+                    batch.get_timestep("actions_onehot", slice(0, t.stop - 1))[rows])
             else:
                 ent_acs[:, :, :self.args.n_agents] = (
-                    batch["actions_onehot"][:, slice(t.start - 1, t.stop - 1)])
+                    batch.get_timestep("actions_onehot", slice(t.start - 1, t.stop - 1))[rows])
             entities.append(ent_acs)
         entities = th.cat(entities, dim=3)
         if self.args.gt_mask_avail:
-            return (entities, batch["obs_mask"][:, t], batch["entity_mask"][:, t], batch["gt_mask"][:, t])
-        return (entities, batch["obs_mask"][:, t], batch["entity_mask"][:, t])
+            return (entities, batch["obs_mask"][rows, t], batch["entity_mask"][rows, t], batch["gt_mask"][rows, t])
+        return (entities, batch["obs_mask"][rows, t], batch["entity_mask"][rows, t])
+
+    def required_keys(self) -> set:
+        keys = {"entities", "obs_mask", "entity_mask", "avail_actions"}
+        if self.args.entity_last_action:
+            keys.add("actions_onehot")
+        if self.args.gt_mask_avail:
+            keys.add("gt_mask")
+        return keys
 
     def _get_input_shape(self, scheme):
         input_shape = scheme["entities"]["vshape"]
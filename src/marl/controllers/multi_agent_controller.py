@@ -44,12 +44,50 @@ class MultiAgentController:
     def select_actions(self, ep_batch: EpisodeBatch, t_ep: int, t_env: int, bs=slice(None), test_mode=False):
         raise NotImplementedError()
 
-    def forward(self, ep_batch: EpisodeBatch, t: int, test_mode=False):
+    def required_keys(self) -> set:
+        """
+        :return: batch keys read when building the inputs of the agents and selecting their outputs
+        """
+        keys = {"obs", "avail_actions"}
+        if self.args.obs_last_action:
+            keys.add("actions_onehot")
+        return keys
+
+    def forward(self, ep_batch: EpisodeBatch, t: int, test_mode=False, bs=slice(None)):
+        """
+        :param ep_batch:
+        :param t:
+        :param test_mode:
+        :param bs: batch entries to compute the outputs for - the hidden states of other entries are kept
+        :return: outputs of the agents of the entries bs
+        """
         raise NotImplementedError()
 
     def init_hidden(self, batch_size: int):
         raise NotImplementedError()
 
+    def reset_hidden(self, bs: list):
+        """
+        Reset the hidden states of single batch entries f.e. when the episode of an entry restarts while others go on.
+        :param bs: batch indices
+        :return:
+        """
+        raise NotImplementedError()
+
+    def get_hidden_states(self):
+        """
+        :return: current hidden states detached from the graph - to continue from them later via set_hidden_states()
+        """
+        raise NotImplementedError()
+
+    def set_hidden_states(self, hidden_states):
+        """
+        Continue from hidden states returned by get_hidden_states() f.e. after the MAC was unrolled on other batches.
+        :param hidden_states:
+        :return:
+        """
+        raise NotImplementedError()
+
     def parameters(self):
         raise NotImplementedError()
 
@@ -75,12 +113,12 @@ class MultiAgentController:
         for p in self.agent.parameters():
             p.requires_grad = False
 
-    def _softmax(self, agent_outs: Tensor, ep_batch: EpisodeBatch, t: int, test_mode: bool):
-        avail_actions = ep_batch["avail_actions"][:, t]
+    def _softmax(self, agent_outs: Tensor, ep_batch: EpisodeBatch, t: int, test_mode: bool, bs=slice(None)):
+        avail_actions = ep_batch["avail_actions"][bs, t]
 
         if getattr(self.args, "mask_before_softmax", True):
             # Make the logits for unavailable actions very negative to minimise their affect on the softmax
-            reshaped_avail_actions = avail_actions.reshape(ep_batch.batch_size * self.n_agents, -1)
+            reshaped_avail_actions = avail_actions.reshape(-1, avail_actions.shape[-1])
             agent_outs[reshaped_avail_actions == 0] = -1e10
         agent_outs = th.nn.functional.softmax(agent_outs, dim=-1)
         if not test_mode:
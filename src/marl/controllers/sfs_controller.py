@@ -30,17 +30,17 @@ class SFSController(MultiAgentController):
         ]
 
     def select_actions(self, ep_batch: EpisodeBatch, t_ep: int, t_env: int, bs=slice(None), test_mode=False):
-        avail_actions = ep_batch["avail_actions"][:, t_ep]
-        agent_outs = self.forward(ep_batch, t=t_ep, test_mode=test_mode)
-        chosen_actions, is_greedy = self.action_selector.select(agent_outs[bs], avail_actions[bs], t_env, test_mode)
+        avail_actions = ep_batch["avail_actions"][bs, t_ep]
+        agent_outs = self.forward(ep_batch, t=t_ep, test_mode=test_mode, bs=bs)
+        chosen_actions, is_greedy = self.action_selector.select(agent_outs, avail_actions, t_env, test_mode)
         return chosen_actions, is_greedy
 
-    def forward(self, ep_batch: EpisodeBatch, t: int, test_mode=False):
+    def forward(self, ep_batch: EpisodeBatch, t: int, test_mode=False, bs=slice(None)):
         if t == 0:  # Choose a random policy at each detected timestep reset to follow the whole episode
             self.policy_idx = th.randint(low=0, high=self.n_policies - 1, size=(1,))
 
-        agent_inputs = self._build_inputs(ep_batch, t)
-        agent_outs = self._compute_agent_outputs(agent_inputs, bs=ep_batch.batch_size)
+        agent_inputs = self._build_inputs(ep_batch, t, bs)
+        agent_outs = self._compute_agent_outputs(agent_inputs, bs=agent_inputs.shape[0] // self.n_agents)
         return agent_outs
 
     def _compute_agent_outputs(self, agent_inputs: Tensor, bs: int) -> Tensor:
@@ -52,14 +52,14 @@ class SFSController(MultiAgentController):
         sf_j_T = sfs_T[:, :, self.policy_idx, :].squeeze(2)
         return sf_j_T @ w_j
 
-    def _build_inputs(self, batch: EpisodeBatch, t: int) -> Tensor:
-        bs = batch.batch_size
-        inputs = [batch["obs"][:, t]]
+    def _build_inputs(self, batch: EpisodeBatch, t: int, rows=slice(None)) -> Tensor:
+        inputs = [batch["obs"][rows, t]]
+        bs = inputs[0].shape[0]
         if self.args.obs_last_action:
             if t == 0:
-                inputs.append(th.zeros_like(batch["actions_onehot"][:, t]))
+                inputs.append(th.zeros_like(batch.get_timestep("actions_onehot", t)[rows]))
             else:
-                inputs.append(batch["actions_onehot"][:, t - 1])
+                inputs.append(batch.get_timestep("actions_onehot", t - 1)[rows])
         if self.args.obs_agent_id:
             inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(bs, -1, -1))
 
@@ -81,6 +81,15 @@ class SFSController(MultiAgentController):
     def init_hidden(self, batch_size: int):
         pass
 
+    def reset_hidden(self, bs: list):
+        pass
+
+    def get_hidden_states(self):
+        return None
+
+    def set_hidden_states(self, hidden_states):
+        pass
+
     def parameters(self):
         return []  # No parameters here, these are handled in the PSFs
 
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+from torch.multiprocessing import Lock, Value
+
+from marl.controllers.basic_controller import BasicMAC
+from marl.controllers.entity_controller import EntityMAC
+from marl.controllers.multi_agent_controller import MultiAgentController
+
+# MACs whose weights are all held by their single agent network
+SHAREABLE_MACS = (BasicMAC, EntityMAC)
+
+
+class SharedPolicy:
+    def __init__(self, mac: MultiAgentController):
+        """
+        Agent network weights of a MAC in shared memory. The learner publishes its weights and the MACs acting with
+        them (f.e. of the rollout actors) load them once a newer version is published. Each publish increments the
+        version.
+        Only MACs with a single agent network are supported - the weights of ensembles or distinct agent networks would
+        not be shared.
+        :param mac: MAC whose agent network is shared
+        """
+        if type(mac) not in SHAREABLE_MACS:
+            raise NotImplementedError(f"Sharing the weights of a {type(mac).__name__} is not supported. Please use a "
+                                      f"MAC with a single agent network: {[m.__name__ for m in SHAREABLE_MACS]}")
+        self.weights = OrderedDict(
+            (k, v.detach().cpu().clone().share_memory_()) for k, v in mac.agent.state_dict().items()
+        )
+        self._version = Value("i", 0, lock=False)
+        self._t_env = Value("q", 0, lock=False)
+        self._lock = Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version.value
+
+    @property
+    def t_env(self) -> int:
+        return self._t_env.value
+
+    def publish(self, mac: MultiAgentController, t_env: int):
+        """
+        :param mac: MAC of the learner
+        :param t_env: environment steps taken until now - actors follow the exploration schedule at this step
+        :return:
+        """
+        with self._lock:
+            for k, v in mac.agent.state_dict().items():
+                self.weights[k].copy_(v)
+            self._version.value += 1
+            self._t_env.value = t_env
+
+    def pull(self, mac: MultiAgentController, version: int) -> int:
+        """
+        Load the published weights into the MAC if they are newer than the given version.
+        :param mac: MAC of an actor
+        :param version: version of the weights the MAC holds
+        :return: version of the weights the MAC holds afterwards
+        """
+        if self.version == version:
+            return version
+        with self._lock:
+            mac.load_state_dict(self.weights)
+            return self.version
@@ -46,6 +46,11 @@ class COMALearner(Learner):
         self.critic_optimiser = RMSprop(params=self.critic_params, lr=args.critic_lr, alpha=args.optim_alpha,
                                         eps=args.optim_eps)
 
+    def required_keys(self) -> set:
+        # The critic reads state, observations and joint actions
+        return {"reward", "actions", "terminated", "avail_actions", "state", "obs", "actions_onehot"} \
+            | self._mac_required_keys()
+
     def train(self, batch: EpisodeBatch, t_env: int, episode_num: int):
         # Get the relevant quantities
         rs = batch["reward"][:, :-1]
@@ -59,8 +64,11 @@ class COMALearner(Learner):
 
         mask = mask.repeat(1, 1, self.n_agents).view(-1)
 
+        is_weights = self._importance_weights(batch)
+
         # Q with counterfactual joint action u without action a per agent
-        q_vals, critic_train_stats = self._train_critic(batch, rs, terminated, actions, avail_actions, critic_mask)
+        q_vals, critic_train_stats, td_errors = self._train_critic(batch, rs, terminated, actions, avail_actions,
+                                                                   critic_mask, is_weights)
 
         actions = actions[:, :-1]
 
@@ -93,7 +101,11 @@ class COMALearner(Learner):
         advantages = (q_taken - baseline).detach()
 
         # COMA gradient
-        coma_loss = - ((log_pi_taken * advantages) * mask).sum() / mask.sum()
+        if is_weights is None:
+            coma_loss = - ((log_pi_taken * advantages) * mask).sum() / mask.sum()
+        else:  # Correct the bias introduced by prioritized sampling
+            weights = is_weights.expand(-1, batch.max_seq_length - 1, self.n_agents).reshape(-1)
+            coma_loss = - ((log_pi_taken * advantages) * weights * mask).sum() / mask.sum()
 
         # Optimise agents
         self.agent_optimiser.zero_grad()
@@ -118,7 +130,9 @@ class COMALearner(Learner):
                                  t_env)
             self.log_stats_t = t_env
 
-    def _train_critic(self, batch: EpisodeBatch, rewards, terminated, actions, avail_actions, mask):
+        return td_errors
+
+    def _train_critic(self, batch: EpisodeBatch, rewards, terminated, actions, avail_actions, mask, is_weights=None):
         target_q_vals = self.target_critic(batch)[:, :]  # Infer targets
         targets_taken = th.gather(target_q_vals, dim=3, index=actions).squeeze(3)  # targets of actions taken
 
@@ -134,6 +148,9 @@ class COMALearner(Learner):
         }
 
         q_vals = th.zeros_like(target_q_vals)[:, :-1]  # Construct Q values tensor to fill with upcoming loop
+        # Accumulate absolute TD-errors per episode to report them as replay priorities
+        td_error_abs = th.zeros(batch.batch_size, device=batch.device)
+        td_error_elems = th.zeros(batch.batch_size, device=batch.device)
 
         # Iterate over timesteps backwards but perform backward propagation of loss
         for t in reversed(range(batch.max_seq_length - 1)):
@@ -152,7 +169,12 @@ class COMALearner(Learner):
             masked_td_error = td_error * mask_t
 
             # Normal L2 loss, take mean over actual data
-            loss = (masked_td_error ** 2).sum() / mask_t.sum()
+            if is_weights is None:
+                loss = (masked_td_error ** 2).sum() / mask_t.sum()
+            else:  # Correct the bias introduced by prioritized sampling
+                loss = (is_weights.view(-1, 1) * masked_td_error ** 2).sum() / mask_t.sum()
+            td_error_abs += masked_td_error.detach().abs().sum(dim=1)
+            td_error_elems += mask_t.sum(dim=1)
             self.critic_optimiser.zero_grad()  # Clear x.grad for every parameter x in the optimizer
             loss.backward()  # Compute dloss/dx for every parameter x which has requires_grad=True
             grad_norm = th.nn.utils.clip_grad_norm_(self.critic_params, self.args.grad_norm_clip)
@@ -166,7 +188,7 @@ class COMALearner(Learner):
             running_log["q_taken_mean"].append((q_taken * mask_t).sum().item() / mask_elems)
             running_log["target_mean"].append((targets_t * mask_t).sum().item() / mask_elems)
 
-        return q_vals, running_log
+        return q_vals, running_log, td_error_abs / td_error_elems.clamp(min=1)
 
     def _update_targets(self):
         self.target_critic.load_state_dict(self.critic.state_dict())
@@ -1,9 +1,14 @@
+from typing import Optional
+
 from marl.components.episode_batch import EpisodeBatch
 from marl.controllers.multi_agent_controller import MultiAgentController
 from torch.optim import RMSprop
+import torch as th
 
 
 class Learner:
+    supports_sequences = False  # Whether the learner can train on sequences sampled from within episodes
+
     def __init__(self, mac: MultiAgentController, scheme, logger, args, name=None):
         """
         Learners update parameters and networks provided via the Multi-Agent Controller
@@ -36,17 +41,90 @@ class Learner:
         """
         raise NotImplementedError()
 
-    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int) -> None:
+    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int) -> th.Tensor:
         """
         Define training procedure based on a batch of episode data, the current timestep in the environment
         and the current episode number.
         :param batch:
         :param t_env:
         :param episode_num:
-        :return:
+        :return: per-episode TD-error magnitudes used as replay priorities
         """
         raise NotImplementedError()
 
+    def required_keys(self) -> Optional[set]:
+        """
+        Keys of the batch read during training. Replay buffers only gather these fields when sampling for the learner.
+        :return: set of keys or None if all fields are required
+        """
+        return None
+
+    def _mac_required_keys(self) -> set:
+        keys = self.mac.required_keys()
+        if "hidden_states" in self.scheme:  # Start of sequences sampled from within episodes
+            keys.add("hidden_states")
+        return keys
+
+    @staticmethod
+    def _importance_weights(batch: EpisodeBatch) -> Optional[th.Tensor]:
+        """
+        :param batch:
+        :return: per-episode importance-sampling weights (B,1,1) if the batch was sampled by priority, else None
+        """
+        if "is_weights" not in batch.data.episode_data:
+            return None
+        return batch["is_weights"].view(-1, 1, 1)
+
+    @staticmethod
+    def _init_hidden(mac: MultiAgentController, batch: EpisodeBatch):
+        """
+        Initialize the hidden state of a MAC for unrolling the batch. Sequences sampled from within episodes start from
+        the hidden state stored during the rollout.
+        :param mac:
+        :param batch:
+        :return:
+        """
+        mac.init_hidden(batch.batch_size)
+        if "burn_in" in batch.data.episode_data:
+            mac.hidden_states = batch["hidden_states"][:, 0]
+
+    @staticmethod
+    def _end_burn_in(mac: MultiAgentController, batch: EpisodeBatch, t: int):
+        """
+        Call after the forward pass of timestep t. Detaches the hidden state of all sequences whose burn-in ends with t,
+        so no gradients flow into their burn-in steps.
+        :param mac:
+        :param batch:
+        :param t:
+        :return:
+        """
+        if "burn_in" in batch.data.episode_data:
+            hidden_states = mac.hidden_states.reshape(batch.batch_size, mac.n_agents, -1)
+            burn_in_ends = (batch["burn_in"] == t + 1).view(-1, 1, 1)
+            mac.hidden_states = th.where(burn_in_ends, hidden_states.detach(), hidden_states)
+
+    @staticmethod
+    def _burn_in_mask(batch: EpisodeBatch, mask: th.Tensor) -> th.Tensor:
+        """
+        :param batch:
+        :param mask: mask of valid steps (B,T,1)
+        :return: mask without the burn-in steps of sequences sampled from within episodes
+        """
+        if "burn_in" not in batch.data.episode_data:
+            return mask
+        ts = th.arange(mask.shape[1], device=mask.device)
+        return mask * (ts.unsqueeze(0) >= batch["burn_in"].unsqueeze(1)).unsqueeze(2).to(mask.dtype)
+
+    @staticmethod
+    def _episode_td_errors(masked_td_error: th.Tensor, mask: th.Tensor) -> th.Tensor:
+        """
+        :param masked_td_error: TD-errors with padded steps set to 0 (B,T,...)
+        :param mask: mask of valid steps in the same shape
+        :return: mean absolute TD-error per episode (B,)
+        """
+        dims = tuple(range(1, masked_td_error.dim()))
+        return (masked_td_error.abs().sum(dim=dims) / mask.sum(dim=dims).clamp(min=1)).detach()
+
     def cuda(self) -> None:
         """
         Move all components to GPU.
@@ -9,6 +9,8 @@ from marl.components.episode_batch import EpisodeBatch
 
 
 class QLearner(Learner):
+    supports_sequences = True
+
     def __init__(self, mac: MultiAgentController, scheme, logger, args, name=None):
         super().__init__(mac, scheme, logger, args, name)
 
@@ -31,6 +33,12 @@ class QLearner(Learner):
         # Add additional mixer params for later optimization
         return list(self.mac.parameters()) + list(self.mixer.parameters()) if self.mixer is not None else []
 
+    def required_keys(self) -> set:
+        keys = {"reward", "actions", "terminated", "avail_actions"} | self._mac_required_keys()
+        if self.mixer is not None:
+            keys.add("state")
+        return keys
+
     def train(self, batch: EpisodeBatch, t_env: int, episode_num: int): # Default batch size = 32 episodes
         # Get the relevant batch quantities
         rewards = batch["reward"][:, :-1]
@@ -40,14 +48,16 @@ class QLearner(Learner):
         mask = batch["filled"][:, :-1].float()
 
         mask[:, 1:] = mask[:, 1:] * (1 - terminated[:, :-1])
+        mask = self._burn_in_mask(batch, mask)
         avail_actions = batch["avail_actions"]
 
         # Calculate estimated Q-Values
         mac_out = []
-        self.mac.init_hidden(batch.batch_size)
+        self._init_hidden(self.mac, batch)
         # Iterate over all timesteps defined by the max. in the batch
         for t in range(batch.max_seq_length):
             agent_outs = self.mac.forward(batch, t=t)
+            self._end_burn_in(self.mac, batch, t)
             mac_out.append(agent_outs)
         mac_out = th.stack(mac_out, dim=1)  # Concat over time
 
@@ -56,7 +66,7 @@ class QLearner(Learner):
 
         # Calculate the Q-Values necessary for the target
         target_mac_out = []
-        self.target_mac.init_hidden(batch.batch_size)
+        self._init_hidden(self.target_mac, batch)
         for t in range(batch.max_seq_length):
             target_agent_outs = self.target_mac.forward(batch, t=t)
             target_mac_out.append(target_agent_outs)
@@ -95,7 +105,11 @@ class QLearner(Learner):
         masked_td_error = td_error * mask
 
         # Normal L2 loss, take mean over actual data
-        loss = (masked_td_error ** 2).sum() / mask.sum()
+        is_weights = self._importance_weights(batch)
+        if is_weights is None:
+            loss = (masked_td_error ** 2).sum() / mask.sum()
+        else:  # Correct the bias introduced by prioritized sampling
+            loss = (is_weights * masked_td_error ** 2).sum() / mask.sum()
 
         # Optimise
         self.optimiser.zero_grad()
@@ -124,6 +138,8 @@ class QLearner(Learner):
                                  (targets * mask).sum().item() / (mask_elems * self.args.n_agents), t_env)
             self.log_stats_t = t_env
 
+        return self._episode_td_errors(masked_td_error, mask)
+
     def update_targets(self):
         self.target_mac.load_state(other_mac=self.mac)
         if self.mixer is not None:
@@ -20,7 +20,10 @@ class SFSLearner(Learner):
         self.gpe_gamma = 0.9  # Discount rate
         self.gpe_lr = 0.01  # Learning rate
 
-    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int) -> None:
+    def required_keys(self) -> set:
+        return {"features", "actions", "terminated", "avail_actions"} | self._mac_required_keys()
+
+    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int) -> th.Tensor:
         # Get the relevant batch quantities
         features = batch["features"][:, :-1]
         actions = batch["actions"][:, :-1]
@@ -30,6 +33,8 @@ class SFSLearner(Learner):
 
         mask[:, 1:] = mask[:, 1:] * (1 - terminated[:, :-1])
         avail_actions = batch["avail_actions"]
+        is_weights = self._importance_weights(batch)
+        td_errors = []
 
         for feature_idx, successor_feature in enumerate(self.mac.agent):  # Iterate over successor features
             mac_out = [self.mac.forward(batch, t=t) for t in range(batch.max_seq_length)]
@@ -52,11 +57,17 @@ class SFSLearner(Learner):
             masked_td_error = td_error * mask
 
             # Normal L2 loss, take mean over actual data
-            loss = (masked_td_error ** 2).sum() / mask.sum()
+            if is_weights is None:
+                loss = (masked_td_error ** 2).sum() / mask.sum()
+            else:  # Correct the bias introduced by prioritized sampling
+                loss = (is_weights * masked_td_error ** 2).sum() / mask.sum()
 
             successor_feature.optimizer.zero_grad()
             loss.backward()
             successor_feature.optimizer.step()
+            td_errors.append(self._episode_td_errors(masked_td_error, mask))
+
+        return th.stack(td_errors).mean(dim=0)  # Mean TD-error magnitude over all successor features
 
     def _build_sfs_inputs(self, batch: EpisodeBatch, t):
         return 1, 1, 1, 1
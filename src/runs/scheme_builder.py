@@ -23,10 +23,13 @@ class SchemeBuilder:
         if self.args.sfs:
             scheme.update({"features": {"vshape": (self.args.sfs_n_features,)}})
 
+        if self.args.sequence_length > 0:  # Hidden states of the rollout are replayed to start sequences within episodes
+            scheme.update({"hidden_states": {"vshape": (self.args.rnn_hidden_dim,), "group": "agents"}})
+
         groups = {
             "agents": self.args.n_agents
         }
         preprocess = {
-            "actions": ("actions_onehot", [OneHot(out_dim=self.args.n_actions)])
+            "actions": ("actions_onehot", [OneHot(out_dim=self.args.n_actions, lazy=True)])
         }
         return groups, preprocess, scheme
\ No newline at end of file
@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, List, Optional, Tuple
+
+import torch as th
+
+from marl.components.episode_batch import EpisodeBatch
+from marl.learners.learner import Learner
+from marl.controllers.shared_policy import SharedPolicy
+
+
+class _StatBuffer:
+    def __init__(self, logger):
+        """
+        Logger of a learner training on a background thread. Stats are buffered and only replayed into the logger on
+        the main thread, as it reports the stats while training. Everything else is passed to the logger.
+        :param logger: logger of the learner
+        """
+        self.logger = logger
+        self.stats: List[Tuple[str, Any, int, str]] = []
+
+    def log_stat(self, key, value, t_env, log_type="scalar"):
+        self.stats.append((key, value, t_env, log_type))
+
+    def replay(self):
+        stats, self.stats = self.stats, []
+        for stat in stats:
+            self.logger.log_stat(*stat)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
+class BackgroundTrainer:
+    def __init__(self, learner: Learner, policy: SharedPolicy):
+        """
+        Runs the training steps of a learner on a background thread, so the next rollout is collected while training.
+        The stepper acts with a snapshot MAC which loads the weights the trainer publishes after each training step -
+        the MAC of the learner is only accessed by the thread while a training step runs. Stats the learner logs are
+        passed to its logger once the step was waited for.
+        Only one training step runs at a time. The sample of a running step must stay valid until it finished.
+        :param learner:
+        :param policy: copy of the learner weights the snapshot MAC loads from
+        """
+        self.learner = learner
+        self.policy = policy
+        self._stats = _StatBuffer(learner.logger)
+        self.learner.logger = self._stats
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trainer")
+        self._running: Optional[Tuple[EpisodeBatch, Future]] = None
+
+    def submit(self, batch: EpisodeBatch, t_env: int, episode_num: int):
+        """
+        Start a training step on the batch. The previous step must have been waited for.
+        :param batch:
+        :param t_env:
+        :param episode_num:
+        :return:
+        """
+        assert self._running is None, "The previous training step did not finish."
+        self._running = (batch, self._executor.submit(self._train, batch, t_env, episode_num))
+
+    def _train(self, batch: EpisodeBatch, t_env: int, episode_num: int) -> th.Tensor:
+        td_errors = self.learner.train(batch, t_env, episode_num)
+        self.policy.publish(self.learner.mac, t_env)
+        return td_errors
+
+    def wait(self) -> Optional[Tuple[EpisodeBatch, th.Tensor]]:
+        """
+        Wait until the running training step finished. Errors raised while training are raised here.
+        :return: batch and TD errors of the finished step or None if no step ran
+        """
+        if self._running is None:
+            return None
+        batch, future = self._running
+        self._running = None
+        try:
+            return batch, future.result()
+        finally:
+            self._stats.replay()  # On the main thread, also the stats logged before an error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+            self.learner.logger = self._stats.logger
@@ -7,14 +7,14 @@ from runs.train.sp_ma_experiment import SelfPlayMultiAgentExperiment
 
 class EnsembleExperiment(SelfPlayMultiAgentExperiment):
 
-    def __init__(self, args, logger, on_episode_end=None, log_start_t=0):
+    def __init__(self, args, logger, on_episode_end=None, log_start_t=0, home_buffer=None):
         """
         LeaguePlay performs training of a single multi-agent and offers loading of new adversarial agents.
         :param args:
         :param logger:
         :param on_episode_end:
         """
-        super().__init__(args, logger, on_episode_end, log_start_t)
+        super().__init__(args, logger, on_episode_end, log_start_t, home_buffer)
         assert isinstance(self.home_mac, EnsembleMAC), 'Ensemble experiment enforces "mac"=ensemble in configuration'
         self.home_mac: EnsembleMAC = self.home_mac
 
@@ -5,17 +5,19 @@ from runs.train.sp_ma_experiment import SelfPlayMultiAgentExperiment
 
 class LeagueExperiment(SelfPlayMultiAgentExperiment):
 
-    def __init__(self, args, logger, on_episode_end=None,  log_start_t=0):
+    def __init__(self, args, logger, on_episode_end=None,  log_start_t=0, home_buffer=None):
         """
         LeaguePlay performs training of a single multi-agent and offers loading of new adversarial agents.
         :param args:
         :param logger:
         :param finish_callback:
         :param on_episode_end:
+        :param home_buffer: replay buffer of the previous league iteration
         """
-        super().__init__(args, logger, on_episode_end=on_episode_end, log_start_t=log_start_t)
+        super().__init__(args, logger, on_episode_end=on_episode_end, log_start_t=log_start_t,
+                         home_buffer=home_buffer)
 
-    def _test(self, n_test_runs):
+    def _test(self, n_test_episodes):
         self.last_test_T = self.stepper.t_env
         pass  # Skip tests in league to save computing time
 
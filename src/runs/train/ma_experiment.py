@@ -1,32 +1,44 @@
+import os
 import pprint
+import queue
 import time
 
 import torch as th
+from torch.multiprocessing import Event, Queue
 
-from league.components import Team
-from marl.components.replay_buffers import ReplayBuffer
+from custom_logging.collectibles import Collectibles
+from custom_logging.utils.enums import Originator
+from league.components import Team, PayoffEntry
+from marl.components.replay_buffers import ReplayBuffer, BatchPrefetcher, balanced
 from marl.controllers.multi_agent_controller import MultiAgentController
+from marl.controllers.shared_policy import SharedPolicy
 from marl.learners.learner import Learner
 from runs.experiment_run import ExperimentRun
+from runs.train.background_trainer import BackgroundTrainer
+from runs.train.rollout_actor import RolloutActor
 from steppers.episode_stepper import EnvStepper
 from utils.asset_manager import AssetManager
 from utils.timehelper import time_left, time_str
 
 from marl.learners import REGISTRY as learner_REGISTRY
+from marl.components.replay_buffers import REGISTRY as buffer_REGISTRY
 from marl.controllers import REGISTRY as mac_REGISTRY
 from marl.components.transforms import OneHot
+from marl.components.codecs import build_codec
 from steppers import REGISTRY as stepper_REGISTRY
 from marl.components.feature_functions import REGISTRY as feature_func_REGISTRY
 
 
 class MultiAgentExperiment(ExperimentRun):
 
-    def __init__(self, args, logger, on_episode_end=None, log_start_t=0):
+    def __init__(self, args, logger, on_episode_end=None, log_start_t=0, home_buffer: ReplayBuffer = None):
         """
         Performs the standard way of training a single multi-agent against a static scripted AI opponent for a fixed
         number of environment steps or a time limit.
         :param args:
         :param logger:
+        :param home_buffer: replay buffer of a previous experiment to continue with. A new buffer is built if its
+        scheme does not match.
         """
         super().__init__(args, logger)
         self.last_test_T = -self.args.test_interval - 1
@@ -37,8 +49,18 @@ class MultiAgentExperiment(ExperimentRun):
         self.last_time = self.start_time
         self.on_episode_end = on_episode_end
         self.home_mac: MultiAgentController = None
-        self.home_buffer: ReplayBuffer = None
+        self.home_buffer: ReplayBuffer = home_buffer
+        self.home_prefetcher: BatchPrefetcher = None
         self.home_learner: Learner = None
+        self.home_policy: SharedPolicy = None  # Weights published to the rollout actors or the actor MAC
+        self.actor_mac: MultiAgentController = None  # Snapshot of the home MAC the stepper acts with while training
+        self.actor_version = -1
+        self.home_trainer: BackgroundTrainer = None
+        self.actors = []
+        self.rollouts: Queue = None
+        self.stop_actors: Event = None
+        self.train_steps = 0
+        self.dropped_rollouts = 0
         self.asset_manager = AssetManager(args=self.args, logger=self.logger)
 
         if self.args.sfs:  # Use feature function instead of reward
@@ -71,20 +93,27 @@ class MultiAgentExperiment(ExperimentRun):
 
     def _build_learners(self):
         # Buffers
-        self.home_buffer = ReplayBuffer(
-            scheme=self.scheme,
-            groups=self.groups,
-            buffer_size=self.args.buffer_size,
-            max_seq_length=self.env_info["episode_limit"] + 1,
-            preprocess=self.preprocess,
-            device="cpu" if self.args.buffer_cpu_only else self.args.device
-        )
+        if self.home_buffer is not None and self.home_buffer.matches(self.scheme, self.groups):
+            self.logger.info("Continue with {}".format(self.home_buffer))
+        else:
+            self.home_buffer = self._build_buffer()
+            if self.args.buffer_load != "":  # Restore episodes of a saved buffer
+                self.home_buffer.load(self.args.buffer_load)
         # Setup multi-agent controller here
         self.home_mac = mac_REGISTRY[self.args.mac](
             scheme=self.home_buffer.scheme,
             groups=self.groups,
             args=self.args
         )
+        if self.args.train_in_background:  # The stepper acts with a snapshot of the weights while training
+            assert self.args.n_actors == 0, "Training in background is not supported with rollout actors."
+            self.actor_mac = mac_REGISTRY[self.args.mac](
+                scheme=self.home_buffer.scheme,
+                groups=self.groups,
+                args=self.args
+            )
+            # The sample of the running training step stays valid while the next one is drawn
+            self.home_buffer.staging_pool = max(self.home_buffer.staging_pool, 2)
         # Learners
         self.home_learner = learner_REGISTRY[self.args.learner](
             mac=self.home_mac,
@@ -93,8 +122,29 @@ class MultiAgentExperiment(ExperimentRun):
             args=self.args,
             name="home"
         )
+        assert self.args.sequence_length == 0 or self.home_learner.supports_sequences, \
+            "Learner {} does not support sequence sampling.".format(self.args.learner)
         # Register in list of learners
         self.learners.append(self.home_learner)
+        # Built after the learner as samples only gather the fields the learner reads
+        if self.args.prefetch_batches > 0:  # Assemble training batches in the background
+            self.home_prefetcher = BatchPrefetcher(self.home_buffer, self._sample, self._prepare_sample,
+                                                   batch_size=self.args.batch_size,
+                                                   queue_size=self.args.prefetch_batches,
+                                                   max_staleness=self.args.prefetch_max_staleness)
+
+    def _build_buffer(self) -> ReplayBuffer:
+        return buffer_REGISTRY[self.args.buffer](
+            scheme=self.scheme,
+            groups=self.groups,
+            buffer_size=self.args.buffer_size,
+            max_seq_length=self.env_info["episode_limit"] + 1,
+            preprocess=self.preprocess,
+            device="cpu" if self.args.buffer_cpu_only or self.args.buffer_storage == "memmap" else self.args.device,
+            storage=self.args.buffer_storage,
+            storage_dir=os.path.join(self.args.log_dir, "replay"),
+            **self.args.buffer_args
+        )
 
     def _build_schemes(self):
         scheme = {
@@ -109,11 +159,18 @@ class MultiAgentExperiment(ExperimentRun):
         if self.args.sfs:
             scheme.update({"features": {"vshape": (self.args.sfs_n_features,)}})
 
+        if self.args.sequence_length > 0:  # Hidden states of the rollout are replayed to start sequences within episodes
+            scheme.update({"hidden_states": {"vshape": (self.args.rnn_hidden_dim,), "group": "agents"}})
+
+        # Storage codecs are only applied within the replay buffer
+        for key, codec in self.args.buffer_codecs.items():
+            scheme.setdefault(key, {})["codec"] = build_codec(codec)
+
         groups = {
             "agents": self.args.n_agents
         }
         preprocess = {
-            "actions": ("actions_onehot", [OneHot(out_dim=self.args.n_actions)])
+            "actions": ("actions_onehot", [OneHot(out_dim=self.args.n_actions, lazy=True)])
         }
         return groups, preprocess, scheme
 
@@ -126,7 +183,7 @@ class MultiAgentExperiment(ExperimentRun):
                 scheme=self.scheme,
                 groups=self.groups,
                 preprocess=self.preprocess,
-                home_mac=self.home_mac
+                home_mac=self.actor_mac or self.home_mac
             )
 
     @property
@@ -170,80 +227,269 @@ class MultiAgentExperiment(ExperimentRun):
         self._start_time = time.time()
         self._end_time = time.time()
 
-        while self._has_not_reached_time_limit or self._has_not_reached_t_max:
-
-            # Run for a whole episode at a time
-            self._train_episode(episode_num=episode)
-
-            # Execute test runs once in a while
-            n_test_runs = max(1, self.args.test_nepisode // self.stepper.batch_size)
-            if (self.stepper.t_env - self.last_test_T) / self.args.test_interval >= 1.0:
-                self.logger.info("t_env: {} / {}".format(self.stepper.t_env, self.args.t_max))
-                self.logger.info("Estimated time left: {}. Time passed: {}".format(
-                    time_left(self.last_time, self.last_test_T, self.stepper.t_env, self.args.t_max),
-                    time_str(time.time() - self.start_time)))
-                self.last_time = time.time()
-                self._test(n_test_runs)
-
-            # Save model if configured
-            save_interval_reached = (self.stepper.t_env - self.model_save_time) >= self.args.save_model_interval
-            if self.args.save_model and (save_interval_reached or self.model_save_time == 0):
-                self.save_models()
-
-            # Update episode counter with number of episodes run in the batch
-            episode += self.args.batch_size_run
-
-            # Log metrics and learner stats once in a while
-            if (self.stepper.t_env - self.last_log_T) >= self.args.log_interval:
-                self.logger.log_stat("episode", episode, self.stepper.t_env)
-                self.logger.log_report()
-                self.last_log_T = self.stepper.t_env
-
-            self._end_time = time.time()
-
-        self.logger.log_stat("episode", episode, self.stepper.t_env)
-        self.logger.log_report()  # Final log
-        # Finish and clean up
-        self._finish()
+        try:
+            if self.args.n_actors > 0:  # Collect rollouts in the background while training
+                self._start_actors()
+            elif self.args.train_in_background:
+                self._start_background_training()
+
+            while self._has_not_reached_time_limit or self._has_not_reached_t_max:
+
+                # Run for a whole episode at a time
+                n_episodes = self._train_episode(episode_num=episode)
+
+                # Execute test runs once in a while
+                if (self.stepper.t_env - self.last_test_T) / self.args.test_interval >= 1.0:
+                    self.logger.info("t_env: {} / {}".format(self.stepper.t_env, self.args.t_max))
+                    self.logger.info("Estimated time left: {}. Time passed: {}".format(
+                        time_left(self.last_time, self.last_test_T, self.stepper.t_env, self.args.t_max),
+                        time_str(time.time() - self.start_time)))
+                    self.last_time = time.time()
+                    self._test(self.args.test_nepisode)
+
+                # Save model if configured
+                save_interval_reached = (self.stepper.t_env - self.model_save_time) >= self.args.save_model_interval
+                if self.args.save_model and (save_interval_reached or self.model_save_time == 0):
+                    self.save_models()
+
+                # Update episode counter with number of episodes run in the batch
+                episode += n_episodes
+
+                # Log metrics and learner stats once in a while
+                if (self.stepper.t_env - self.last_log_T) >= self.args.log_interval:
+                    self.logger.log_stat("episode", episode, self.stepper.t_env)
+                    self.logger.log_stat("buffer_padding_ratio", self.home_buffer.padding_ratio(), self.stepper.t_env)
+                    if self.home_prefetcher is not None:
+                        self.logger.log_stat("prefetch_queue_occupancy", self.home_prefetcher.occupancy(),
+                                             self.stepper.t_env)
+                    if self.actors:
+                        self.logger.log_stat("actor_dropped_rollouts", self.dropped_rollouts, self.stepper.t_env)
+                    self.logger.log_report()
+                    self.last_log_T = self.stepper.t_env
+
+                self._end_time = time.time()
+
+            self.logger.log_stat("episode", episode, self.stepper.t_env)
+            self.logger.log_report()  # Final log
+            # Finish and clean up
+            self._finish()
+        finally:
+            self._close_workers()  # Also if training failed - the rollout actors would otherwise keep the run alive
 
         return self.stepper.log_t
 
     def load_models(self, checkpoint_path=None):
         timestep_to_load = self.asset_manager.load_learner(learners=self.learners, load_step=self.args.load_step)
         self.stepper.t_env = timestep_to_load
+        if self.actor_mac is not None:
+            self.actor_mac.load_state(self.home_mac)
 
     def save_models(self, identifier=None):
+        self._finish_training_step()  # Save the weights after the running training step
         self.model_save_time = self.stepper.t_env
         out_path = self.asset_manager.save_learner(learners=self.learners, t=self.model_save_time, id=identifier)
         return out_path
 
     def _finish(self):
+        self._finish_training_step()
+        self._close_workers()
         self.stepper.close_env()
+        if self.args.buffer_save:
+            os.makedirs(self.args.log_dir, exist_ok=True)
+            self.home_buffer.save(os.path.join(self.args.log_dir, "replay_buffer.pt"))
         self.logger.info("Finished.")
 
-    def _train_episode(self, episode_num):
-        episode_batch, env_info = self.stepper.run(test_mode=False)
+    def _train_episode(self, episode_num) -> int:
+        """
+        Run episodes and train on a batch of the buffer.
+        :param episode_num: number of episodes run until now
+        :return: number of episodes run - the batch size of the stepper unless episodes are returned asynchronously
+        """
+        if self.home_trainer is not None:  # Act with the weights of the last finished training step
+            self.actor_version = self.home_policy.pull(self.actor_mac, self.actor_version)
+        if self.actors:
+            episode_batch, env_info = self._receive_rollout()
+        else:
+            episode_batch, env_info = self.stepper.run(test_mode=False)
         if self.on_episode_end is not None:
             self.on_episode_end(env_info)
 
-        self.home_buffer.insert_episode_batch(episode_batch)
-
-        if self.home_buffer.can_sample(self.args.batch_size):
-            episode_sample_batch = self.home_buffer.sample(self.args.batch_size)
-
-            # Truncate batch to only filled timesteps
-            max_ep_t = episode_sample_batch.max_t_filled()
-            episode_sample_batch = episode_sample_batch[:, :max_ep_t]
-
-            if episode_sample_batch.device != self.args.device:
-                episode_sample_batch.to(self.args.device)
+        self._insert_episode_batch(episode_batch, self._episode_index(env_info))
+        if not self.actors:
+            self.stepper.recycle(episode_batch)  # The buffer holds a copy
+
+        if self.home_trainer is not None:
+            # The training step started during this rollout finishes before the next one is started
+            self._finish_training_step()
+            if self.home_buffer.can_sample(self.args.batch_size):
+                self.home_trainer.submit(self._next_sample(), self.stepper.t_env, episode_num)
+        elif self.home_buffer.can_sample(self.args.batch_size):
+            episode_sample_batch = self._next_sample()
+            td_errors = self.home_learner.train(episode_sample_batch, self.stepper.t_env, episode_num)
+            self._update_priorities(episode_sample_batch, td_errors)
+            self.train_steps += 1
+            if self.actors and self.train_steps % self.args.actor_publish_interval == 0:
+                self.home_policy.publish(self.home_mac, self.stepper.t_env)
+        return episode_batch.batch_size
+
+    def _start_background_training(self):
+        """
+        Train on a background thread while the stepper collects the next rollout. The actor MAC loads the weights
+        published after each training step before a rollout, so it acts at most one training step behind.
+        :return:
+        """
+        self.actor_mac.load_state(self.home_mac)
+        self.home_policy = SharedPolicy(self.home_mac)
+        self.actor_version = self.home_policy.version
+        self.home_trainer = BackgroundTrainer(self.home_learner, self.home_policy)
+
+    def _finish_training_step(self):
+        if self.home_trainer is None:
+            return
+        finished = self.home_trainer.wait()
+        if finished is not None:
+            self._update_priorities(*finished)
+
+    def _start_actors(self):
+        """
+        Start the rollout actors. They act with the published weights of the home MAC, which are refreshed every
+        actor_publish_interval training steps.
+        :return:
+        """
+        self.home_policy = SharedPolicy(self.home_mac)
+        self.home_policy.publish(self.home_mac, self.stepper.t_env)
+        self.rollouts = Queue(maxsize=2 * self.args.n_actors)
+        self.stop_actors = Event()
+        self.actors = [
+            RolloutActor(idx, self.args, self.scheme, self.groups, self.preprocess, self.home_buffer.scheme,
+                         policy=self.home_policy, rollouts=self.rollouts, stop=self.stop_actors)
+            for idx in range(self.args.n_actors)
+        ]
+        for actor in self.actors:
+            actor.start()  # Not daemonic as actors start env workers themselves
+
+    def _close_workers(self):
+        """
+        Stop the rollout actors and close the background trainer and prefetcher. Can be called repeatedly.
+        :return:
+        """
+        self._stop_actors()
+        if self.home_prefetcher is not None:
+            self.home_prefetcher.close()
+            self.home_prefetcher = None
+        if self.home_trainer is not None:
+            trainer, self.home_trainer = self.home_trainer, None
+            trainer.close()
+
+    def _stop_actors(self):
+        if not self.actors:
+            return
+        self.stop_actors.set()
+        for actor in self.actors:
+            actor.join()
+        self.actors = []
+
+    def _receive_rollout(self):
+        """
+        Wait for the next rollout of the actors. Rollouts acted with weights which lag more than actor_max_policy_lag
+        publishes behind are dropped. Their env steps are counted nonetheless.
+        :return: batch and env info of the rollout
+        """
+        while True:
+            try:
+                version, env_steps, episode_batch, env_info = self.rollouts.get(timeout=1.)
+            except queue.Empty:
+                if not all(actor.is_alive() for actor in self.actors):
+                    raise RuntimeError("A rollout actor ended unexpectedly.")
+                continue
+            self.stepper.t_env += env_steps
+            if self.home_policy.version - version <= self.args.actor_max_policy_lag:
+                break
+            self.dropped_rollouts += 1
+
+        # Rollouts are logged here as the stats of the actors remain in their processes
+        env_infos = env_info if isinstance(env_info, list) else [env_info]
+        self.logger.test_mode = False
+        self.logger.collect(Collectibles.RETURN, episode_batch["reward"].sum(dim=(1, 2)).tolist(),
+                            origin=Originator.HOME, parallel=True)
+        self.logger.collect(Collectibles.WON, [info["battle_won"][0] for info in env_infos],
+                            origin=Originator.HOME, parallel=True)
+        self.logger.collect(Collectibles.WON, [info["battle_won"][1] for info in env_infos],
+                            origin=Originator.AWAY, parallel=True)
+        self.logger.collect(Collectibles.DRAW, [info["draw"] for info in env_infos], parallel=True)
+        self.logger.collect(Collectibles.STEPS, episode_batch["filled"].sum(dim=(1, 2)).tolist(), parallel=True)
+        self.logger.log(self.stepper.t_env)
+        return episode_batch, env_info
+
+    def _insert_episode_batch(self, episode_batch, index=None):
+        if self.home_prefetcher is not None:
+            self.home_prefetcher.insert_episode_batch(episode_batch, index)
+        else:
+            self.home_buffer.insert_episode_batch(episode_batch, index)
 
-            self.home_learner.train(episode_sample_batch, self.stepper.t_env, episode_num)
+    def _episode_index(self, env_info, team_id: int = None) -> dict:
+        """
+        :param env_info: info of the episode or list of infos per episode of a parallel run
+        :param team_id: team the episodes were recorded for, defaults to the policy team
+        :return: replay buffer index of the episodes holding their outcome and insertion time
+        """
+        env_infos = env_info if isinstance(env_info, list) else [env_info]
+        return {
+            "outcome": [self.episode_result(info, team_id) for info in env_infos],
+            "t_env": [self.stepper.t_env] * len(env_infos)
+        }
 
-    def _test(self, n_test_runs):
+    def episode_result(self, env_info: dict, team_id: int = None) -> PayoffEntry:
+        """
+        :param env_info: info of a terminated episode
+        :param team_id: team to view the result from, defaults to the policy team
+        :return: result of the episode from the view of the team
+        """
+        team_id = self.stepper.policy_team_id if team_id is None else team_id
+        battle_won = env_info["battle_won"]
+        if env_info["draw"] or all(battle_won) or not any(battle_won):
+            return PayoffEntry.DRAW  # Draw if all won or all lost
+        elif battle_won[team_id]:
+            return PayoffEntry.WIN
+        return PayoffEntry.LOSS
+
+    def _next_sample(self):
+        if self.home_prefetcher is not None:
+            return self.home_prefetcher.get()
+        return self._prepare_sample(self._sample(self.home_buffer))
+
+    def _update_priorities(self, batch, td_errors):
+        if self.home_prefetcher is not None:
+            self.home_prefetcher.update_priorities(batch, td_errors)
+        else:
+            self.home_buffer.update_priorities(batch, td_errors)
+
+    def _prepare_sample(self, batch):
+        # Truncate batch to only filled timesteps
+        max_ep_t = batch.max_t_filled()
+        batch = batch[:, :max_ep_t]
+
+        if batch.device != self.args.device:
+            batch.to(self.args.device)
+        return batch
+
+    def _sample(self, buffer, batch_size=None):
+        batch_size = self.args.batch_size if batch_size is None else batch_size
+        # Only gather the fields the learner reads
+        keys = self.home_learner.required_keys()
+        weights = balanced(self.args.buffer_balance) if self.args.buffer_balance != "" else None
+        if self.args.sequence_length > 0:
+            return buffer.sample_sequences(batch_size, self.args.sequence_length, burn_in=self.args.burn_in,
+                                           keys=keys, weights=weights)
+        return buffer.sample(batch_size, keys=keys, weights=weights)
+
+    def _test(self, n_test_episodes):
         self.last_test_T = self.stepper.t_env
-        for _ in range(n_test_runs):
-            self.stepper.run(test_mode=True)
+        n_episodes = 0
+        while n_episodes < n_test_episodes:  # Asynchronous steppers return a varying number of episodes per run
+            *batches, _ = self.stepper.run(test_mode=True)
+            n_episodes += batches[0].batch_size
+            self.stepper.recycle(*batches)
 
     def evaluate_sequential(self, test_n_episode=None, clean_up=False):
         n_episode = self.args.test_nepisode if test_n_episode is None else test_n_episode
@@ -0,0 +1,67 @@
+import copy
+import queue
+
+import torch as th
+from torch.multiprocessing import Process, Event, Queue
+
+from custom_logging.logger import MainLogger
+from custom_logging.platforms import CustomConsoleLogger
+from marl.controllers import REGISTRY as mac_REGISTRY
+from marl.controllers.shared_policy import SharedPolicy
+from steppers import REGISTRY as stepper_REGISTRY
+
+
+class RolloutActor(Process):
+    def __init__(self, idx: int, args, scheme, groups, preprocess, mac_scheme, policy: SharedPolicy,
+                 rollouts: Queue, stop: Event):
+        """
+        Process which steps its own stepper continuously and puts the rollouts into the queue, while the learner trains
+        in the main process. The actor acts with the weights published in the shared policy and loads newer weights
+        before each rollout. Rollouts are queued as (policy version, env steps, batch, env info).
+        The envs are built within the process once it runs, with the seed offset by the index of the actor.
+        :param idx: index of the actor
+        :param args:
+        :param scheme: scheme of the rollout batches
+        :param groups:
+        :param preprocess:
+        :param mac_scheme: scheme the MAC is built with
+        :param policy: weights published by the learner
+        :param rollouts: queue the rollouts are put into
+        :param stop: set to end the actor
+        """
+        super().__init__()
+        self.idx = idx
+        self.args = copy.copy(args)
+        self.args.seed = args.seed + idx + 1
+        self.args.env_args = {**args.env_args, "seed": self.args.seed}
+        self.scheme = scheme
+        self.groups = groups
+        self.preprocess = preprocess
+        self.mac_scheme = mac_scheme
+        self.policy = policy
+        self.rollouts = rollouts
+        self.stop = stop
+
+    def run(self) -> None:
+        th.manual_seed(self.args.seed)
+        logger = MainLogger(CustomConsoleLogger(f"actor-{self.idx}"), self.args)
+        mac = mac_REGISTRY[self.args.mac](scheme=self.mac_scheme, groups=self.groups, args=self.args)
+        stepper = stepper_REGISTRY[self.args.runner](args=self.args, logger=logger)
+        stepper.initialize(scheme=self.scheme, groups=self.groups, preprocess=self.preprocess, home_mac=mac)
+        version = -1
+
+        while not self.stop.is_set():
+            version = self.policy.pull(mac, version)
+            stepper.t_env = t_env = self.policy.t_env
+            with th.no_grad():
+                episode_batch, env_info = stepper.run(test_mode=False)
+            rollout = (version, stepper.t_env - t_env, episode_batch, env_info)
+            while not self.stop.is_set():
+                try:
+                    self.rollouts.put(rollout, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+        stepper.close_env()
+        self.rollouts.cancel_join_thread()  # Rollouts left in the queue are discarded
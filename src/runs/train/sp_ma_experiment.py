@@ -1,5 +1,7 @@
 from typing import OrderedDict
 
+from marl.components.episode_batch import concat_batches
+from marl.components.replay_buffers import ReplayBuffer, PrioritizedReplayBuffer
 from runs.train.ma_experiment import MultiAgentExperiment
 
 from marl.controllers import REGISTRY as mac_REGISTRY
@@ -11,7 +13,7 @@ from steppers.episode_stepper import EnvStepper
 
 class SelfPlayMultiAgentExperiment(MultiAgentExperiment):
 
-    def __init__(self, args, logger, on_episode_end=None, log_start_t=0):
+    def __init__(self, args, logger, on_episode_end=None, log_start_t=0, home_buffer=None):
         """
         Self-Play replaces the opposing agent previously controlled by a static scripted AI with another static policy
         controlled agent. This agent is fixed during the training to prevent non-stationarity in the environment.
@@ -19,11 +21,32 @@ class SelfPlayMultiAgentExperiment(MultiAgentExperiment):
         :param logger:
         :param finish_callback:
         :param episode_callback:
+        :param home_buffer:
         """
-        super().__init__(args, logger, on_episode_end=on_episode_end, log_start_t=log_start_t)
+        assert args.n_actors == 0, "Rollout actors do not support self-play."
+        assert not args.train_in_background, "Training in background does not support self-play."
+        self.away_buffer: ReplayBuffer = None  # Set before a prefetcher may start sampling
+        super().__init__(args, logger, on_episode_end=on_episode_end, log_start_t=log_start_t,
+                         home_buffer=home_buffer)
         # WARN: Assuming the away agent uses the same buffer scheme!!
         self.away_mac = mac_REGISTRY[self.args.mac](self.home_buffer.scheme, self.groups, self.args)
 
+        # With mirrored team builds the episodes of the away team are valid training data for the home team
+        plan = self.args.env_args["match_build_plan"]
+        self.train_on_away = self.args.away_experience and plan[0]["units"] == plan[1]["units"]
+        if self.args.away_experience and not self.train_on_away:
+            self.logger.info("Away episodes are not trained on since the team builds are not mirrored.")
+        assert not self.train_on_away or not self.args.sfs, "Away episodes do not record features."
+        # Sequences start from the stored hidden states, which the away MAC computed with the opponent's weights
+        assert not self.train_on_away or self.args.sequence_length == 0, \
+            "Away episodes record the hidden states of the away agents - sample them as whole episodes."
+        if self.train_on_away and self.args.away_buffer_ratio > 0:
+            assert not isinstance(self.home_buffer, PrioritizedReplayBuffer), \
+                "Mixing batches from a separate away buffer does not support prioritized replay."
+            away_buffer = self._build_buffer()
+            away_buffer.staging_pool = self.home_buffer.staging_pool
+            self.away_buffer = away_buffer
+
     def load_adversary(self, agent: OrderedDict):
         self.away_mac.load_state_dict(agent=agent)
         del agent
@@ -57,31 +80,44 @@ class SelfPlayMultiAgentExperiment(MultiAgentExperiment):
                                 home_mac=self.home_mac,
                                 away_mac=self.away_mac)
 
-    def _train_episode(self, episode_num, on_train_end=None):
+    def _train_episode(self, episode_num, on_train_end=None) -> int:
         # Run for a whole episode at a time
-        home_batch, _, env_info = self.stepper.run(test_mode=False)
+        home_batch, away_batch, env_info = self.stepper.run(test_mode=False)
         if self.on_episode_end is not None:
             self.on_episode_end(env_info)
 
-        self.home_buffer.insert_episode_batch(home_batch)
+        self._insert_episode_batch(home_batch, self._episode_index(env_info))
+        if self.train_on_away:
+            self._insert_away_batch(away_batch, env_info)
+        self.stepper.recycle(home_batch, away_batch)  # The buffers hold a copy
 
         # Sample batch from buffer if possible
         batch_size = self.args.batch_size
         if self.home_buffer.can_sample(batch_size):
-            home_sample = self.home_buffer.sample(batch_size)
-
-            # Truncate batch to only filled timesteps
-            max_ep_t_h = home_sample.max_t_filled()
-            home_sample = home_sample[:, :max_ep_t_h]
-
-            device = self.args.device
-            if home_sample.device != device:
-                home_sample.to(device)
+            home_sample = self._next_sample()
             # ! WARN ! Only train the learning agent not it`s sampled self-play adversary
-            self.home_learner.train(home_sample, self.stepper.t_env, episode_num)
+            td_errors = self.home_learner.train(home_sample, self.stepper.t_env, episode_num)
+            self._update_priorities(home_sample, td_errors)
 
             if on_train_end:
                 on_train_end(self.learners)
+        return home_batch.batch_size
+
+    def _insert_away_batch(self, away_batch, env_info):
+        index = self._episode_index(env_info, team_id=1 - self.stepper.policy_team_id)
+        if self.away_buffer is None:
+            self._insert_episode_batch(away_batch, index)
+        else:
+            with self.home_buffer.lock:  # A prefetcher samples both buffers while holding the lock of the home buffer
+                self.away_buffer.insert_episode_batch(away_batch, index)
+
+    def _sample(self, buffer, batch_size=None):
+        # Draw the configured share of the batch from the away buffer once it holds enough episodes
+        n_away = 0 if self.away_buffer is None else round(self.args.batch_size * self.args.away_buffer_ratio)
+        if batch_size is not None or n_away == 0 or not self.away_buffer.can_sample(n_away):
+            return super()._sample(buffer, batch_size)
+        return concat_batches([super()._sample(buffer, self.args.batch_size - n_away),
+                               super()._sample(self.away_buffer, n_away)])
 
     def evaluate_mean_returns(self, episode_n=1):
         self.logger.info("Evaluate for {} episodes.".format(episode_n))
@@ -1,4 +1,5 @@
 from .parallel_stepper import ParallelStepper
+from .async_parallel_stepper import AsyncParallelStepper
 from .episode_stepper import EpisodeStepper
 from .self_play_parallel_stepper import SelfPlayParallelStepper
 from .self_play_stepper import SelfPlayStepper
@@ -6,6 +7,7 @@ from .self_play_stepper import SelfPlayStepper
 REGISTRY = {}
 REGISTRY["episode"] = EpisodeStepper
 REGISTRY["parallel"] = ParallelStepper
+REGISTRY["async"] = AsyncParallelStepper
 
 SELF_REGISTRY = {}
 SELF_REGISTRY["episode"] = SelfPlayStepper
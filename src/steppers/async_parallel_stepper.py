@@ -0,0 +1,189 @@
+import copy
+from functools import partial
+
+from custom_logging.collectibles import Collectibles
+from custom_logging.utils.enums import Originator
+from marl.components.episode_batch import EpisodeBatch
+from steppers.parallel_stepper import ParallelStepper
+from steppers.utils.shared_step_data import PRE_TRANSITION_KEYS
+
+
+class AsyncParallelStepper(ParallelStepper):
+    def __init__(self, args, logger):
+        """
+        Parallel stepper which steps all environments continuously instead of waiting for the slowest episode of the
+        batch. Each env owns a row of the rollout batch and advances its own timestep in it. An env whose episode
+        terminated is reset right away while the others keep stepping and its hidden state row is reset in the MAC.
+        run() steps until at least one episode terminated and returns the terminated episodes, so they reach the buffer
+        as soon as they are finished.
+        Actions are selected on a frame batch of two timesteps per env holding the last actions and the current
+        observations. The hidden states of the running episodes are kept between runs, as the learner unrolls the
+        same MAC on its batches. Only supports a single policy team.
+        :param args:
+        :param logger:
+        """
+        super().__init__(args, logger)
+        self.new_frame_fn = None
+        self.frame = None  # Last actions (t=0) and current pre-transition data (t=1) of every env
+        self.ts = None  # Timestep of every env within its row of the rollout batch
+        self.episode_returns = None
+        self.hidden_states = None  # Hidden states of the running episodes in the MAC
+        self.test_mode = None  # Mode the running episodes were started in
+        self.completed = None  # Training episodes completed when switching to test mode - returned by the next train run
+
+    def initialize(self, scheme, groups, preprocess, home_mac, away_mac=None):
+        super().initialize(scheme, groups, preprocess, home_mac, away_mac)
+        # Derived fields of the frame are stored, so the last actions of restarted envs can be zeroed
+        self.new_frame_fn = partial(EpisodeBatch, scheme, groups, self.batch_size, 2,
+                                    preprocess=_eager(preprocess or {}), device=self.args.device)
+
+    def recycle(self, *batches: EpisodeBatch):
+        pass  # Returned episodes are copied out of the rollout batch which is kept
+
+    def reset(self):
+        # Restart the episodes of all envs
+        self.home_batch = self.new_batch_fn()
+        self.frame = self.new_frame_fn()
+        self.home_mac.init_hidden(batch_size=self.batch_size)
+        self.hidden_states = self.home_mac.get_hidden_states()
+        self.ts = [0] * self.batch_size
+        self.episode_returns = [0.] * self.batch_size
+        self._reset_envs()
+        envs = list(range(self.batch_size))
+        self._write_pre_transition_data(envs)
+        self.t = 0
+
+    def run(self, test_mode=False):
+        """
+        Step all environments until at least one episode terminated. When switching to test mode, the running training
+        episodes are completed first and returned by the next training run, as they are needed for the buffer. Running
+        test episodes are dropped when switching back to training - they would be stale by the next test.
+        :param test_mode:
+        :return: batch of the terminated episodes and their env infos
+        """
+        self.env_steps_this_run = 0
+        if self.frame is not None and test_mode != self.test_mode:
+            if test_mode:
+                self.completed = self._complete_episodes()
+            self.frame = None  # All envs are reset by the next run
+        self.logger.test_mode = test_mode
+
+        if not test_mode and self.completed is not None:
+            episodes, env_infos, episode_returns = self.completed
+            self.completed = None
+        else:
+            if self.frame is None:
+                self.reset()
+                self.test_mode = test_mode
+            self.home_mac.set_hidden_states(self.hidden_states)  # The learner unrolled the MAC since the last run
+
+            envs = list(range(self.batch_size))
+            done, infos = [], {}
+            while not done:
+                done, infos = self._step(envs)
+
+            episodes = self.home_batch[done]  # Copy before the rows are reused
+            env_infos = [infos[idx] for idx in done]
+            episode_returns = [self.episode_returns[idx] for idx in done]
+            self._restart(done)
+            self.hidden_states = self.home_mac.get_hidden_states()
+
+        self.t_env += self.env_steps_this_run
+        self.t = episodes.max_t_filled().item() - 1  # The timestep after the last step is filled as well
+
+        # Send data collected during the episodes - this data needs further processing
+        self.logger.collect(Collectibles.RETURN, episode_returns, origin=Originator.HOME, parallel=True)
+        self.logger.collect(Collectibles.WON, [env_info["battle_won"][0] for env_info in env_infos],
+                            origin=Originator.HOME, parallel=True)
+        self.logger.collect(Collectibles.WON, [env_info["battle_won"][1] for env_info in env_infos],
+                            origin=Originator.AWAY, parallel=True)
+        self.logger.collect(Collectibles.DRAW, [env_info["draw"] for env_info in env_infos], parallel=True)
+        self.logger.collect(Collectibles.STEPS, self.t, parallel=True)
+        # Log collectibles if conditions suffice
+        self.logger.log(self.t_env)
+
+        return episodes, env_infos
+
+    def _step(self, envs):
+        """
+        Select actions for the envs and take a step in each of them.
+        :param envs: ids of the envs with running episodes
+        :return: ids of the envs whose episode terminated and the infos of the stepped envs
+        """
+        # Select actions on the frame - all envs are at the second timestep of the frame
+        actions, is_greedy = self.home_mac.select_actions(self.frame, t_ep=1, t_env=self.t_env, bs=envs,
+                                                          test_mode=self.test_mode)
+        ts = [self.ts[idx] for idx in envs]
+        actions_chosen = {"actions": actions.unsqueeze(-1)}
+        if "hidden_states" in self.frame.data.transition_data:  # Stored by the MAC for sequence replay
+            actions_chosen["hidden_states"] = self.frame["hidden_states"][envs, 1]
+        self.home_batch.update_stacked(actions_chosen, bs=envs, ts=ts, mark_filled=False)
+        self.frame.update_stacked({"actions": actions_chosen["actions"]}, bs=envs, ts=0, mark_filled=False)
+
+        infos = self._step_envs(envs, actions)
+        if not self.test_mode:
+            self.env_steps_this_run += len(envs)
+
+        # Add post_transition data into the batch
+        rewards = self.step_data["reward"][envs, :1]  # ! Only supported if one policy team is playing
+        terminated = self.step_data["terminated"][envs].any(dim=1, keepdim=True)
+        self.home_batch.update_stacked({"reward": rewards, "terminated": terminated}, bs=envs, ts=ts,
+                                       mark_filled=False)
+
+        # Move each env onto its next timestep
+        for idx, reward in zip(envs, rewards.view(-1).tolist()):
+            self.episode_returns[idx] += reward
+            self.ts[idx] += 1
+        self._write_pre_transition_data(envs)
+        return [idx for idx, term in zip(envs, terminated.view(-1).tolist()) if term], infos
+
+    def _complete_episodes(self):
+        """
+        Step the running episodes until all terminated without restarting them.
+        :return: batch of the episodes, their env infos and returns
+        """
+        self.home_mac.set_hidden_states(self.hidden_states)
+        envs, env_infos = list(range(self.batch_size)), [None] * self.batch_size
+        while envs:
+            done, infos = self._step(envs)
+            for idx in done:
+                env_infos[idx] = infos[idx]
+            envs = [idx for idx in envs if idx not in done]
+        return self.home_batch, env_infos, self.episode_returns
+
+    def _restart(self, envs):
+        """
+        Reset envs with terminated episodes and start their next episode in their rows.
+        :param envs: ids of the envs
+        :return:
+        """
+        self._reset_envs(envs)
+        self.home_batch.clear(envs)
+        for v in self.frame.data.transition_data.values():  # No last actions at the first timestep
+            v[envs, 0] = 0
+        self.home_mac.reset_hidden(envs)
+        for idx in envs:
+            self.ts[idx] = 0
+            self.episode_returns[idx] = 0.
+        self._write_pre_transition_data(envs)
+
+    def _write_pre_transition_data(self, envs):
+        # Data needed to select the next actions - into the rows of the envs and the frame
+        pre_transition_data = {k: self.step_data[k][envs] for k in PRE_TRANSITION_KEYS}
+        self.home_batch.update_stacked(pre_transition_data, bs=envs, ts=[self.ts[idx] for idx in envs],
+                                       mark_filled=True)
+        self.frame.update_stacked(pre_transition_data, bs=envs, ts=1, mark_filled=True)
+
+
+def _eager(preprocess):
+    """
+    :param preprocess:
+    :return: copy of preprocess whose transforms are applied on every update instead of when the field is read
+    """
+    eager = {}
+    for k, (new_k, transforms) in preprocess.items():
+        transforms = [copy.copy(transform) for transform in transforms]
+        for transform in transforms:
+            transform.lazy = False
+        eager[k] = (new_k, transforms)
+    return eager
@@ -1,4 +1,7 @@
+from typing import List, Tuple
+
 from custom_logging.logger import MainLogger
+from marl.components.episode_batch import EpisodeBatch
 
 
 class EnvStepper:
@@ -14,6 +17,8 @@ class EnvStepper:
         self.t_env = None
         self.is_initalized = False
         self.log_start_t = None
+        self.new_batch_fn = None
+        self.batch_pool: List[Tuple[EpisodeBatch, ...]] = []  # Batches handed back for reuse in later episodes
 
     @property
     def log_t(self):
@@ -22,6 +27,30 @@ class EnvStepper:
     def run(self, test_mode=False):
         raise NotImplementedError()
 
+    def recycle(self, *batches: EpisodeBatch):
+        """
+        Hand the batches of a run back once their data was consumed (f.e. copied into the replay buffer). The batches
+        are reused for a later episode instead of allocating new ones, so they must not be used by the caller anymore.
+        :param batches: all batches returned by the same run
+        :return:
+        """
+        if len(self.batch_pool) < self.args.batch_pool_size:
+            self.batch_pool.append(batches)
+
+    def _reset_batches(self) -> Tuple[EpisodeBatch, ...]:
+        """
+        :return: batches for the next episode - batches handed back by recycle() if available
+        """
+        if not self.batch_pool:
+            return self._new_batches()
+        batches = self.batch_pool.pop()
+        for batch in batches:
+            batch.clear()  # Data of the last episode would remain in timesteps which are not filled again
+        return batches
+
+    def _new_batches(self) -> Tuple[EpisodeBatch, ...]:
+        return self.new_batch_fn(),
+
     def initialize(self, scheme, groups, preprocess, home_mac):
         raise NotImplementedError()
 
@@ -42,7 +42,6 @@ class EpisodeStepper(EnvStepper):
         self.phi: FeatureFunction = feature_func_REGISTRY[self.args.sfs] if self.args.sfs else None
         self.home_batch = None
         self.home_mac = None
-        self.new_batch_fn = None
 
     def initialize(self, scheme, groups, preprocess, home_mac, away_mac=None):
         self.new_batch_fn = partial(
@@ -67,7 +66,7 @@ class EpisodeStepper(EnvStepper):
         self.env.close()
 
     def reset(self):
-        self.home_batch = self.new_batch_fn()
+        self.home_batch, = self._reset_batches()
         self.env.reset()
         self.t = 0
 
@@ -1,5 +1,7 @@
-import torch
-from torch.multiprocessing.queue import Queue
+from multiprocessing.connection import wait
+
+import torch as th
+from torch.multiprocessing import Pipe
 
 from custom_logging.collectibles import Collectibles
 from custom_logging.utils.enums import Originator
@@ -7,7 +9,8 @@ from functools import partial
 from marl.components.episode_batch import EpisodeBatch
 from steppers.env_stepper import EnvStepper
 
-from steppers.utils.env_worker_process import EnvWorker
+from steppers.utils.env_worker_process import EnvWorker, EnvHost, InProcessConnection
+from steppers.utils.shared_step_data import new_shared_step_data, PRE_TRANSITION_KEYS
 from steppers.utils.stepper_utils import get_policy_team_id
 
 
@@ -28,20 +31,37 @@ class ParallelStepper(EnvStepper):
         teams = args.env_args["match_build_plan"]
         self.policy_team_id = get_policy_team_id(teams)
 
-        # Make subprocesses for the envs
-        self.in_queues, self.out_queues = zip(*[(Queue(), Queue()) for _ in range(self.batch_size)])
-        self.workers = [
-            EnvWorker(args, in_q=in_q, out_q=out_q)
-            for (in_q, out_q) in zip(self.in_queues, self.out_queues)
-        ]
+        # Make subprocesses for the envs - each hosts the envs of consecutive batch rows
+        self.envs_per_worker = self.args.envs_per_worker or self.batch_size
+        if self.args.envs_per_worker == 0:  # Step all envs in this process
+            self.parent_conns = [InProcessConnection(EnvHost(args, n_envs=self.batch_size))]
+            self.workers = []
+        else:
+            envs = range(0, self.batch_size, self.envs_per_worker)
+            self.parent_conns, worker_conns = zip(*[Pipe() for _ in envs])
+            self.workers = [
+                EnvWorker(args, remote=worker_conn, n_envs=min(self.envs_per_worker, self.batch_size - first_env))
+                for first_env, worker_conn in zip(envs, worker_conns)
+            ]
         for worker in self.workers:
             worker.daemon = True
             worker.start()
-
-        self.in_queues[0].put(("get_env_info", None))
-        self.env_info = self.out_queues[0].get()
+        # Workers build their envs concurrently - wait until all are ready
+        for parent_conn in self.parent_conns[:len(self.workers)]:
+            error = parent_conn.recv()
+            if error is not None:
+                raise RuntimeError("Env worker failed to build its environments.") from error
+
+        self.parent_conns[0].send(("get_env_info", None))
+        self.env_info = self.parent_conns[0].recv()
         self.episode_limit = self.env_info["episode_limit"]
 
+        # Actions and step results of all envs - each worker reads and writes the rows of its envs
+        self.step_data = new_shared_step_data(self.batch_size, self.env_info, n_teams=len(teams))
+        for worker_id, parent_conn in enumerate(self.parent_conns):
+            rows = slice(worker_id * self.envs_per_worker, (worker_id + 1) * self.envs_per_worker)
+            parent_conn.send(("attach", {k: v[rows] for k, v in self.step_data.items()}))
+
         self.t = 0
 
         self.t_env = 0
@@ -52,7 +72,6 @@ class ParallelStepper(EnvStepper):
         self.test_stats = {}
 
         self.log_train_stats_t = -100000
-        self.new_batch_fn = None
         self.scheme = None
         self.groups = None
         self.preprocess = None
@@ -76,29 +95,13 @@ class ParallelStepper(EnvStepper):
         pass
 
     def close_env(self):
-        for in_q in self.in_queues:
-            in_q.put(("close", None))
+        for parent_conn in self.parent_conns:
+            parent_conn.send(("close", None))
 
     def reset(self):
-        self.home_batch = self.new_batch_fn()
-
-        # Reset the envs
-        for in_q in self.in_queues:
-            in_q.put(("reset", None))
-
-        pre_transition_data = {
-            "state": [],
-            "avail_actions": [],
-            "obs": []
-        }
-        # Get the obs, state and avail_actions back
-        for out_q in self.out_queues:
-            data = out_q.get()
-            pre_transition_data["state"].append(data["state"])
-            pre_transition_data["avail_actions"].append(data["avail_actions"])
-            pre_transition_data["obs"].append(data["obs"])
-
-        self.home_batch.update(pre_transition_data, ts=0)
+        self.home_batch, = self._reset_batches()
+        self._reset_envs()
+        self.home_batch.update_stacked({k: self.step_data[k] for k in PRE_TRANSITION_KEYS}, ts=0)
 
         self.t = 0
         self.env_steps_this_run = 0
@@ -113,24 +116,21 @@ class ParallelStepper(EnvStepper):
 
         self.logger.test_mode = test_mode
 
-        all_terminated = False
-        episode_returns = [0 for _ in range(self.batch_size)]
-        eps = [0 for _ in range(self.batch_size)]
+        episode_returns = th.zeros(self.batch_size)
         self.home_mac.init_hidden(batch_size=self.batch_size)
-        # bools to determine finished envs
-        terminateds = [False for _ in range(self.batch_size)]
-        # IDs of running envs
-        running_envs = [idx for idx, terminated in enumerate(terminateds) if not terminated]
-        env_infos = []  # may store extra stats like battle won. this is filled in ORDER OF TERMINATION
-
-        actions_batch = torch.zeros((self.batch_size, self.env_info["n_agents"]))
+        # Mask of finished envs
+        terminated = th.zeros(self.batch_size, dtype=th.bool)
+        # IDs of the envs which select actions - includes envs which terminated in the last step to select the
+        # actions of their last timestep
+        acting_envs = th.arange(self.batch_size)
+        env_infos = [None] * self.batch_size  # may store extra stats like battle won. Ordered like the batch rows
 
         while True:
 
             # Pass the entire batch of experiences up till now to the agents
-            # Receive the actions for each agent at this timestep in a batch for each un-terminated env
+            # Receive the actions for each agent at this timestep in a batch for each acting env
             actions, is_greedy = self.home_mac.select_actions(self.home_batch, t_ep=self.t, t_env=self.t_env,
-                                                              bs=running_envs,
+                                                              bs=acting_envs.tolist(),
                                                               test_mode=test_mode)
 
             # Update the actions taken
@@ -138,72 +138,46 @@ class ParallelStepper(EnvStepper):
                 "actions": actions.unsqueeze(1)
             }
 
-            self.home_batch.update(actions_chosen, bs=running_envs, ts=self.t, mark_filled=False)
-
-            # Send actions to each running env
-            action_idx = 0
-            for idx, in_q in enumerate(self.in_queues):
-                if idx in running_envs:  # We produced actions for this env
-                    if not terminateds[idx]:  # Only send the actions to the env if it hasn't terminated
-                        actions_batch[action_idx] = actions[action_idx]
-                        in_q.put(("step", actions_batch[action_idx]))
-                    action_idx += 1  # actions is not a list over every env
+            self.home_batch.update(actions_chosen, bs=acting_envs.tolist(), ts=self.t, mark_filled=False)
 
             # Update running envs
-            running_envs = [idx for idx, terminated in enumerate(terminateds) if not terminated]
-            if all(terminateds):
+            running = ~terminated[acting_envs]
+            if not running.any():
                 break  # all envs terminated -> end parallel episode
-
-            post_transition_data = {  # Post step data we will insert for the current timestep
-                "reward": [],
-                "terminated": []
+            running_envs = acting_envs[running].tolist()
+
+            # Step each running env with its actions - written to its row of the shared step data
+            for idx, info in self._step_envs(running_envs, actions[running]).items():
+                if info is not None:  # env terminated -> attach additional episode infos
+                    env_infos[idx] = info
+
+            rewards = self.step_data["reward"][running_envs, :1]  # ! Only supported if one policy team is playing
+            terminated_envs = self.step_data["terminated"][running_envs].any(dim=1)  # if any team is done
+            episode_returns[running_envs] += rewards.view(-1)
+            terminated[running_envs] = terminated_envs
+            if not test_mode:
+                self.env_steps_this_run += len(running_envs)
+
+            # Add post_transition data of the current timestep into the batch
+            post_transition_data = {
+                "reward": rewards,
+                "terminated": terminated_envs.unsqueeze(1)
             }
-
-            pre_transition_data = {  # Data for the next step we will insert in order to select an action
-                "state": [],
-                "avail_actions": [],
-                "obs": []
-            }
-
-            for idx, out_q in enumerate(self.out_queues):  # Receive step data back for each unterminated env
-                if not terminateds[idx]:
-                    data = out_q.get()
-                    # Remaining data for this current timestep
-                    policy_team_reward = data["reward"][0]  # ! Only supported if one policy team is playing
-                    post_transition_data["reward"].append((policy_team_reward,))
-
-                    episode_returns[idx] += policy_team_reward
-                    eps[idx] += 1
-
-                    if not test_mode:
-                        self.env_steps_this_run += 1
-
-                    done_n = data["terminated"]  # list of done booleans per team
-                    terminated = any(done_n)
-                    if terminated:  # if any team is done -> env terminated -> attach additional episode infos
-                        env_infos.append(data["info"])
-                    terminateds[idx] = terminated
-                    post_transition_data["terminated"].append((terminated,))
-
-                    # Data for the next timestep needed to select an action
-                    pre_transition_data["state"].append(data["state"])
-                    pre_transition_data["avail_actions"].append(data["avail_actions"])
-                    pre_transition_data["obs"].append(data["obs"])
-
-            # Add post_transition data into the batch
-            self.home_batch.update(post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
+            self.home_batch.update_stacked(post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
 
             # Move onto the next timestep
             self.t += 1
 
-            # Add the pre-transition data
-            self.home_batch.update(pre_transition_data, bs=running_envs, ts=self.t, mark_filled=True)
+            # Add the pre-transition data needed to select the next actions
+            self.home_batch.update_stacked({k: self.step_data[k][running_envs] for k in PRE_TRANSITION_KEYS},
+                                           bs=running_envs, ts=self.t, mark_filled=True)
+            acting_envs = acting_envs[running]
 
         if not test_mode:
             self.t_env += self.env_steps_this_run
 
         # Send data collected during the episode - this data needs further processing
-        self.logger.collect(Collectibles.RETURN, episode_returns, origin=Originator.HOME, parallel=True)
+        self.logger.collect(Collectibles.RETURN, episode_returns.tolist(), origin=Originator.HOME, parallel=True)
         self.logger.collect(Collectibles.WON, [env_info["battle_won"][0] for env_info in env_infos],
                             origin=Originator.HOME, parallel=True)
         self.logger.collect(Collectibles.WON, [env_info["battle_won"][1] for env_info in env_infos],
@@ -215,6 +189,59 @@ class ParallelStepper(EnvStepper):
 
         return self.home_batch, env_infos
 
+    def _reset_envs(self, envs=None):
+        """
+        Reset the envs and wait until they wrote their obs, state and avail_actions.
+        :param envs: ids of the envs to reset - all if None
+        :return:
+        """
+        if envs is None:
+            worker_envs = {worker_id: None for worker_id in range(len(self.parent_conns))}
+        else:
+            worker_envs = {worker_id: [idx % self.envs_per_worker for idx in idxs]
+                           for worker_id, idxs in self._group_by_worker(envs).items()}
+        for worker_id, local_idxs in worker_envs.items():
+            self.parent_conns[worker_id].send(("reset", local_idxs))
+        for _ in self._replies(worker_envs):
+            pass
+
+    def _step_envs(self, envs, actions):
+        """
+        Write the actions into the shared rows of the envs and step them. Each worker is requested once to step all of
+        its envs and returns their infos in one message.
+        :param envs: ids of the envs to step
+        :param actions: actions with one row per env in envs
+        :return: info per stepped env - None unless the episode terminated
+        """
+        self.step_data["actions"][envs] = actions.to(device="cpu", dtype=self.step_data["actions"].dtype)
+        worker_envs = self._group_by_worker(envs)
+        for worker_id, idxs in worker_envs.items():
+            self.parent_conns[worker_id].send(("step", [idx % self.envs_per_worker for idx in idxs]))
+        infos = {}
+        for idxs, reply in self._replies(worker_envs):
+            infos.update(zip(idxs, reply))
+        return infos
+
+    def _replies(self, worker_envs):
+        """
+        Receive the replies of workers in the order they arrive, so a slow worker does not hold up handling the others.
+        :param worker_envs: env ids per id of a worker whose reply is awaited
+        :return: env ids of the worker and its reply per reply
+        """
+        pending = {self.parent_conns[worker_id]: idxs for worker_id, idxs in worker_envs.items()}
+        while pending:
+            # The in-process connection has its replies ready
+            ready = wait(list(pending)) if self.workers else list(pending)
+            for parent_conn in ready:
+                yield pending.pop(parent_conn), parent_conn.recv()
+
+    def _group_by_worker(self, envs):
+        # Env ids per id of the worker hosting them
+        worker_envs = {}
+        for idx in envs:
+            worker_envs.setdefault(idx // self.envs_per_worker, []).append(idx)
+        return worker_envs
+
     def __del__(self):
         # Close env workers
         self.close_env()
@@ -1,13 +1,11 @@
 from functools import partial
 
-import torch
-
 from marl.components.episode_batch import EpisodeBatch
 
 from steppers import ParallelStepper
 import torch as th
 
-from steppers.utils.stepper_utils import append_pre_transition_data
+from steppers.utils.stepper_utils import new_self_play_batches, split_pre_transition_data
 from custom_logging.logger import Originator
 
 
@@ -40,33 +38,16 @@ class SelfPlayParallelStepper(ParallelStepper):
     def save_replay(self):
         pass
 
+    def _new_batches(self):
+        return new_self_play_batches(self.new_batch_fn)
+
     def reset(self):
-        self.home_batch = self.new_batch_fn()
-        self.away_batch = self.new_batch_fn()
-
-        # Reset the envs
-        for parent_conn in self.in_queues:
-            parent_conn.send(("reset", None))
-
-        # Pre transition data
-        home_ptd = {
-            "state": [],
-            "avail_actions": [],
-            "obs": []
-        }
-        away_ptd = {
-            "state": [],
-            "avail_actions": [],
-            "obs": []
-        }
-
-        # Get the obs, state and avail_actions back
-        for parent_conn in self.in_queues:
-            data = parent_conn.recv()
-            append_pre_transition_data(away_ptd, home_ptd, data)
-
-        self.home_batch.update(home_ptd, ts=0)
-        self.away_batch.update(away_ptd, ts=0)
+        self.home_batch, self.away_batch = self._reset_batches()
+        self._reset_envs()
+
+        home_ptd, away_ptd = split_pre_transition_data(self.step_data, slice(None))
+        self.home_batch.update_stacked(home_ptd, ts=0)
+        self.away_batch.update_stacked(away_ptd, ts=0, mark_filled=False)
         self.t = 0
         self.env_steps_this_run = 0
 
@@ -82,27 +63,25 @@ class SelfPlayParallelStepper(ParallelStepper):
         self.logger.test_n_episode = self.args.test_nepisode
         self.logger.runner_log_interval = self.args.runner_log_interval
 
-        all_terminated = False
-        home_episode_returns = [0 for _ in range(self.batch_size)]
-        away_episode_returns = [0 for _ in range(self.batch_size)]
-        ep_lens = [0 for _ in range(self.batch_size)]
+        episode_returns = th.zeros((self.batch_size, 2))  # Returns of the home and away team
+        ep_lens = th.zeros(self.batch_size, dtype=th.long)
 
         self.home_mac.init_hidden(batch_size=self.batch_size)
         self.away_mac.init_hidden(batch_size=self.batch_size)
 
-        terminateds = [False for _ in range(self.batch_size)]
-        running_envs = [idx for idx, terminated in enumerate(terminateds) if not terminated]
-        env_infos = []  # may store extra stats like battle won. this is filled in ORDER OF TERMINATION
-
-        self.actions = torch.zeros((self.batch_size, self.args.n_agents * 2)) # TODO Assumes two teams of equal size
+        terminated = th.zeros(self.batch_size, dtype=th.bool)  # Mask of finished envs
+        # Envs which select actions - includes envs which terminated in the last step for their last timestep
+        acting_envs = th.arange(self.batch_size)
+        env_infos = [None] * self.batch_size  # may store extra stats like battle won. Ordered like the batch rows
 
         while True:
 
             # Pass the entire batch of experiences up till now to the agents
-            # Receive the actions for each agent at this timestep in a batch for each un-terminateds env
-            home_actions, h_is_greedy = self.home_mac.select_actions(self.home_batch, t_ep=self.t, t_env=self.t_env, bs=running_envs,
+            # Receive the actions for each agent at this timestep in a batch for each acting env
+            bs = acting_envs.tolist()
+            home_actions, h_is_greedy = self.home_mac.select_actions(self.home_batch, t_ep=self.t, t_env=self.t_env, bs=bs,
                                                         test_mode=test_mode)
-            away_actions, a_is_greedy = self.away_mac.select_actions(self.away_batch, t_ep=self.t, t_env=self.t_env, bs=running_envs,
+            away_actions, a_is_greedy = self.away_mac.select_actions(self.away_batch, t_ep=self.t, t_env=self.t_env, bs=bs,
                                                         test_mode=test_mode)
 
             actions = th.cat((home_actions, away_actions), dim=1)
@@ -114,88 +93,58 @@ class SelfPlayParallelStepper(ParallelStepper):
             away_actions_chosen = {
                 "actions": away_actions.unsqueeze(1)
             }
-            self.home_batch.update(home_actions_chosen, bs=running_envs, ts=self.t, mark_filled=False)
-            self.away_batch.update(away_actions_chosen, bs=running_envs, ts=self.t, mark_filled=False)
-
-            # Send actions to each env
-            action_idx = 0
-            for idx, in_q in enumerate(self.in_queues):
-                if idx in running_envs:  # We produced actions for this env
-                    if not terminateds[idx]:  # Only send the actions to the env if it hasn't terminateds
-                        self.actions[action_idx] = actions[action_idx]
-                        in_q.put(("step", self.actions[action_idx]))
-                    action_idx += 1  # actions is not a list over every env
+            self.home_batch.update(home_actions_chosen, bs=bs, ts=self.t, mark_filled=False)
+            self.away_batch.update(away_actions_chosen, bs=bs, ts=self.t, mark_filled=False)
 
             # Update running_envs
-            running_envs = [idx for idx, terminated in enumerate(terminateds) if not terminated]
-            all_terminated = all(terminateds)
-            if all_terminated:
+            running = ~terminated[acting_envs]
+            if not running.any():
                 break
+            running_envs = acting_envs[running].tolist()
+
+            # Step each running env with its actions - written to its row of the shared step data
+            for idx, info in self._step_envs(running_envs, actions[running]).items():
+                if info is not None:  # env terminated
+                    env_infos[idx] = info
+
+            rewards = self.step_data["reward"][running_envs]
+            terminated_envs = self.step_data["terminated"][running_envs].any(dim=1)  # if any team is done
+            episode_returns[running_envs] += rewards
+            ep_lens[running_envs] += 1
+            terminated[running_envs] = terminated_envs
+            if not test_mode:
+                self.env_steps_this_run += len(running_envs)
 
             # Post step data we will insert for the current timestep
             home_post_transition_data = {
-                "reward": [],
-                "terminated": []
+                "reward": rewards[:, :1],
+                "terminated": terminated_envs.unsqueeze(1)
             }
             away_post_transition_data = {
-                "reward": [],
-                "terminated": []
-            }
-            # Data for the next step we will insert in order to select an action
-            home_pre_transition_data = {
-                "state": [],
-                "avail_actions": [],
-                "obs": []
-            }
-            away_pre_transition_data = {
-                "state": [],
-                "avail_actions": [],
-                "obs": []
+                "reward": rewards[:, 1:]
             }
-            # Receive data back for each unterminated env
-            for idx, out_q in enumerate(self.out_queues):
-                if not terminateds[idx]:
-                    data = out_q.get()
-                    home_reward, away_reward = data["reward"]
-                    # Remaining data for this current timestep
-                    home_post_transition_data["reward"].append((home_reward,))
-                    away_post_transition_data["reward"].append((away_reward,))
-
-                    home_episode_returns[idx] += home_reward
-                    away_episode_returns[idx] += away_reward
-                    ep_lens[idx] += 1
-
-                    if not test_mode:
-                        self.env_steps_this_run += 1
-
-                    done_n = data["terminated"]  # list of done booleans per team
-                    terminated = any(done_n)
-                    if terminated:  # if any team is done -> env terminated
-                        env_infos.append(data["info"])
-                    terminateds[idx] = terminated
-                    home_post_transition_data["terminated"].append((terminated,))
-                    away_post_transition_data["terminated"].append((terminated,))
-
-                    # Data for the next timestep needed to select an action
-                    append_pre_transition_data(away_pre_transition_data, home_pre_transition_data, data)
 
             # Add post_transiton data into the batch
-            self.home_batch.update(home_post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
-            self.away_batch.update(away_post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
+            self.home_batch.update_stacked(home_post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
+            self.away_batch.update_stacked(away_post_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
 
             # Move onto the next timestep
             self.t += 1
 
-            # Add the pre-transition data
-            self.home_batch.update(home_pre_transition_data, bs=running_envs, ts=self.t, mark_filled=True)
-            self.away_batch.update(away_pre_transition_data, bs=running_envs, ts=self.t, mark_filled=True)
+            # Add the pre-transition data needed to select the next actions
+            home_pre_transition_data, away_pre_transition_data = split_pre_transition_data(self.step_data,
+                                                                                           running_envs)
+            self.home_batch.update_stacked(home_pre_transition_data, bs=running_envs, ts=self.t, mark_filled=True)
+            self.away_batch.update_stacked(away_pre_transition_data, bs=running_envs, ts=self.t, mark_filled=False)
+            acting_envs = acting_envs[running]
 
         if not test_mode:
             self.t_env += self.env_steps_this_run
 
-        self.logger.collect_episode_returns(home_episode_returns, parallel=True)
-        self.logger.collect_episode_returns(away_episode_returns, org=Originator.AWAY, parallel=True)
-        self.logger.collect_episode_stats(env_infos, self.t, parallel=True, batch_size=self.batch_size, ep_lens=ep_lens)
+        self.logger.collect_episode_returns(episode_returns[:, 0].tolist(), parallel=True)
+        self.logger.collect_episode_returns(episode_returns[:, 1].tolist(), org=Originator.AWAY, parallel=True)
+        self.logger.collect_episode_stats(env_infos, self.t, parallel=True, batch_size=self.batch_size,
+                                          ep_lens=ep_lens.tolist())
         self.logger.add_stats(self.t_env, epsilons=self.epsilons)
 
         return self.home_batch, self.away_batch, env_infos
@@ -3,7 +3,7 @@ import torch as th
 from custom_logging.collectibles import Collectibles
 from steppers import EpisodeStepper
 from custom_logging.logger import Originator
-from steppers.utils.stepper_utils import build_pre_transition_data
+from steppers.utils.stepper_utils import build_pre_transition_data, new_self_play_batches
 
 
 class SelfPlayStepper(EpisodeStepper):
@@ -38,8 +38,12 @@ class SelfPlayStepper(EpisodeStepper):
         raise NotImplementedError()
 
     def reset(self):
-        super().reset()
-        self.away_batch = self.new_batch_fn()
+        self.home_batch, self.away_batch = self._reset_batches()
+        self.env.reset()
+        self.t = 0
+
+    def _new_batches(self):
+        return new_self_play_batches(self.new_batch_fn)
 
     def run(self, test_mode=False):
         """
@@ -67,7 +71,7 @@ class SelfPlayStepper(EpisodeStepper):
             home_pre_transition_data, away_pre_transition_data = build_pre_transition_data(self.env)
 
             self.home_batch.update(home_pre_transition_data, ts=self.t)
-            self.away_batch.update(away_pre_transition_data, ts=self.t)
+            self.away_batch.update(away_pre_transition_data, ts=self.t, mark_filled=False)
 
             home_actions, h_is_greedy = self.home_mac.select_actions(self.home_batch, t_ep=self.t, t_env=self.t_env,
                                                                      test_mode=test_mode)
@@ -94,19 +98,18 @@ class SelfPlayStepper(EpisodeStepper):
             }
             away_post_transition_data = {
                 "actions": away_actions,
-                "reward": [(away_reward,)],
-                "terminated": [(terminated,)]
+                "reward": [(away_reward,)]
             }
 
             self.home_batch.update(home_post_transition_data, ts=self.t)
-            self.away_batch.update(away_post_transition_data, ts=self.t)
+            self.away_batch.update(away_post_transition_data, ts=self.t, mark_filled=False)
 
             self.t += 1
 
         home_last_data, away_last_data = build_pre_transition_data(self.env)
 
         self.home_batch.update(home_last_data, ts=self.t)
-        self.away_batch.update(away_last_data, ts=self.t)
+        self.away_batch.update(away_last_data, ts=self.t, mark_filled=False)
 
         # Select actions in the last stored state
         home_actions, h_is_greedy = self.home_mac.select_actions(self.home_batch, t_ep=self.t, t_env=self.t_env,
@@ -115,7 +118,7 @@ class SelfPlayStepper(EpisodeStepper):
 
         away_actions, a_is_greedy = self.away_mac.select_actions(self.away_batch, t_ep=self.t, t_env=self.t_env,
                                                                  test_mode=test_mode)
-        self.away_batch.update({"actions": away_actions}, ts=self.t)
+        self.away_batch.update({"actions": away_actions}, ts=self.t, mark_filled=False)
 
         home_actions_taken.append(th.stack([home_actions, h_is_greedy]))
         away_actions_taken.append(th.stack([away_actions, a_is_greedy]))
@@ -1,71 +1,134 @@
+from collections import deque
+from multiprocessing.connection import Connection
 from types import SimpleNamespace
 
 from torch.multiprocessing import Process
-from torch.multiprocessing.queue import Queue
 
 from envs import REGISTRY as env_REGISTRY
 
+# Commands which are answered - the others are only executed
+REPLYING_COMMANDS = ("step", "reset", "get_env_info")
 
-class EnvWorker(Process):
-    def __init__(self, args: SimpleNamespace, in_q: Queue, out_q: Queue):
+
+class EnvHost:
+    def __init__(self, args: SimpleNamespace, n_envs: int):
         """
-        Interacts with environment if requested and communicates results back to parent connection.
-        :param remote:
-        :param env:
+        Hosts a number of environments and steps them on request. Step data is exchanged through rows of the step
+        data tensors (see new_shared_step_data) which are attached before the first reset - one row per hosted env.
+        After a reset or step only the infos of terminated episodes are returned.
+        :param args:
+        :param n_envs: number of hosted environments
         """
-        super().__init__()
         self.args = args
-        self.in_q = in_q
-        self.out_q = out_q
         #assert self._is_consistent_env(), "Environments are not consistent."
-        self.env = env_REGISTRY[self.args.env](**self.args.env_args)
-        self.terminated_env = False
+        self.envs = [env_REGISTRY[self.args.env](**self.args.env_args) for _ in range(n_envs)]
+        self.terminated_envs = [False] * n_envs
+        self.actions = None  # Rows of the actions - read on every step
+        self.step_data = None  # NumPy views of the rows the step results are written to
 
     def _is_consistent_env(self):
         return self.args.env_args["stochastic_spawns"] is False
 
+    def handle(self, cmd, data):
+        """
+        :param cmd: command
+        :param data: data of the command
+        :return: reply to the command
+        """
+        if cmd == "step":
+            # Take a step in each requested environment
+            return [self._step(idx) for idx in data]
+        elif cmd == "reset":
+            # Reset the requested or all environments
+            for idx in range(len(self.envs)) if data is None else data:
+                self.envs[idx].reset()
+                self.terminated_envs[idx] = False
+                self._write_pre_transition_data(idx, self.envs[idx].get_obs())
+        elif cmd == "attach":
+            self.actions = data.pop("actions")
+            self.step_data = {k: v.numpy() for k, v in data.items()}
+        elif cmd == "close":
+            self.terminated_envs = [True] * len(self.envs)
+            for env in self.envs:
+                env.close()
+        elif cmd == "get_env_info":
+            return self.envs[0].get_env_info()
+        else:
+            raise NotImplementedError(f"Unknown message received in environment worker: {cmd}")
+
+    def _step(self, idx):
+        """
+        :param idx: index of the hosted env
+        :return: info of the episode if it terminated else None
+        """
+        if self.terminated_envs[idx]:
+            raise Exception("Worker can not step a terminated environment.")
+        obs, reward, done_n, env_info = self.envs[idx].step(self.actions[idx])
+        if any(done_n):
+            self.terminated_envs[idx] = True
+        # Write the observations, avail_actions and state to make the next action
+        self._write_pre_transition_data(idx, obs)
+        # Rest of the data for the current timestep
+        self.step_data["reward"][idx] = reward
+        self.step_data["terminated"][idx] = done_n
+        return env_info if self.terminated_envs[idx] else None
+
+    def _write_pre_transition_data(self, idx, obs):
+        # Data for the next timestep needed to pick an action
+        self.step_data["state"][idx] = self.envs[idx].get_state()
+        self.step_data["avail_actions"][idx] = self.envs[idx].get_avail_actions()
+        self.step_data["obs"][idx] = obs
+
+
+class EnvWorker(Process):
+    def __init__(self, args: SimpleNamespace, remote: Connection, n_envs: int = 1):
+        """
+        Process hosting environments (see EnvHost) which handles the commands of the parent connection.
+        The environments are built within the process once it runs, so only the args are passed to the child. When
+        they are built the worker sends None to signal that it is ready or the exception raised while building them.
+        :param args:
+        :param remote: worker end of the pipe to the stepper
+        :param n_envs: number of hosted environments
+        """
+        super().__init__()
+        self.args = args
+        self.remote = remote
+        self.n_envs = n_envs
+        self.host = None
+
     def run(self) -> None:
-        # Make environment
+        try:
+            self.host = EnvHost(self.args, self.n_envs)
+        except Exception as e:
+            self.remote.send(e)
+            raise
+        self.remote.send(None)  # Ready
+
         # Handle incoming commands from the remote connection within another process
         while True:
-            cmd, data = self.in_q.get()
-            if cmd == "step":
-                if self.terminated_env:
-                    raise Exception("Worker can not step a terminated environment.")
-                actions = data
-                # Take a step in the environment
-                obs, reward, done_n, env_info = self.env.step(actions)
-                if any(done_n):
-                    self.terminated_env = True
-                # Return the observations, avail_actions and state to make the next action
-                state = self.env.get_state()
-                avail_actions = self.env.get_avail_actions()
-                self.out_q.put({
-                    # Data for the next timestep needed to pick an action
-                    "state": state,
-                    "avail_actions": avail_actions,
-                    "obs": obs,
-                    # Rest of the data for the current timestep
-                    "reward": reward,
-                    "terminated": done_n,
-                    "info": env_info
-                })
-                del actions
-            elif cmd == "reset":
-                self.env.reset()
-                self.terminated_env = False
-                self.out_q.put({
-                    "state": self.env.get_state(),
-                    "avail_actions": self.env.get_avail_actions(),
-                    "obs": self.env.get_obs()
-                })
+            cmd, data = self.remote.recv()
+            reply = self.host.handle(cmd, data)
+            if cmd in REPLYING_COMMANDS:
+                self.remote.send(reply)
             elif cmd == "close":
-                self.terminated_env = True
-                self.env.close()
-                self.out_q.close()
-                self.in_q.close()
+                self.remote.close()
                 break
-            elif cmd == "get_env_info":
-                self.out_q.put(self.env.get_env_info())
-            else:
-                raise NotImplementedError(f"Unknown message received in environment worker: {cmd}")
+
+
+class InProcessConnection:
+    def __init__(self, host: EnvHost):
+        """
+        Stands in for the pipe to an EnvWorker but handles the commands with the host in the calling process.
+        :param host:
+        """
+        self.host = host
+        self.replies = deque()
+
+    def send(self, obj):
+        cmd, data = obj
+        reply = self.host.handle(cmd, data)
+        if cmd in REPLYING_COMMANDS:
+            self.replies.append(reply)
+
+    def recv(self):
+        return self.replies.popleft()
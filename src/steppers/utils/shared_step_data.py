@@ -0,0 +1,27 @@
+from typing import Dict
+
+import torch as th
+
+# Fields written by the env workers after a reset or step which are needed to select the next actions
+PRE_TRANSITION_KEYS = ("state", "avail_actions", "obs")
+
+
+def new_shared_step_data(n_envs: int, env_info: dict, n_teams: int) -> Dict[str, th.Tensor]:
+    """
+    Allocate the step data of all env workers in shared memory. Each worker reads its actions from and writes the
+    results of its steps into its own row, so only the info of terminated episodes is pickled between processes.
+    :param n_envs: number of env workers
+    :param env_info: info of the env
+    :param n_teams: number of teams in the env - rewards and terminations are reported per team
+    :return: tensor per field with one row per env worker
+    """
+    n_agents = env_info["n_agents"]
+    step_data = {
+        "actions": th.zeros((n_envs, n_agents)),
+        "state": th.zeros((n_envs, env_info["state_shape"])),
+        "avail_actions": th.zeros((n_envs, n_agents, env_info["n_actions"]), dtype=th.int),
+        "obs": th.zeros((n_envs, n_agents, env_info["obs_shape"])),
+        "reward": th.zeros((n_envs, n_teams)),
+        "terminated": th.zeros((n_envs, n_teams), dtype=th.bool),
+    }
+    return {k: v.share_memory_() for k, v in step_data.items()}
@@ -1,5 +1,18 @@
 from typing import List
 
+# Fields which are equal for both teams of a self-play episode. The away batch shares them with the home batch, so
+# they are only written to the home batch.
+SHARED_KEYS = ("state", "terminated", "filled")
+
+
+def new_self_play_batches(new_batch_fn):
+    """
+    :param new_batch_fn: builds an episode batch
+    :return: home and away batch of a self-play episode, where the away batch shares the common fields of the home batch
+    """
+    home_batch = new_batch_fn()
+    return home_batch, new_batch_fn(shared=home_batch.shared_fields(SHARED_KEYS))
+
 
 def build_pre_transition_data(env):
     state = env.get_state()
@@ -18,31 +31,29 @@ def build_pre_transition_data(env):
     opponent_avail_actions = avail_actions[n_avail_actions // 2:]
     opponent_obs = obs[len(obs) // 2:]
     opponent_pre_transition_data = {
-        "state": [state],
         "avail_actions": [opponent_avail_actions],
         "obs": [opponent_obs]
     }
     return home_pre_transition_data, opponent_pre_transition_data
 
 
-def append_pre_transition_data(away_pre_transition_data, home_pre_transition_data, data):
-    state = data["state"]
-    avail_actions = data["avail_actions"]
-    obs = data["obs"]
-    n_avail_actions = len(avail_actions)
-    assert n_avail_actions % 2 == 0, f"{n_avail_actions} avail_actions do not fit in the symmetric two-team scenario."
+def split_pre_transition_data(step_data, envs):
+    """
+    Split the pre-transition data of envs in which both teams are controlled by policies.
+    :param step_data: shared step data of the env workers (see new_shared_step_data)
+    :param envs: ids of the envs to take the data from
+    :return: pre-transition data of the home and the away team stacked over the envs
+    """
+    n_agents = step_data["obs"].shape[1]
+    assert n_agents % 2 == 0, f"{n_agents} agents do not fit in the symmetric two-team scenario."
 
-    home_avail_actions = avail_actions[:n_avail_actions // 2]
-    home_obs = obs[:len(obs) // 2]
-    home_pre_transition_data["state"].append(state)
-    home_pre_transition_data["avail_actions"].append(home_avail_actions)
-    home_pre_transition_data["obs"].append(home_obs)
-
-    away_avail_actions = avail_actions[n_avail_actions // 2:]
-    away_obs = obs[len(obs) // 2:]
-    away_pre_transition_data["state"].append(state)
-    away_pre_transition_data["avail_actions"].append(away_avail_actions)
-    away_pre_transition_data["obs"].append(away_obs)
+    home_pre_transition_data = {"state": step_data["state"][envs]}
+    away_pre_transition_data = {}
+    for key in ("avail_actions", "obs"):
+        rows = step_data[key][envs]
+        home_pre_transition_data[key] = rows[:, :n_agents // 2]
+        away_pre_transition_data[key] = rows[:, n_agents // 2:]
+    return home_pre_transition_data, away_pre_transition_data
 
 
 def get_policy_team_id(teams: List):
@@ -0,0 +1,151 @@
+import itertools
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.transforms import OneHot
+from marl.controllers.basic_controller import BasicMAC
+
+try:
+    import envs
+    from steppers.async_parallel_stepper import AsyncParallelStepper
+except ImportError as e:  # Envs and loggers depend on the multi-agent env package
+    raise unittest.SkipTest(f"Steppers can not be imported: {e}")
+
+N_AGENTS = 2
+N_ACTIONS = 3
+OBS_SHAPE = 4
+BATCH_SIZE_RUN = 3
+EPISODE_LIMIT = 6
+
+
+class CountingEnv:
+    lengths = itertools.cycle([2, 5, 3, 4])
+
+    def __init__(self, **kwargs):
+        """
+        Env whose episodes last a fixed but varying number of steps and whose observations count the steps taken.
+        """
+        self.t = 0
+        self.length = None
+
+    def reset(self):
+        self.t = 0
+        self.length = next(CountingEnv.lengths)
+
+    def step(self, actions):
+        self.t += 1
+        done = self.t >= self.length
+        return self.get_obs(), [1., 0.], [done, False], {"battle_won": [True, False], "draw": False}
+
+    def get_obs(self):
+        return [np.full(OBS_SHAPE, self.t + agent, dtype=np.float32) for agent in range(N_AGENTS)]
+
+    def get_state(self):
+        return np.full(3, self.t, dtype=np.float32)
+
+    def get_avail_actions(self):
+        return [[1] * N_ACTIONS for _ in range(N_AGENTS)]
+
+    def get_env_info(self):
+        return {"n_agents": N_AGENTS, "n_actions": N_ACTIONS, "obs_shape": OBS_SHAPE, "state_shape": 3,
+                "episode_limit": EPISODE_LIMIT}
+
+    def close(self):
+        pass
+
+
+class Logger:
+    test_mode = False
+
+    def collect(self, *args, **kwargs):
+        pass
+
+    def log(self, t_env):
+        pass
+
+
+class AsyncParallelStepperTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        envs.REGISTRY["counting"] = CountingEnv
+        self.args = SimpleNamespace(n_agents=N_AGENTS, n_actions=N_ACTIONS, agent="rnn", rnn_hidden_dim=8,
+                                    agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=1.,
+                                    epsilon_finish=.05, epsilon_anneal_time=10, freeze_native=False,
+                                    obs_last_action=True, obs_agent_id=True, device="cpu", batch_size_run=BATCH_SIZE_RUN,
+                                    envs_per_worker=0, batch_pool_size=1, env="counting",
+                                    env_args={"match_build_plan": [{"is_scripted": False}, {"is_scripted": True}]})
+        self.scheme = {
+            "state": {"vshape": 3},
+            "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+            "reward": {"vshape": (1,)},
+            "terminated": {"vshape": (1,), "dtype": th.uint8},
+            "hidden_states": {"vshape": (8,), "group": "agents"},
+        }
+        self.groups = {"agents": N_AGENTS}
+        self.preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+        mac_scheme = EpisodeBatch(self.scheme, self.groups, 1, 1, preprocess=self.preprocess).scheme
+        self.mac = BasicMAC(mac_scheme, self.groups, self.args)
+        self.stepper = AsyncParallelStepper(self.args, Logger())
+        self.stepper.initialize(self.scheme, self.groups, self.preprocess, self.mac)
+
+    def tearDown(self) -> None:
+        self.stepper.close_env()
+        del envs.REGISTRY["counting"]
+
+    def _assert_continued(self, episodes: EpisodeBatch):
+        # Hidden states stored for each step must match unrolling the episode from its start
+        with th.no_grad():
+            self.mac.init_hidden(episodes.batch_size)
+            for t in range(episodes.max_seq_length):
+                hidden_states = self.mac.hidden_states.reshape(episodes.batch_size, N_AGENTS, -1)
+                self.mac.forward(episodes, t)
+                for row in range(episodes.batch_size):
+                    if episodes["filled"][row, t] and t < episodes["filled"][row].sum() - 1:
+                        self.assertTrue(th.allclose(hidden_states[row], episodes["hidden_states"][row, t], atol=1e-6))
+
+    def test_running_episodes_continue_across_training(self):
+        other = EpisodeBatch(self.scheme, self.groups, 5, EPISODE_LIMIT + 1, preprocess=self.preprocess)
+        n_episodes = 0
+        while n_episodes < 8:
+            with th.no_grad():
+                episodes, env_infos = self.stepper.run(test_mode=False)
+                # The learner unrolls the same MAC on its batches between runs
+                self.mac.init_hidden(other.batch_size)
+                self.mac.forward(other, 0)
+            self.assertEqual(episodes.batch_size, len(env_infos))
+            self.assertTrue(episodes["terminated"].any(dim=1).all())
+            self._assert_continued(episodes)
+            n_episodes += episodes.batch_size
+
+    def test_mode_switch_returns_running_episodes(self):
+        with th.no_grad():
+            self.stepper.run(test_mode=False)
+            t_env = self.stepper.t_env
+            self.stepper.run(test_mode=True)
+            # Training episodes running at the switch were completed - including the restarted ones
+            self.assertGreater(self.stepper.t_env, t_env)
+            episodes, _ = self.stepper.run(test_mode=False)
+        self.assertEqual(BATCH_SIZE_RUN, episodes.batch_size)
+        self.assertTrue(episodes["terminated"].any(dim=1).all())
+        self._assert_continued(episodes)
+
+    def test_mode_switch_drops_running_test_episodes(self):
+        with th.no_grad():
+            self.stepper.run(test_mode=True)
+            self.stepper.run(test_mode=False)
+            episodes, _ = self.stepper.run(test_mode=True)
+        # All envs were reset for the new test - only the shortest of their distinct episode lengths terminated
+        self.assertEqual(1, episodes.batch_size)
+        self.assertTrue(th.equal(episodes["state"][0, 0], th.zeros(3)))
+        self._assert_continued(episodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
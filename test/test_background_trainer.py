@@ -0,0 +1,94 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.transforms import OneHot
+from marl.controllers import BasicMAC
+from marl.controllers.shared_policy import SharedPolicy
+from runs.train.background_trainer import BackgroundTrainer
+
+N_AGENTS = 2
+N_ACTIONS = 3
+
+
+class Logger:
+
+    def __init__(self):
+        self.stats = []
+
+    def log_stat(self, key, value, t_env, log_type="scalar"):
+        self.stats.append((key, value, t_env, threading.current_thread()))
+
+
+class Learner:
+
+    def __init__(self, mac, logger, error=None):
+        """
+        Learner which logs a stat and returns the TD errors of a training step or raises the given error.
+        """
+        self.mac = mac
+        self.logger = logger
+        self.error = error
+        self.trained = threading.Event()
+
+    def train(self, batch, t_env, episode_num):
+        self.logger.log_stat("loss", 1., t_env)
+        self.trained.set()
+        if self.error is not None:
+            raise self.error
+        return th.ones(batch.batch_size)
+
+
+class BackgroundTrainerTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        args = SimpleNamespace(n_agents=N_AGENTS, n_actions=N_ACTIONS, agent="rnn", rnn_hidden_dim=8,
+                               agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=1.,
+                               epsilon_finish=.05, epsilon_anneal_time=10, freeze_native=False, obs_last_action=True,
+                               obs_agent_id=True, device="cpu")
+        scheme = {
+            "obs": {"vshape": 4, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+        }
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+        self.batch = EpisodeBatch(scheme, {"agents": N_AGENTS}, 3, 2, preprocess=preprocess)
+        self.mac = BasicMAC(self.batch.scheme, {"agents": N_AGENTS}, args)
+        self.policy = SharedPolicy(self.mac)
+        self.logger = Logger()
+
+    def test_wait_returns_training_step_and_logs_stats_on_main_thread(self):
+        learner = Learner(self.mac, self.logger)
+        trainer = BackgroundTrainer(learner, self.policy)
+        self.assertIsNone(trainer.wait())
+
+        trainer.submit(self.batch, t_env=5, episode_num=1)
+        learner.trained.wait()
+        self.assertEqual([], self.logger.stats)  # Held back until waited for
+        batch, td_errors = trainer.wait()
+        trainer.close()
+
+        self.assertIs(self.batch, batch)
+        self.assertTrue(th.equal(th.ones(3), td_errors))
+        self.assertEqual([("loss", 1., 5, threading.main_thread())], self.logger.stats)
+        self.assertEqual(1, self.policy.version)
+        self.assertIs(self.logger, learner.logger)
+
+    def test_wait_raises_errors_of_training_step(self):
+        learner = Learner(self.mac, self.logger, error=ValueError("train"))
+        trainer = BackgroundTrainer(learner, self.policy)
+        trainer.submit(self.batch, t_env=5, episode_num=1)
+
+        with self.assertRaises(ValueError):
+            trainer.wait()
+        trainer.close()
+        self.assertEqual(1, len(self.logger.stats))
+        self.assertEqual(0, self.policy.version)
+
+
+if __name__ == '__main__':
+    unittest.main()
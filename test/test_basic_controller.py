@@ -0,0 +1,82 @@
+import unittest
+from types import SimpleNamespace
+
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.transforms import OneHot
+from marl.controllers.basic_controller import BasicMAC
+
+N_AGENTS = 2
+N_ACTIONS = 3
+OBS_SHAPE = 4
+BATCH_SIZE = 3
+MAX_SEQ_LENGTH = 4
+
+
+class BasicMACTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        self.args = SimpleNamespace(n_agents=N_AGENTS, n_actions=N_ACTIONS, agent="rnn", rnn_hidden_dim=8,
+                                    agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=1.,
+                                    epsilon_finish=.05, epsilon_anneal_time=10, freeze_native=False,
+                                    obs_last_action=True, obs_agent_id=True, device="cpu")
+        scheme = {
+            "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+        }
+        groups = {"agents": N_AGENTS}
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+        self.batch = EpisodeBatch(scheme, groups, BATCH_SIZE, MAX_SEQ_LENGTH, preprocess=preprocess)
+        for t in range(MAX_SEQ_LENGTH):
+            self.batch.update({
+                "obs": th.rand(BATCH_SIZE, N_AGENTS, OBS_SHAPE),
+                "actions": th.randint(N_ACTIONS, (BATCH_SIZE, N_AGENTS, 1)),
+                "avail_actions": th.ones(BATCH_SIZE, N_AGENTS, N_ACTIONS, dtype=th.int),
+            }, ts=t)
+        self.mac = BasicMAC(self.batch.scheme, groups, self.args)
+
+    def test_forward_of_rows_matches_full_batch(self):
+        with th.no_grad():
+            self.mac.init_hidden(BATCH_SIZE)
+            full = [self.mac.forward(self.batch, t) for t in range(MAX_SEQ_LENGTH)]
+            full_hidden_states = self.mac.hidden_states.view(BATCH_SIZE, N_AGENTS, -1)
+
+            # The second entry only takes part in the first timestep
+            self.mac.init_hidden(BATCH_SIZE)
+            self.mac.forward(self.batch, 0)
+            hidden_states = self.mac.hidden_states.view(BATCH_SIZE, N_AGENTS, -1)[1].clone()
+            for t in range(1, MAX_SEQ_LENGTH):
+                agent_outs = self.mac.forward(self.batch, t, bs=[0, 2])
+                self.assertEqual((2, N_AGENTS, N_ACTIONS), agent_outs.shape)
+                self.assertTrue(th.allclose(full[t][[0, 2]], agent_outs, atol=1e-6))
+            compacted_hidden_states = self.mac.hidden_states.view(BATCH_SIZE, N_AGENTS, -1)
+
+        self.assertTrue(th.allclose(full_hidden_states[[0, 2]], compacted_hidden_states[[0, 2]], atol=1e-6))
+        self.assertTrue(th.equal(hidden_states, compacted_hidden_states[1]))  # Hidden state of skipped entries is kept
+
+    def test_select_actions_returns_selected_rows(self):
+        with th.no_grad():
+            self.mac.init_hidden(BATCH_SIZE)
+            greedy_actions = self.mac.forward(self.batch, 0)[2:].max(dim=2)[1]
+            self.mac.init_hidden(BATCH_SIZE)
+            actions, _ = self.mac.select_actions(self.batch, t_ep=0, t_env=0, bs=[2], test_mode=True)
+        self.assertEqual((1, N_AGENTS), actions.shape)
+        self.assertTrue(th.equal(greedy_actions, actions))
+
+    def test_set_hidden_states_continues_after_other_batch(self):
+        with th.no_grad():
+            self.mac.init_hidden(BATCH_SIZE)
+            full = [self.mac.forward(self.batch, t) for t in range(MAX_SEQ_LENGTH)]
+
+            self.mac.init_hidden(BATCH_SIZE)
+            self.mac.forward(self.batch, 0)
+            hidden_states = self.mac.get_hidden_states()
+            # Unroll the MAC on a batch of another size in between, as the learner does
+            self.mac.init_hidden(BATCH_SIZE + 1)
+            self.mac.forward(self.batch[[0, 1, 2, 0]], 0)
+            self.mac.set_hidden_states(hidden_states)
+            agent_outs = self.mac.forward(self.batch, 1)
+        self.assertTrue(th.allclose(full[1], agent_outs, atol=1e-6))
@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from marl.components.replay_buffers.prioritized_replay_buffer import BinarySumTree
+
+
+class BinarySumTreeTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        np.random.seed(0)
+        self.tree = BinarySumTree(capacity=5)
+
+    def test_add_wraps_and_propagates(self):
+        self.tree.add(np.array([1., 2., 3.]))
+        idxs = self.tree.add(np.array([4., 5., 6.]))
+        np.testing.assert_array_equal([3, 4, 0], idxs)
+        self.assertEqual(5, self.tree.n_entries)
+        self.assertAlmostEqual(6. + 2. + 3. + 4. + 5., self.tree.total())
+        self.assertAlmostEqual(2., self.tree.min())
+
+    def test_update_keeps_last_duplicate(self):
+        self.tree.add(np.ones(5))
+        self.tree.update(np.array([1, 3, 1]), np.array([10., 0.5, 7.]))
+        np.testing.assert_array_equal([1., 7., 1., .5, 1.], self.tree.get(np.arange(5)))
+        self.assertAlmostEqual(10.5, self.tree.total())
+        self.assertAlmostEqual(.5, self.tree.min())
+
+    def test_retrieve_prefix_sums(self):
+        self.tree.add(np.array([1., 2., 3., 4.]))
+        leaves = self.tree.retrieve(np.array([0., 0.5, 1.5, 3.5, 6.5, 9.99]))
+        np.testing.assert_array_equal([0, 0, 1, 2, 3, 3], leaves)
+
+    def test_sample_follows_priorities(self):
+        self.tree.add(np.array([1., 0., 3., 0., 4.]))
+        counts = np.bincount(np.concatenate([self.tree.sample(8) for _ in range(500)]), minlength=5)
+        self.assertEqual(0, counts[1])
+        self.assertEqual(0, counts[3])
+        np.testing.assert_allclose([1 / 8, 3 / 8, 4 / 8], counts[[0, 2, 4]] / counts.sum(), atol=0.02)
@@ -0,0 +1,97 @@
+import unittest
+
+import numpy as np
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.episode_batch import concat_batches
+from marl.components.transforms import OneHot
+
+N_AGENTS = 2
+N_ACTIONS = 3
+MAX_SEQ_LENGTH = 5
+
+
+class EpisodeBatchTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scheme = {"actions": {"vshape": (1,), "group": "agents", "dtype": th.long}}
+        self.groups = {"agents": N_AGENTS}
+
+    def build_batch(self, lazy):
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS, lazy=lazy)])}
+        batch = EpisodeBatch(self.scheme, self.groups, 2, MAX_SEQ_LENGTH, preprocess=preprocess)
+        for t in range(3):
+            batch.update({"actions": th.full((2, N_AGENTS, 1), (t + 1) % N_ACTIONS, dtype=th.long)}, ts=t)
+        return batch
+
+    def test_lazy_field_matches_eager_preprocessing(self):
+        eager, lazy = self.build_batch(lazy=False), self.build_batch(lazy=True)
+        self.assertNotIn("actions_onehot", lazy.data.transition_data)
+        self.assertTrue(th.equal(eager["actions_onehot"], lazy["actions_onehot"]))
+        for t in range(MAX_SEQ_LENGTH):
+            self.assertTrue(th.equal(eager["actions_onehot"][:, t], lazy.get_timestep("actions_onehot", t)))
+        self.assertTrue(th.equal(eager[:, 1:3]["actions_onehot"], lazy[:, 1:3]["actions_onehot"]))
+
+    def test_lazy_field_follows_updates(self):
+        batch = self.build_batch(lazy=True)
+        self.assertEqual(1., batch["actions_onehot"][0, 0, 0, 1].item())
+        batch.update({"actions": th.zeros((2, N_AGENTS, 1), dtype=th.long)}, ts=0)
+        self.assertEqual(1., batch["actions_onehot"][0, 0, 0, 0].item())
+        self.assertEqual(0., batch["actions_onehot"][0, 0, 0, 1].item())
+
+    def test_update_stacked_matches_update(self):
+        scheme = {**self.scheme, "obs": {"vshape": 4, "group": "agents"}, "state": {"vshape": (3,)}}
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+        batch = EpisodeBatch(scheme, self.groups, 3, MAX_SEQ_LENGTH, preprocess=preprocess)
+        stacked = EpisodeBatch(scheme, self.groups, 3, MAX_SEQ_LENGTH, preprocess=preprocess)
+        obs = np.random.rand(2, N_AGENTS, 4)  # float64 is converted to the dtype of the field
+        actions = np.full((2, N_AGENTS, 1), 2)
+        batch.update({"obs": list(obs), "actions": actions.tolist()}, bs=[0, 2], ts=1)
+        stacked.update_stacked({"obs": obs, "actions": actions}, bs=[0, 2], ts=1)
+        for key in ["obs", "actions", "actions_onehot", "filled"]:
+            self.assertTrue(th.equal(batch[key], stacked[key]), key)
+        with self.assertRaises(ValueError):
+            stacked.update_stacked({"state": np.zeros((2, 4))}, bs=[0, 2], ts=1)
+
+    def test_concat_batches_pads_shorter_batches(self):
+        batch = self.build_batch(lazy=True)
+        short = batch[:1, :3]
+        concat = concat_batches([batch, short])
+        self.assertEqual((3, MAX_SEQ_LENGTH), (concat.batch_size, concat.max_seq_length))
+        self.assertTrue(th.equal(batch["actions_onehot"], concat["actions_onehot"][:2]))
+        self.assertTrue(th.equal(short["actions_onehot"], concat["actions_onehot"][2:, :3]))
+        self.assertEqual(0, concat["filled"][2, 3:].sum().item())
+
+    def test_shared_fields_are_written_once(self):
+        scheme = {**self.scheme, "state": {"vshape": (3,)}}
+        home = EpisodeBatch(scheme, self.groups, 2, MAX_SEQ_LENGTH)
+        away = EpisodeBatch(scheme, self.groups, 2, MAX_SEQ_LENGTH, shared=home.shared_fields(["state", "filled"]))
+        home.update({"state": th.ones(2, 3), "actions": th.ones(2, N_AGENTS, 1, dtype=th.long)}, ts=0)
+        away.update({"actions": th.full((2, N_AGENTS, 1), 2, dtype=th.long)}, ts=0, mark_filled=False)
+        self.assertEqual(home["state"].data_ptr(), away["state"].data_ptr())
+        self.assertTrue(th.equal(home["filled"], away[:, :]["filled"]))
+        self.assertEqual(2, away["filled"].sum().item())
+        self.assertEqual(2, away["actions"][0, 0, 0, 0].item())
+        self.assertEqual(1, home["actions"][0, 0, 0, 0].item())
+
+    def test_update_stacked_with_timestep_per_row(self):
+        batch = self.build_batch(lazy=True)
+        batch.update_stacked({"actions": th.zeros((2, N_AGENTS, 1), dtype=th.long)}, bs=[1, 0], ts=[4, 1])
+        self.assertEqual([[1, 1, 1, 0, 0], [1, 1, 1, 0, 1]], batch["filled"].squeeze(-1).tolist())
+        self.assertEqual(1., batch["actions_onehot"][1, 4, 0, 0].item())
+        self.assertEqual(1., batch["actions_onehot"][0, 1, 0, 0].item())
+        self.assertEqual(1., batch["actions_onehot"][1, 1, 0, 2].item())  # Rows keep their other timesteps
+
+    def test_cleared_batch_is_reused_for_shorter_episode(self):
+        scheme = {**self.scheme, "reward": {"vshape": (1,)}}
+        batch = EpisodeBatch(scheme, self.groups, 2, MAX_SEQ_LENGTH)
+        for t in range(MAX_SEQ_LENGTH):
+            batch.update({"reward": th.ones(2, 1)}, ts=t)
+        batch.clear()
+        for t in range(2):  # Shorter episode in the reused batch
+            batch.update({"reward": th.ones(2, 1)}, ts=t)
+        self.assertEqual([2., 2.], batch["reward"].sum(dim=(1, 2)).tolist())
+        self.assertEqual([2, 2], batch["filled"].sum(dim=(1, 2)).tolist())
+        batch.clear([1])
+        self.assertEqual([2., 0.], batch["reward"].sum(dim=(1, 2)).tolist())
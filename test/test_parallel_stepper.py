@@ -0,0 +1,121 @@
+import itertools
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.transforms import OneHot
+from marl.controllers.basic_controller import BasicMAC
+
+try:
+    import envs
+    from steppers.parallel_stepper import ParallelStepper
+except ImportError as e:  # Envs and loggers depend on the multi-agent env package
+    raise unittest.SkipTest(f"Steppers can not be imported: {e}")
+
+N_AGENTS = 2
+N_ACTIONS = 3
+OBS_SHAPE = 4
+BATCH_SIZE_RUN = 3
+EPISODE_LIMIT = 6
+
+
+class CountingEnv:
+    instances = itertools.count()
+
+    def __init__(self, **kwargs):
+        """
+        Env whose observations count the steps taken. Episodes of the envs built in a process last 2, 4, 2, ... steps.
+        """
+        self.length = 2 if next(CountingEnv.instances) % 2 == 0 else 4
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+
+    def step(self, actions):
+        self.t += 1
+        done = self.t >= self.length
+        info = {"battle_won": [True, False], "draw": False, "episode_length": self.t}
+        return self.get_obs(), [1., 0.], [done, False], info
+
+    def get_obs(self):
+        return [np.full(OBS_SHAPE, self.t, dtype=np.float32) for _ in range(N_AGENTS)]
+
+    def get_state(self):
+        return np.full(3, self.t, dtype=np.float32)
+
+    def get_avail_actions(self):
+        return [[1] * N_ACTIONS for _ in range(N_AGENTS)]
+
+    def get_env_info(self):
+        return {"n_agents": N_AGENTS, "n_actions": N_ACTIONS, "obs_shape": OBS_SHAPE, "state_shape": 3,
+                "episode_limit": EPISODE_LIMIT}
+
+    def close(self):
+        pass
+
+
+class Logger:
+    test_mode = False
+
+    def collect(self, *args, **kwargs):
+        pass
+
+    def log(self, t_env):
+        pass
+
+
+class ParallelStepperTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        envs.REGISTRY["counting"] = CountingEnv  # Inherited by the forked env workers
+        # Two worker processes, hosting the envs of rows 0-1 and row 2
+        self.args = SimpleNamespace(n_agents=N_AGENTS, n_actions=N_ACTIONS, agent="rnn", rnn_hidden_dim=8,
+                                    agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=1.,
+                                    epsilon_finish=.05, epsilon_anneal_time=10, freeze_native=False,
+                                    obs_last_action=True, obs_agent_id=True, device="cpu", batch_size_run=BATCH_SIZE_RUN,
+                                    envs_per_worker=2, batch_pool_size=1, env="counting",
+                                    env_args={"match_build_plan": [{"is_scripted": False}, {"is_scripted": True}]})
+        scheme = {
+            "state": {"vshape": 3},
+            "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+            "reward": {"vshape": (1,)},
+            "terminated": {"vshape": (1,), "dtype": th.uint8},
+        }
+        groups = {"agents": N_AGENTS}
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+        mac_scheme = EpisodeBatch(scheme, groups, 1, 1, preprocess=preprocess).scheme
+        self.stepper = ParallelStepper(self.args, Logger())
+        self.stepper.initialize(scheme, groups, preprocess, BasicMAC(mac_scheme, groups, self.args))
+
+    def tearDown(self) -> None:
+        self.stepper.close_env()
+        del envs.REGISTRY["counting"]
+
+    def test_episodes_of_different_length_are_collected_from_workers(self):
+        t_env = 0
+        for _ in range(2):  # Envs terminated in the first run are reset by the second
+            with th.no_grad():
+                batch, env_infos = self.stepper.run(test_mode=False)
+            lengths = [info["episode_length"] for info in env_infos]
+            self.assertEqual([2, 4, 2], lengths)
+            t_env += sum(lengths)
+            self.assertEqual(t_env, self.stepper.t_env)
+
+            for row, length in enumerate(lengths):
+                self.assertEqual(length + 1, batch["filled"][row].sum().item())
+                self.assertEqual([0.] * (length - 1) + [1.], batch["terminated"][row, :length].view(-1).tolist())
+                self.assertEqual(float(length), batch["reward"][row].sum().item())
+                # Observations written by the workers into the shared step data
+                self.assertTrue(th.equal(th.arange(length + 1, dtype=th.float), batch["obs"][row, :length + 1, 0, 0]))
+            self.stepper.recycle(batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
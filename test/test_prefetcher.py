@@ -0,0 +1,69 @@
+import time
+import unittest
+
+import torch as th
+
+from marl.components.replay_buffers import ReplayBuffer, BatchPrefetcher
+from marl.components.transforms import OneHot
+from test_replay_buffer import build_episode_batch, N_AGENTS, N_ACTIONS, MAX_SEQ_LENGTH
+
+
+class BatchPrefetcherTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scheme = {
+            "obs": {"vshape": 4, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "reward": {"vshape": (1,)},
+            "terminated": {"vshape": (1,), "dtype": th.uint8},
+        }
+        self.groups = {"agents": N_AGENTS}
+        self.preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS, lazy=True)])}
+        self.buffer = ReplayBuffer(self.scheme, self.groups, 8, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+
+    def build_prefetcher(self, max_staleness):
+        prefetcher = BatchPrefetcher(self.buffer, lambda buffer: buffer.sample(2),
+                                     lambda batch: batch[:, :batch.max_t_filled()],
+                                     batch_size=2, queue_size=2, max_staleness=max_staleness)
+        self.addCleanup(prefetcher.close)
+        return prefetcher
+
+    def insert(self, prefetcher, lengths):
+        prefetcher.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, lengths))
+
+    def test_prefetched_batches_are_truncated_and_do_not_share_staging(self):
+        prefetcher = self.build_prefetcher(max_staleness=2)
+        self.insert(prefetcher, [2, 3, 4, 5])
+        while not prefetcher.queue.full():
+            time.sleep(0.01)
+        data_ptrs = set()
+        for _ in range(3):
+            # Only the batch in training is guaranteed to stay untouched - check each before popping the next
+            batch = prefetcher.get()
+            self.assertEqual(batch.max_t_filled().item(), batch.max_seq_length)
+            ep_ids = (batch["obs"][:, 0, 0, 0] // 10).long()
+            self.assertTrue(th.equal(self.buffer["obs"][ep_ids, :batch.max_seq_length], batch["obs"]))
+            data_ptrs.add(batch["obs"].data_ptr())
+        self.assertEqual(3, len(data_ptrs))
+        self.assertGreater(prefetcher.occupancy(), 0.)
+
+    def test_stale_batches_are_dropped(self):
+        prefetcher = self.build_prefetcher(max_staleness=0)
+        self.insert(prefetcher, [2, 3])
+        while not prefetcher.queue.full():
+            time.sleep(0.01)
+        self.insert(prefetcher, [4, 5])
+        prefetcher.get()
+        self.assertGreaterEqual(prefetcher.dropped, 2)  # Both queued batches missed the second insertion
+
+    def test_errors_while_sampling_are_raised_by_get(self):
+        def sample_fn(buffer):
+            raise ValueError("sampling failed")
+
+        prefetcher = BatchPrefetcher(self.buffer, sample_fn, lambda batch: batch, batch_size=2)
+        self.addCleanup(prefetcher.close)
+        self.insert(prefetcher, [2, 3])
+        for _ in range(2):
+            with self.assertRaises(RuntimeError) as context:
+                prefetcher.get()
+            self.assertIsInstance(context.exception.__cause__, ValueError)
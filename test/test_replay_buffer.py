@@ -0,0 +1,315 @@
+import os
+import tempfile
+import unittest
+
+import torch as th
+
+from marl.components import EpisodeBatch
+from marl.components.codecs import build_codec
+from marl.components.replay_buffers import ReplayBuffer, PrioritizedReplayBuffer, PackedReplayBuffer, balanced
+from marl.components.transforms import OneHot
+
+N_AGENTS = 2
+N_ACTIONS = 3
+MAX_SEQ_LENGTH = 6
+
+
+def build_episode_batch(scheme, groups, preprocess, lengths):
+    batch = EpisodeBatch(scheme, groups, len(lengths), MAX_SEQ_LENGTH, preprocess=preprocess)
+    for b, length in enumerate(lengths):
+        for t in range(length + 1):
+            batch.update({
+                "obs": th.full((1, N_AGENTS, 4), float(b * 10 + t)),
+                "actions": th.full((1, N_AGENTS, 1), t % N_ACTIONS, dtype=th.long),
+                "reward": [(float(t),)],
+                "terminated": [(t == length - 1,)],
+            }, bs=b, ts=t)
+    return batch
+
+
+class ReplayBufferTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scheme = {
+            "obs": {"vshape": 4, "group": "agents"},
+            "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+            "reward": {"vshape": (1,)},
+            "terminated": {"vshape": (1,), "dtype": th.uint8},
+        }
+        self.groups = {"agents": N_AGENTS}
+        self.preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+
+    def build_buffer(self, buffer_size=4):
+        return ReplayBuffer(self.scheme, self.groups, buffer_size, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+
+    def insert_tagged(self, buffer, n):
+        # Insert n episodes one at a time, tagged with their insertion number
+        episodes = build_episode_batch(self.scheme, self.groups, self.preprocess, [2] * n)
+        for i in range(n):
+            buffer.tag = i
+            buffer.insert_episode_batch(episodes[i:i + 1])
+
+    def test_insert_wraps_around(self):
+        buffer = self.build_buffer()
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4]))
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [5, 1]))
+        self.assertEqual(4, buffer.episodes_in_buffer)
+        self.assertEqual(1, buffer.buffer_index)
+        # Second batch of episodes continued at the end and wrapped into the first slot
+        self.assertEqual(10., buffer["obs"][0, 0, 0, 0].item())
+        self.assertEqual(0., buffer["obs"][3, 0, 0, 0].item())
+        self.assertEqual(6, buffer["filled"][3].sum().item())
+
+    def test_sample_gathers_rows_into_staging(self):
+        buffer = self.build_buffer()
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 5]))
+        sample = buffer.sample(2)
+        obs = sample["obs"]
+        for b in range(2):
+            ep_id = int(obs[b, 0, 0, 0].item()) // 10
+            self.assertTrue(th.equal(buffer["obs"][ep_id], obs[b]))
+            self.assertTrue(th.equal(buffer["actions_onehot"][ep_id], sample["actions_onehot"][b]))
+        # Staging tensors are reused across samples of the same size
+        self.assertIs(sample, buffer.sample(2))
+        self.assertEqual(obs.data_ptr(), buffer.sample(2)["obs"].data_ptr())
+
+    def test_length_bucketed_sampling_groups_similar_lengths(self):
+        buffer = ReplayBuffer(self.scheme, self.groups, 6, MAX_SEQ_LENGTH, preprocess=self.preprocess,
+                              sampler="length_bucketed")
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [1, 5, 1, 5, 1, 5]))
+        counts = th.zeros(6)
+        for _ in range(600):
+            ep_ids = (buffer.sample(2)["obs"][:, 0, 0, 0] // 10).long()
+            counts[ep_ids] += 1
+        # Only 2 of the 6 windows over the sorted episodes mix short and long episodes (uniform sampling: 9 of 15 pairs)
+        self.assertLess(buffer.padding_ratio(), 0.2)
+        self.assertEqual(0., buffer.padding_ratio())  # Reset by the previous call
+        self.assertTrue(th.allclose(counts / counts.sum(), th.full((6,), 1 / 6), atol=0.04))
+        buffer.sampler = "uniform"
+        for _ in range(600):
+            buffer.sample(2)
+        self.assertGreater(buffer.padding_ratio(), 0.2)
+
+    def test_sample_sequences_from_within_episodes(self):
+        scheme = {**self.scheme, "hidden_states": {"vshape": (1,), "group": "agents"}}
+        episodes = build_episode_batch(scheme, self.groups, self.preprocess, [5, 4, 5, 3])
+        episodes.update({"hidden_states": episodes["obs"][..., :1]})
+        buffer = ReplayBuffer(scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+        buffer.insert_episode_batch(episodes)
+        for _ in range(20):
+            sequences = buffer.sample_sequences(4, sequence_length=2, burn_in=2)
+            self.assertEqual(5, sequences.max_seq_length)
+            for b in range(4):
+                ep_id, t = divmod(int(sequences["obs"][b, 0, 0, 0].item()), 10)
+                burn_in = sequences["burn_in"][b].item()
+                self.assertEqual(min(2, t + burn_in), burn_in)  # Shorter burn-in only at the start of episodes
+                n_filled = sequences["filled"][b].sum().item()
+                self.assertGreaterEqual(n_filled, burn_in + 2)  # At least one trained transition
+                self.assertTrue(th.equal(episodes["obs"][ep_id, t:t + n_filled], sequences["obs"][b, :n_filled]))
+                self.assertTrue(th.equal(sequences["obs"][b, :, :, :1], sequences["hidden_states"][b]))
+                self.assertEqual(0, sequences["obs"][b, n_filled:].abs().sum().item())
+
+    def test_episode_index_weights_samples(self):
+        episodes = build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 5])
+        for buffer in [self.build_buffer(),
+                       PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)]:
+            buffer.tag = 7
+            buffer.insert_episode_batch(episodes[:3], {"outcome": [1, 2, 1], "t_env": [10, 10, 10]})
+            buffer.insert_episode_batch(episodes[3:])
+            index = buffer.episode_index()
+            self.assertEqual([3, 4, 5, 6], index["length"].tolist())
+            self.assertEqual([3., 6., 10., 15.], index["return"].tolist())  # Rewards 0, 1, ... per filled timestep
+            self.assertEqual([1, 2, 1, 0], index["outcome"].tolist())
+            self.assertEqual([7] * 4, index["tag"].tolist())
+            for _ in range(5):
+                sample = buffer.sample(2, weights=lambda idx: idx["outcome"] == 1)
+                self.assertEqual([0., 20.], sorted(sample["obs"][:, 0, 0, 0].tolist()))
+            # Episodes of a rare outcome are as likely as all episodes of a frequent outcome
+            weights = balanced("outcome")(index)
+            self.assertEqual([.5, 1., .5, 1.], weights.tolist())
+
+    def test_episode_index_ignores_unfilled_timesteps(self):
+        episodes = build_episode_batch(self.scheme, self.groups, self.preprocess, [4, 5])
+        episodes.data.transition_data["filled"][:, 3:] = 0  # Stale data of a longer episode remains behind
+        for buffer in [self.build_buffer(),
+                       PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)]:
+            buffer.insert_episode_batch(episodes)
+            index = buffer.episode_index()
+            self.assertEqual([3, 3], index["length"].tolist())
+            self.assertEqual([3., 3.], index["return"].tolist())
+
+    def test_storage_in_shared_memory(self):
+        buffer = self.build_buffer()
+        self.assertTrue(buffer["obs"].is_shared())
+
+    def test_memmap_storage(self):
+        with tempfile.TemporaryDirectory() as storage_dir:
+            buffer = ReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess,
+                                  storage="memmap", storage_dir=storage_dir)
+            buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 5]))
+            self.assertFalse(buffer["obs"].is_shared())
+            sample = buffer.sample(4)
+            self.assertEqual(2 + 3 + 4 + 5 + 4, sample["filled"].sum().item())
+            self.assertEqual([], os.listdir(storage_dir))  # Backing files are unlinked after mapping
+
+    def test_codecs_decode_on_sample(self):
+        encoded_scheme = {**self.scheme, "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int}}
+        batch = build_episode_batch(encoded_scheme, self.groups, self.preprocess, [2, 3, 4, 5])
+        batch.update({"avail_actions": th.randint(0, 2, (4, MAX_SEQ_LENGTH, N_AGENTS, N_ACTIONS))})
+        codecs = {
+            "obs": build_codec("float16"),
+            "reward": build_codec({"codec": "uint8", "low": 0., "high": 10.}),
+            "avail_actions": build_codec("bitpack"),
+            "terminated": build_codec({"codec": "bitpack", "dim": 1}),
+            "filled": build_codec({"codec": "bitpack", "dim": 1}),
+        }
+        for key, codec in codecs.items():
+            encoded_scheme[key] = {**encoded_scheme.get(key, {}), "codec": codec}
+        buffer = ReplayBuffer(encoded_scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+        buffer.insert_episode_batch(batch)
+        self.assertEqual(th.uint8, buffer["filled"].dtype)
+        self.assertEqual((4, 1, 1), buffer["filled"].shape)
+        sample = buffer.sample(4)
+        for key in ["obs", "avail_actions", "terminated", "filled", "actions_onehot"]:
+            self.assertEqual(batch[key].dtype, sample[key].dtype)
+            self.assertTrue(th.equal(batch[key], sample[key]), key)
+        self.assertTrue(th.allclose(batch["reward"], sample["reward"], atol=0.02))
+
+    def test_prioritized_sample_carries_weights_and_updates_priorities(self):
+        buffer = PrioritizedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 5]))
+        sample = buffer.sample(2)
+        self.assertTrue(th.equal(th.ones(2, 1), sample["is_weights"]))  # New episodes share the max priority
+        ep_ids = sample["ep_ids"].clone()
+        buffer.update_priorities(sample, th.tensor([3., 0.]))
+        priorities = buffer.tree.get(ep_ids.numpy())
+        self.assertGreater(priorities[0], priorities[1])
+        # Truncation to the filled timesteps keeps the per-episode data
+        sample = buffer.sample(2)
+        self.assertTrue(th.equal(sample["ep_ids"], sample[:, :3]["ep_ids"]))
+
+    def test_sample_projects_to_required_keys(self):
+        preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS, lazy=True)])}
+        episodes = build_episode_batch(self.scheme, self.groups, preprocess, [2, 3, 4, 5])
+        for buffer in [PrioritizedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=preprocess),
+                       PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=preprocess)]:
+            buffer.insert_episode_batch(episodes)
+            sample = buffer.sample(2, keys={"reward", "actions_onehot"})
+            # The lazy field is derived from its stored source, which is gathered in its place
+            self.assertEqual({"reward", "actions", "filled"}, set(sample.data.transition_data))
+            self.assertEqual(sample["filled"].sum().item() * N_AGENTS, sample["actions_onehot"].sum().item())
+            if isinstance(buffer, PrioritizedReplayBuffer):
+                self.assertIn("is_weights", sample.data.episode_data)
+
+    def test_packed_sample_matches_padded_episodes(self):
+        episodes = build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 1])
+        buffer = PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess,
+                                    step_capacity=16)
+        buffer.insert_episode_batch(episodes)
+        self.assertEqual((16, N_AGENTS, 4), buffer["obs"].shape)
+        sample = buffer.sample(2)
+        ep_ids = (sample["obs"][:, 0, 0, 0] // 10).long()
+        max_t = episodes["filled"][ep_ids].sum(1).max().item()
+        self.assertEqual(max_t, sample.max_seq_length)
+        self.assertEqual(max_t, sample.max_t_filled().item())
+        for key in ["obs", "actions", "reward", "terminated", "filled", "actions_onehot"]:
+            self.assertTrue(th.equal(episodes[ep_ids, :max_t][key], sample[key]), key)
+
+    def test_packed_evicts_overwritten_episodes(self):
+        buffer = PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess,
+                                    step_capacity=8)
+        # Episodes fill 3, 4 and 2 timesteps - the third one wraps to the start and overwrites the first
+        buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 1]))
+        self.assertEqual(2, buffer.episodes_in_buffer)
+        self.assertEqual([4, 2], buffer.lengths[[1, 2]].tolist())
+        self.assertEqual(0, buffer.offsets[2].item())
+        sample = buffer.sample(2)
+        self.assertEqual([1., 2.], sorted((sample["obs"][:, 0, 0, 0] // 10).tolist()))
+
+    def test_evict_tagged_episodes(self):
+        old = build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3])
+        new = build_episode_batch(self.scheme, self.groups, self.preprocess, [4, 5])
+        for buffer in [self.build_buffer(),
+                       PrioritizedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess),
+                       PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)]:
+            buffer.tag = 1
+            buffer.insert_episode_batch(old)
+            buffer.tag = 2
+            buffer.insert_episode_batch(new)
+            buffer.evict([1])
+            self.assertEqual(2, buffer.episodes_in_buffer)
+            sample = buffer.sample(2)
+            self.assertTrue(th.equal(new[:, :sample.max_seq_length]["obs"], sample["obs"]))
+            self.assertTrue(th.equal(new[:, :sample.max_seq_length]["filled"], sample["filled"]))
+            buffer.insert_episode_batch(old)  # Insertion continues behind the remaining episodes
+            self.assertEqual(4, buffer.episodes_in_buffer)
+
+    def test_evict_tagged_episodes_after_wraparound(self):
+        for buffer in [self.build_buffer(),
+                       PrioritizedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess),
+                       PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)]:
+            self.insert_tagged(buffer, 6)
+            self.assertEqual([2, 3, 4, 5], buffer.episode_index()["tag"].tolist())
+            buffer.evict([])
+            self.assertEqual([2, 3, 4, 5], buffer.episode_index()["tag"].tolist())
+            buffer.tag = 6
+            buffer.insert_episode_batch(build_episode_batch(self.scheme, self.groups, self.preprocess, [2]))
+            self.assertEqual([3, 4, 5, 6], buffer.episode_index()["tag"].tolist())  # The oldest episode is replaced
+            buffer.evict([4])
+            self.assertEqual([3, 5, 6], buffer.episode_index()["tag"].tolist())
+
+    def test_save_and_load_keep_newest_episodes(self):
+        episodes = build_episode_batch(self.scheme, self.groups, self.preprocess, [2, 3, 4, 1])
+        buffer = self.build_buffer()
+        buffer.insert_episode_batch(episodes)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "replay_buffer.pt")
+            buffer.save(path)
+            restored = self.build_buffer()
+            restored.load(path)
+            for key in ["obs", "actions", "filled", "actions_onehot"]:
+                self.assertTrue(th.equal(buffer[key], restored[key]), key)
+            # Three episodes fit into the packed buffer
+            packed = PackedReplayBuffer(self.scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess,
+                                        step_capacity=12)
+            packed.load(path)
+        self.assertEqual(3, packed.episodes_in_buffer)
+        sample = packed.sample(3)
+        self.assertTrue(th.equal(episodes[1:, :sample.max_seq_length]["obs"], sample["obs"]))
+
+    def test_save_and_load_keep_newest_episodes_after_wraparound(self):
+        buffer = self.build_buffer()
+        self.insert_tagged(buffer, 6)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "replay_buffer.pt")
+            buffer.save(path)
+            restored = self.build_buffer(buffer_size=2)
+            restored.load(path)
+        self.assertEqual([4, 5], restored.episode_index()["tag"].tolist())
+
+    def test_save_load_and_evict_fields_encoded_along_time(self):
+        scheme = dict(self.scheme)
+        for key in ["terminated", "filled"]:
+            scheme[key] = {**scheme.get(key, {}), "codec": build_codec({"codec": "bitpack", "dim": 1})}
+        episodes = build_episode_batch(scheme, self.groups, self.preprocess, [2, 3, 4, 5, 1])
+        for buffer_type in [ReplayBuffer, PrioritizedReplayBuffer]:
+            buffer = buffer_type(scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+            for i in range(5):
+                buffer.tag = i
+                buffer.insert_episode_batch(episodes[i:i + 1])
+            slots = buffer._slots(th.arange(4))
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "replay_buffer.pt")
+                buffer.save(path)
+                restored = buffer_type(scheme, self.groups, 4, MAX_SEQ_LENGTH, preprocess=self.preprocess)
+                restored.load(path)
+            for key in ["obs", "terminated", "filled"]:
+                self.assertTrue(th.equal(buffer[key][slots], restored[key]), key)
+
+            restored.evict([2])
+            self.assertEqual([1, 3, 4], restored.episode_index()["tag"].tolist())
+            for key in ["obs", "terminated", "filled"]:
+                self.assertTrue(th.equal(buffer[key][slots[[0, 2, 3]]], restored[key][:3]), key)
+            sample = restored.sample(3)
+            self.assertEqual([2, 4, 6], sorted(sample["filled"].view(3, -1).sum(1).tolist()))
+            self.assertEqual([1, 1, 1], sample["terminated"].view(3, -1).sum(1).tolist())
@@ -0,0 +1,138 @@
+import queue
+import unittest
+from types import SimpleNamespace
+
+import torch as th
+
+from custom_logging.collectibles import Collectibles
+from custom_logging.utils.enums import Originator
+from marl.components import EpisodeBatch
+from marl.components.transforms import OneHot
+from marl.controllers import BasicMAC, EnsembleMAC
+from marl.controllers.shared_policy import SharedPolicy
+
+try:
+    from runs.train.ma_experiment import MultiAgentExperiment
+except ImportError:  # Experiments depend on the multi-agent env package
+    MultiAgentExperiment = None
+
+N_AGENTS = 2
+N_ACTIONS = 3
+OBS_SHAPE = 4
+
+
+def new_args(**kwargs):
+    return SimpleNamespace(n_agents=N_AGENTS, n_actions=N_ACTIONS, agent="rnn", rnn_hidden_dim=8,
+                           agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=1.,
+                           epsilon_finish=.05, epsilon_anneal_time=10, freeze_native=False, obs_last_action=True,
+                           obs_agent_id=True, device="cpu", **kwargs)
+
+
+def new_batch(batch_size=1, max_seq_length=1):
+    scheme = {
+        "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+        "reward": {"vshape": (1,)},
+    }
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    return EpisodeBatch(scheme, {"agents": N_AGENTS}, batch_size, max_seq_length, preprocess=preprocess)
+
+
+class SharedPolicyTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        self.scheme = new_batch().scheme
+        self.learner_mac = BasicMAC(self.scheme, {"agents": N_AGENTS}, new_args())
+        self.actor_mac = BasicMAC(self.scheme, {"agents": N_AGENTS}, new_args())
+
+    def _assert_same_weights(self, mac, other_mac):
+        for (k, v), other_v in zip(mac.agent.state_dict().items(), other_mac.agent.state_dict().values()):
+            self.assertTrue(th.equal(v, other_v), k)
+
+    def test_pull_loads_published_weights(self):
+        policy = SharedPolicy(self.learner_mac)
+        self.assertEqual(0, policy.version)
+        with th.no_grad():
+            for p in self.learner_mac.parameters():
+                p.add_(1.)
+        policy.publish(self.learner_mac, t_env=42)
+        self.assertEqual(1, policy.version)
+        self.assertEqual(42, policy.t_env)
+
+        version = policy.pull(self.actor_mac, version=0)
+        self.assertEqual(1, version)
+        self._assert_same_weights(self.learner_mac, self.actor_mac)
+
+        # Weights of the current version are not loaded again
+        with th.no_grad():
+            for p in self.actor_mac.parameters():
+                p.zero_()
+        self.assertEqual(1, policy.pull(self.actor_mac, version=1))
+        self.assertTrue(all((p == 0).all() for p in self.actor_mac.parameters()))
+
+    def test_published_weights_are_a_copy(self):
+        policy = SharedPolicy(self.learner_mac)
+        policy.publish(self.learner_mac, t_env=0)
+        with th.no_grad():
+            for p in self.learner_mac.parameters():
+                p.add_(1.)
+        policy.pull(self.actor_mac, version=0)
+        self.assertFalse(th.equal(next(self.learner_mac.parameters()), next(self.actor_mac.parameters())))
+
+    def test_macs_with_several_agent_networks_are_rejected(self):
+        mac = EnsembleMAC(self.scheme, {"agents": N_AGENTS}, new_args())
+        with self.assertRaises(NotImplementedError):
+            SharedPolicy(mac)
+
+
+class Logger:
+
+    def __init__(self):
+        self.test_mode = None
+        self.collected = {}
+
+    def collect(self, collectible, data, origin=None, parallel=False):
+        self.collected[collectible, origin] = data
+
+    def log(self, t_env):
+        pass
+
+
+@unittest.skipIf(MultiAgentExperiment is None, "Experiments can not be imported.")
+class ReceiveRolloutTestCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        th.manual_seed(0)
+        mac = BasicMAC(new_batch().scheme, {"agents": N_AGENTS}, new_args())
+        self.experiment = SimpleNamespace(
+            rollouts=queue.Queue(), actors=[], home_policy=SharedPolicy(mac), stepper=SimpleNamespace(t_env=10),
+            logger=Logger(), args=SimpleNamespace(actor_max_policy_lag=1), dropped_rollouts=0
+        )
+        for _ in range(3):
+            self.experiment.home_policy.publish(mac, t_env=10)
+
+    @staticmethod
+    def _rollout(version, env_steps, returns):
+        batch = new_batch(batch_size=len(returns), max_seq_length=2)
+        batch.update({"reward": th.tensor(returns).view(-1, 1)}, ts=0)
+        infos = [{"battle_won": [True, False], "draw": False} for _ in returns]
+        return version, env_steps, batch, infos
+
+    def test_rollouts_of_stale_policies_are_dropped(self):
+        self.experiment.rollouts.put(self._rollout(version=1, env_steps=5, returns=[1.]))
+        self.experiment.rollouts.put(self._rollout(version=2, env_steps=7, returns=[2., 3.]))
+
+        episode_batch, env_info = MultiAgentExperiment._receive_rollout(self.experiment)
+
+        self.assertEqual(2, episode_batch.batch_size)
+        self.assertEqual(2, len(env_info))
+        self.assertEqual(1, self.experiment.dropped_rollouts)
+        self.assertEqual(22, self.experiment.stepper.t_env)  # Steps of dropped rollouts are counted as well
+        self.assertFalse(self.experiment.logger.test_mode)
+        self.assertEqual([2., 3.], self.experiment.logger.collected[Collectibles.RETURN, Originator.HOME])
+
+
+if __name__ == '__main__':
+    unittest.main()